@@ -0,0 +1,2 @@
+# Núcleo de consulta de afecciones ambientales de la UDIF
+from .capas import Capa, obtener_capa, descartar_capas
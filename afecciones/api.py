@@ -0,0 +1,265 @@
+# Servicio HTTP/JSON de consulta de afecciones, sin Streamlit. Las capas, el
+# almacén catastral y los índices se cargan una vez en el proceso principal y
+# después se crean los procesos de trabajo con fork(), que los comparten en
+# solo lectura (copia en escritura). Todos atienden el mismo socket.
+#
+#   python -m afecciones.api --puerto 8000 --procesos 4
+#
+# Rutas:
+#   GET  /salud
+#   GET  /version                          versión de los datos y huella de cada fichero
+#   GET  /metrics                          métricas del proceso que atiende, formato Prometheus
+#   GET  /consulta/punto?x=...&y=...       POST /consulta/punto    {"x": ..., "y": ...}
+#   POST /consulta/parcela   {"municipio": ..., "poligono": ..., "parcela": ...}
+#                            Las consultas admiten "proximidad": true (en GET, proximidad=1) y, en
+#                            POST, "distancias": {"VP": 200, ...} para cambiar los umbrales
+#   POST /informe            lo mismo que una de las consultas, más los datos del
+#                            solicitante (nombre, apellidos, dni...); devuelve el PDF.
+#                            Con "formato": "docx", o "plantilla": true para el PDF, el
+#                            informe se genera con la plantilla Word
+import argparse
+import gc
+import json
+import os
+import signal
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from . import metricas
+from .capas import obtener_capa
+from .catastro import obtener_almacen
+from .crs import transformar
+from .informe import componer_datos, generar_pdf
+from .plantilla import FORMATOS, generar_informe
+from .motor import CAPAS_AFECCION, con_distancias, consultar_afecciones
+from .versiones import obtener_versionado
+
+# Tamaño máximo del cuerpo de una petición
+MAXIMO_CUERPO = 1024 * 1024
+
+TIPOS_INFORME = {"pdf": "application/pdf",
+                 "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"}
+
+# Rutas atendidas; el resto se agrupa en una sola etiqueta de las métricas para que
+# las rutas que envíe un cliente no creen series nuevas
+RUTAS = ("/salud", "/version", "/metrics", "/consulta/punto", "/consulta/parcela", "/informe")
+
+CAMPOS_SOLICITANTE = ("fecha_solicitud", "nombre", "apellidos", "dni", "direccion", "telefono", "email", "objeto")
+
+
+# Error de la petición que se devuelve al cliente con su código HTTP
+class ErrorPeticion(Exception):
+    def __init__(self, mensaje, estado=400):
+        super().__init__(mensaje)
+        self.estado = estado
+
+
+def _numero(parametros, nombre):
+    try:
+        return float(parametros[nombre])
+    except KeyError:
+        raise ErrorPeticion(f"Falta el parámetro '{nombre}'") from None
+    except (TypeError, ValueError):
+        raise ErrorPeticion(f"El parámetro '{nombre}' debe ser numérico") from None
+
+
+# Modo de proximidad y capas con los umbrales pedidos
+def _proximidad(parametros):
+    proximidad = str(parametros.get("proximidad", "")).lower() in ("1", "true", "si", "sí")
+    distancias = parametros.get("distancias") or {}
+    if not isinstance(distancias, dict):
+        raise ErrorPeticion("El parámetro 'distancias' debe ser un objeto {capa: metros}")
+    try:
+        capas = con_distancias({c: float(d) for c, d in distancias.items()})
+    except (TypeError, ValueError):
+        raise ErrorPeticion("Las distancias deben ser numéricas") from None
+    return proximidad, capas
+
+
+# Resultado de una consulta por punto o por parcela, con los datos de localización
+def consultar(parametros):
+    proximidad, capas = _proximidad(parametros)
+    if "municipio" in parametros:
+        almacen = obtener_almacen()
+        if almacen is None:
+            raise ErrorPeticion("El almacén catastral no está disponible", 503)
+        try:
+            municipio, poligono, parcela = (parametros[c] for c in ("municipio", "poligono", "parcela"))
+        except KeyError as e:
+            raise ErrorPeticion(f"Falta el parámetro '{e.args[0]}'") from None
+        geometria = almacen.geometria(municipio, poligono, parcela)
+        if geometria is None:
+            raise ErrorPeticion("Parcela no encontrada", 404)
+        centro = geometria.centroid
+        resultado = consultar_afecciones(centro.x, centro.y, capas=capas, geometria=geometria,
+                                         proximidad=proximidad)
+        return resultado, {"municipio": str(municipio), "poligono": str(poligono), "parcela": str(parcela)}
+
+    resultado = consultar_afecciones(_numero(parametros, "x"), _numero(parametros, "y"), capas=capas,
+                                     proximidad=proximidad)
+    return resultado, {}
+
+
+class ManejadorAPI(BaseHTTPRequestHandler):
+    server_version = "AfeccionesUDIF"
+    _estado = None
+
+    def _responder(self, estado, cuerpo, tipo="application/json; charset=utf-8"):
+        if not isinstance(cuerpo, bytes):
+            cuerpo = json.dumps(cuerpo, ensure_ascii=False).encode("utf-8")
+        self._estado = estado
+        self.send_response(estado)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.send_header("X-Request-Id", metricas.identificador() or "")
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _cuerpo(self):
+        try:
+            longitud = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            longitud = -1
+        if longitud < 0:
+            raise ErrorPeticion("Content-Length no válido")
+        if longitud > MAXIMO_CUERPO:
+            raise ErrorPeticion("Petición demasiado grande", 413)
+        if not longitud:
+            return {}
+        try:
+            datos = json.loads(self.rfile.read(longitud))
+        except ValueError:
+            raise ErrorPeticion("El cuerpo debe ser JSON") from None
+        if not isinstance(datos, dict):
+            raise ErrorPeticion("El cuerpo debe ser un objeto JSON")
+        return datos
+
+    # Cada petición lleva un identificador de correlación (el de la cabecera X-Request-Id
+    # si el cliente la envía) que aparece en la respuesta y en la línea de registro
+    def _atender(self, metodo):
+        url = urlparse(self.path)
+        ruta = url.path.rstrip("/") or "/"
+        tipo = ruta if ruta in RUTAS else "desconocida"
+        with metricas.peticion(tipo, self.headers.get("X-Request-Id"), metodo=metodo, ruta=ruta) as datos:
+            self._despachar(metodo, url, ruta)
+            datos["estado_http"] = self._estado
+            if self._estado >= 500:
+                datos["estado"] = "error"
+            elif self._estado >= 400:
+                datos["estado"] = "error_cliente"
+
+    def _despachar(self, metodo, url, ruta):
+        try:
+            if metodo == "GET":
+                parametros = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            else:
+                parametros = self._cuerpo()
+
+            if ruta == "/salud" and metodo == "GET":
+                self._responder(200, {"estado": "ok", "pid": os.getpid(),
+                                      "version_datos": obtener_versionado().version})
+            elif ruta == "/version" and metodo == "GET":
+                self._responder(200, obtener_versionado().como_dict())
+            elif ruta == "/metrics" and metodo == "GET":
+                self._responder(200, metricas.texto_prometheus().encode("utf-8"),
+                                "text/plain; version=0.0.4; charset=utf-8")
+            elif ruta in ("/consulta/punto", "/consulta/parcela"):
+                resultado, _ = consultar(parametros)
+                self._responder(200, resultado.como_dict())
+            elif ruta == "/informe" and metodo == "POST":
+                resultado, localizacion = consultar(parametros)
+                solicitante = {c: str(parametros.get(c, "")) for c in CAMPOS_SOLICITANTE}
+                datos = componer_datos(resultado, **solicitante, **localizacion)
+                formato = str(parametros.get("formato", "pdf")).lower()
+                if formato not in FORMATOS:
+                    raise ErrorPeticion(f"Formato desconocido: {formato} (opciones: {', '.join(FORMATOS)})")
+                if formato == "docx" or parametros.get("plantilla") in (True, "1", "true"):
+                    informe = generar_informe(datos, resultado.x, resultado.y, formato)
+                else:
+                    informe = generar_pdf(datos, resultado.x, resultado.y)
+                self._responder(200, informe.getvalue(), TIPOS_INFORME[formato])
+            else:
+                raise ErrorPeticion("Ruta no encontrada", 404)
+        except ErrorPeticion as e:
+            self._responder(e.estado, {"error": str(e)})
+        except Exception as e:
+            self.log_error("Error atendiendo %s: %r", self.path, e)
+            self._responder(500, {"error": "Error interno"})
+
+    def do_GET(self):
+        self._atender("GET")
+
+    def do_POST(self):
+        self._atender("POST")
+
+
+# Carga en el proceso principal todo lo que deben compartir los procesos de trabajo
+def precargar(capas=CAPAS_AFECCION):
+    for definicion in capas:
+        try:
+            capa = obtener_capa(definicion.origen, definicion.nombre)
+            print(f"Capa {definicion.nombre}: {len(capa)} elementos", file=sys.stderr)
+        except Exception as e:
+            print(f"Capa {definicion.nombre} no disponible: {e}", file=sys.stderr)
+    obtener_almacen()
+    # Las huellas de los ficheros se calculan una vez; cada proceso de trabajo arranca su
+    # propio hilo de actualización
+    obtener_versionado(iniciar=False)
+    transformar(0, 0)
+    # Los objetos cargados pasan a la generación permanente para que el recolector
+    # no los recorra y no fuerce la copia de sus páginas en cada proceso hijo
+    gc.collect()
+    gc.freeze()
+
+
+def servir(host="127.0.0.1", puerto=8000, procesos=None):
+    precargar()
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorAPI)
+    procesos = procesos or os.cpu_count() or 1
+    print(f"Escuchando en http://{host}:{puerto} con {procesos} procesos", file=sys.stderr)
+
+    if procesos == 1:
+        servidor.serve_forever()
+        return
+
+    hijos = []
+    for _ in range(procesos):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                servidor.serve_forever()
+            finally:
+                os._exit(0)
+        hijos.append(pid)
+
+    def terminar(*_):
+        for pid in hijos:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminar)
+    try:
+        for pid in hijos:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        terminar()
+    finally:
+        servidor.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servicio HTTP de consulta de afecciones")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8000)
+    parser.add_argument("--procesos", type=int, default=None, help="procesos de trabajo (por defecto, uno por CPU)")
+    args = parser.parse_args(argv)
+    servir(args.host, args.puerto, args.procesos)
+
+
+if __name__ == "__main__":
+    main()
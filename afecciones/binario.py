@@ -0,0 +1,119 @@
+# Formato binario de las capas de afección: un fichero Arrow IPC (.arrow) junto a
+# cada GeoJSON / Esri JSON, con la tabla de atributos, la geometría en WKB y la
+# envolvente de cada elemento. Se abre mapeado en memoria y sin copiar, de modo que
+# no hay texto que analizar al arrancar, los procesos que leen la misma capa
+# comparten sus páginas y una geometría solo se decodifica cuando una consulta la
+# necesita por primera vez; después se reutiliza. El índice espacial se construye sobre las envolventes guardadas.
+#
+#   python -m afecciones.binario            # convierte todas las capas locales
+#   python -m afecciones.binario GeoJSON/MUP.json
+import os
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import shapely
+
+from .capas import Capa
+from .config import DIRECTORIO_DATOS
+
+EXTENSION = ".arrow"
+
+COLUMNA_GEOMETRIA = "__geometria"
+COLUMNAS_CAJA = ("__xmin", "__ymin", "__xmax", "__ymax")
+
+
+# Ruta relativa del fichero binario de una capa ("GeoJSON/MUP.json" -> "GeoJSON/MUP.arrow")
+def ruta_binaria(origen):
+    return str(Path(origen).with_suffix(EXTENSION))
+
+
+# Convierte un fichero de capa (cualquier formato que lea GDAL) a Arrow IPC
+def convertir_capa(entrada, salida=None):
+    entrada = Path(entrada)
+    salida = Path(salida) if salida else entrada.with_suffix(EXTENSION)
+    gdf = gpd.read_file(entrada)
+
+    geometrias = gdf.geometry.to_numpy()
+    cajas = shapely.bounds(geometrias)
+    tabla = pa.Table.from_pandas(gdf.drop(columns=gdf.geometry.name), preserve_index=False)
+    tabla = tabla.append_column(COLUMNA_GEOMETRIA, pa.array(shapely.to_wkb(geometrias), type=pa.binary()))
+    for i, nombre in enumerate(COLUMNAS_CAJA):
+        tabla = tabla.append_column(nombre, pa.array(cajas[:, i]))
+    metadatos = {b"crs": gdf.crs.to_string().encode() if gdf.crs else b"", b"origen": entrada.name.encode()}
+    tabla = tabla.replace_schema_metadata({**(tabla.schema.metadata or {}), **metadatos})
+
+    # Sin compresión, para que las columnas se puedan usar directamente desde el mapa en memoria
+    temporal = salida.with_name(f".{salida.name}.{os.getpid()}.tmp")
+    with pa.OSFile(str(temporal), "wb") as fichero, pa.ipc.new_file(fichero, tabla.schema) as escritor:
+        escritor.write_table(tabla)
+    temporal.replace(salida)
+    return salida
+
+
+# Geometrías de una columna WKB, indexables con una posición o un array de posiciones.
+# Cada elemento se decodifica (y se prepara) la primera vez que se pide y se guarda,
+# de modo que las consultas siguientes no vuelven a leer el WKB y una posición
+# repetida en la misma petición se decodifica una sola vez.
+class GeometriasWKB:
+    def __init__(self, columna):
+        self.columna = columna.combine_chunks() if isinstance(columna, pa.ChunkedArray) else columna
+        self._decodificadas = np.empty(len(self.columna), dtype=object)
+        self._hechas = np.zeros(len(self.columna), dtype=bool)
+
+    def __len__(self):
+        return len(self.columna)
+
+    def __getitem__(self, posiciones):
+        if isinstance(posiciones, (int, np.integer)):
+            self._decodificar(np.array([posiciones], dtype=np.int64))
+            return self._decodificadas[int(posiciones)]
+        posiciones = np.asarray(posiciones, dtype=np.int64)
+        self._decodificar(np.unique(posiciones))
+        return self._decodificadas[posiciones]
+
+    # Decodifica las posiciones (sin repetir) que aún no se han pedido. Si dos hilos
+    # decodifican la misma a la vez, las dos geometrías son iguales y queda una.
+    def _decodificar(self, unicas):
+        pendientes = unicas[~self._hechas[unicas]]
+        if len(pendientes) == 0:
+            return
+        geometrias = shapely.from_wkb(self.columna.take(pa.array(pendientes)).to_numpy(zero_copy_only=False))
+        shapely.prepare(geometrias)
+        self._decodificadas[pendientes] = geometrias
+        self._hechas[pendientes] = True
+
+
+# Capa leída de un fichero Arrow IPC mapeado en memoria
+def leer_capa_binaria(ruta, nombre):
+    mapa = pa.memory_map(str(ruta), "r")
+    tabla = pa.ipc.open_file(mapa).read_all()
+    metadatos = tabla.schema.metadata or {}
+
+    cajas = np.column_stack([tabla.column(c).to_numpy() for c in COLUMNAS_CAJA])
+    geometrias = GeometriasWKB(tabla.column(COLUMNA_GEOMETRIA))
+    atributos = tabla.drop_columns([COLUMNA_GEOMETRIA, *COLUMNAS_CAJA]).to_pandas()
+    crs = metadatos.get(b"crs", b"").decode() or None
+    capa = Capa(nombre, atributos, geometrias=geometrias, cajas=cajas, crs=crs)
+    # El mapa debe vivir lo mismo que la capa, que usa sus páginas
+    capa.mapa = mapa
+    return capa
+
+
+def main(argv=None):
+    from .motor import CAPAS_AFECCION
+
+    origenes = argv if argv else [d.origen for d in CAPAS_AFECCION]
+    for origen in origenes:
+        entrada = Path(origen) if Path(origen).is_absolute() else DIRECTORIO_DATOS / origen
+        if not entrada.is_file():
+            print(f"{origen}: no existe, se omite", file=sys.stderr)
+            continue
+        salida = convertir_capa(entrada)
+        print(f"{origen} ({entrada.stat().st_size} bytes) -> {salida.name} ({salida.stat().st_size} bytes)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+# Caché persistente de resultados, direccionada por contenido: la clave combina la
+# versión de los datos (versiones.py, huella de los ficheros de GeoJSON/ y CATASTRO/)
+# con la geometría consultada redondeada al centímetro. Al cambiar un fichero cambia
+# la versión, las entradas antiguas dejan de usarse y se borran. El tamaño está
+# acotado y se expulsan primero las entradas usadas hace más tiempo (LRU).
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import shapely
+
+from . import config, metricas
+from .versiones import version_datos
+
+# Precisión (en metros) con la que se redondean las geometrías para formar la clave
+PRECISION = 0.01
+# Versión del formato de los valores guardados: se incrementa al cambiar las clases
+# que se serializan (ResultadoConsulta, Afeccion...) o lo que guarda cada espacio
+VERSION_ESQUEMA = "1"
+
+
+# Clave de una consulta: versión del esquema y de los datos, tipo de entrada y
+# geometría redondeada
+def clave(espacio, geometria, *extra):
+    geometria = shapely.normalize(shapely.set_precision(geometria, PRECISION))
+    huella = hashlib.sha256()
+    for parte in (VERSION_ESQUEMA, espacio, version_datos(), *map(str, extra)):
+        huella.update(parte.encode() + b"\0")
+    huella.update(shapely.to_wkb(geometria))
+    return huella.hexdigest()
+
+
+class CacheResultados:
+    def __init__(self, ruta=config.RUTA_CACHE_RESULTADOS, tamano_maximo=config.TAMANO_CACHE_RESULTADOS):
+        self.ruta = ruta
+        self.tamano_maximo = tamano_maximo
+        self.aciertos = 0
+        self.fallos = 0
+        self._local = threading.local()
+        self._version_limpiada = None
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+        with self._conexion() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS resultados (clave TEXT PRIMARY KEY, version TEXT, "
+                        "valor BLOB, tamano INTEGER, acceso REAL)")
+            con.execute("CREATE INDEX IF NOT EXISTS idx_resultados_acceso ON resultados (acceso)")
+
+    def _conexion(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return con
+
+    def obtener(self, clave):
+        con = self._conexion()
+        fila = con.execute("SELECT valor FROM resultados WHERE clave = ?", (clave,)).fetchone()
+        valor = None
+        if fila is not None:
+            try:
+                valor = pickle.loads(fila[0])
+            except Exception:
+                # Entrada de otra versión del código que ya no se puede leer
+                con.execute("DELETE FROM resultados WHERE clave = ?", (clave,))
+                fila = None
+        if fila is None:
+            self.fallos += 1
+            metricas.cache("resultados", False)
+            return None
+        con.execute("UPDATE resultados SET acceso = ? WHERE clave = ?", (time.time(), clave))
+        self.aciertos += 1
+        metricas.cache("resultados", True)
+        return valor
+
+    def guardar(self, clave, valor):
+        datos = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        version = version_datos()
+        con = self._conexion()
+        con.execute("INSERT OR REPLACE INTO resultados VALUES (?, ?, ?, ?, ?)",
+                    (clave, version, datos, len(datos), time.time()))
+        if self._version_limpiada != version:
+            # Las entradas de versiones anteriores ya no pueden acertar
+            con.execute("DELETE FROM resultados WHERE version != ?", (version,))
+            self._version_limpiada = version
+        self._expulsar(con)
+
+    # Borra las entradas menos usadas hasta quedar por debajo del tamaño máximo
+    def _expulsar(self, con):
+        total = con.execute("SELECT COALESCE(SUM(tamano), 0) FROM resultados").fetchone()[0]
+        if total <= self.tamano_maximo:
+            return
+        exceso = total - self.tamano_maximo
+        liberado = 0
+        claves = []
+        for clave, tamano in con.execute("SELECT clave, tamano FROM resultados ORDER BY acceso"):
+            claves.append((clave,))
+            liberado += tamano
+            if liberado >= exceso:
+                break
+        con.executemany("DELETE FROM resultados WHERE clave = ?", claves)
+
+    # Devuelve el valor guardado o lo calcula con funcion() y lo guarda si guardable(valor)
+    def memoizar(self, clave, funcion, guardable=lambda valor: True):
+        valor = self.obtener(clave)
+        if valor is None:
+            valor = funcion()
+            if guardable(valor):
+                self.guardar(clave, valor)
+        return valor
+
+
+_cache = None
+_bloqueo_cache = threading.Lock()
+
+
+# Las conexiones sqlite no deben cruzar un fork(): el hijo abre las suyas
+def _reiniciar_tras_fork():
+    global _cache
+    _cache = None
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+# Caché del proceso; None si está desactivada (AFECCIONES_CACHE_RESULTADOS_MAX=0)
+def obtener_cache():
+    global _cache
+    if _cache is None and config.TAMANO_CACHE_RESULTADOS > 0:
+        with _bloqueo_cache:
+            if _cache is None:
+                _cache = CacheResultados()
+    return _cache
@@ -0,0 +1,274 @@
+# Registro de capas de afección: cada capa se lee una sola vez por proceso
+# y se indexa con un STRtree para resolver las consultas punto-en-polígono
+# y de superposición con polígonos.
+import os
+import threading
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import CRS
+from shapely import STRtree
+from shapely.geometry import Point
+
+from . import config, metricas
+from .fuentes import obtener_fuente
+
+
+# Capa cargada en memoria junto con su índice espacial. Leída de texto, gdf es el
+# GeoDataFrame completo y el índice se construye sobre las geometrías. Leída del
+# formato binario (binario.py), gdf solo tiene los atributos, las geometrías se
+# decodifican del WKB mapeado en memoria a medida que se piden y el índice se
+# construye sobre las envolventes guardadas, que luego se refinan con la geometría.
+class Capa:
+    def __init__(self, nombre, gdf, geometrias=None, cajas=None, crs=None):
+        self.nombre = nombre
+        self.gdf = gdf.reset_index(drop=True)
+        if geometrias is None:
+            self.geometrias = np.asarray(self.gdf.geometry.values)
+            self.indice = STRtree(self.geometrias)
+            self.crs = self.gdf.crs
+        else:
+            self.geometrias = geometrias
+            self.indice = STRtree(shapely.box(cajas[:, 0], cajas[:, 1], cajas[:, 2], cajas[:, 3]))
+            # Se interpreta una sola vez: con el texto, cada GeoDataFrame de filas() lo volvería a analizar
+            self.crs = CRS.from_user_input(crs) if crs else None
+        self._simplificadas = {}
+        self._bloqueo = threading.Lock()
+
+    def __len__(self):
+        return len(self.gdf)
+
+    # Si el índice está construido sobre las geometrías (y no sobre sus envolventes)
+    @property
+    def indice_exacto(self):
+        return isinstance(self.geometrias, np.ndarray)
+
+    # Extensión (xmin, ymin, xmax, ymax) de toda la capa
+    @property
+    def extension(self):
+        return tuple(shapely.total_bounds(self.indice.geometries))
+
+    # Filas de la capa en las posiciones indicadas, como GeoDataFrame con su geometría
+    def filas(self, posiciones):
+        seleccion = self.gdf.iloc[posiciones]
+        if isinstance(seleccion, gpd.GeoDataFrame):
+            return seleccion
+        return gpd.GeoDataFrame(seleccion, geometry=list(self.geometrias_de(posiciones)), crs=self.crs)
+
+    # Filas de la capa en las posiciones indicadas solo con sus atributos (leída de texto
+    # llevan también la geometría). Es lo que necesitan las consultas, y en el formato
+    # binario no obliga a decodificar las geometrías ni a montar un GeoDataFrame.
+    def atributos(self, posiciones):
+        return self.gdf.iloc[posiciones]
+
+    # Geometrías de las posiciones indicadas, que pueden repetirse (un elemento cruzado
+    # con varias entradas): cada elemento se pide una sola vez y se reparte con el
+    # índice inverso
+    def geometrias_de(self, posiciones):
+        unicas, inversa = np.unique(posiciones, return_inverse=True)
+        return self.geometrias[unicas][inversa]
+
+    # Posiciones (en el orden original de la capa) de los polígonos que contienen el punto
+    def indices_punto(self, x, y):
+        if self.indice_exacto:
+            posiciones = self.indice.query(Point(x, y), predicate="within")
+        else:
+            candidatos = self.indice.query(Point(x, y))
+            posiciones = candidatos[shapely.contains_xy(self.geometrias[candidatos], x, y)]
+        return np.sort(posiciones)
+
+    # Posiciones de los elementos a menos de distancia metros de la geometría y su
+    # distancia, de la más cercana a la más lejana. El índice descarta por envolvente
+    # (la distancia a la envolvente nunca supera a la distancia al elemento) y la
+    # distancia exacta solo se calcula para los candidatos que quedan.
+    def cercanos(self, geometria, distancia):
+        candidatos = self.indice.query(geometria, predicate="dwithin", distance=distancia)
+        distancias = shapely.distance(self.geometrias[candidatos], geometria)
+        dentro = distancias <= distancia
+        orden = np.argsort(distancias[dentro], kind="stable")
+        return candidatos[dentro][orden], distancias[dentro][orden]
+
+    # Posición del elemento más cercano a la geometría y su distancia, o (None, None) si
+    # la capa está vacía. Con el índice de envolventes la caja más cercana no tiene por
+    # qué ser la del elemento más cercano, pero este tiene que estar, como mucho, a la
+    # distancia del elemento de esa caja.
+    def mas_cercano(self, geometria):
+        primero = self.indice.query_nearest(geometria, all_matches=False)
+        if len(primero) == 0:
+            return None, None
+        cota = float(shapely.distance(self.geometrias[int(primero[0])], geometria))
+        posiciones, distancias = self.cercanos(geometria, cota)
+        return int(posiciones[0]), float(distancias[0])
+
+    # Atributos de las filas de la capa que contienen el punto, equivalente a gdf[gdf.contains(punto)]
+    def consultar_punto(self, x, y):
+        return self.atributos(self.indices_punto(x, y))
+
+    # Pares (posición en geometrias, posición en la capa) que cumplen el predicado
+    # ("within" o "intersects") entre cada geometría de entrada y los elementos de la capa
+    def cruzar(self, geometrias, predicado):
+        if self.indice_exacto:
+            return self.indice.query(geometrias, predicate=predicado)
+        izquierda, posiciones = self.indice.query(geometrias)
+        validos = getattr(shapely, predicado)(geometrias[izquierda], self.geometrias_de(posiciones))
+        return izquierda[validos], posiciones[validos]
+
+    # Superposición con una geometría: el índice descarta por envolvente y la
+    # comprobación exacta se hace con la geometría preparada, de forma vectorizada.
+    # Devuelve las posiciones afectadas y la intersección con cada una.
+    def superponer(self, geometria):
+        candidatos = np.sort(self.indice.query(geometria))
+        if len(candidatos) == 0:
+            return candidatos, np.empty(0, dtype=object)
+
+        shapely.prepare(geometria)
+        geometrias = self.geometrias[candidatos]
+        # Los elementos que solo comparten borde no cuentan como afectados
+        afectados = shapely.intersects(geometria, geometrias) & ~shapely.touches(geometria, geometrias)
+        posiciones, geometrias = candidatos[afectados], geometrias[afectados]
+        intersecciones = shapely.intersection(geometrias, geometria)
+        # Ni los que solo se superponen en una astilla a lo largo del borde
+        validas = superposicion_significativa(intersecciones, geometria, geometrias)
+        return posiciones[validas], intersecciones[validas]
+
+    # Atributos de las filas de la capa afectadas por la geometría, con la superficie y longitud de la
+    # intersección y el porcentaje que supone sobre la geometría consultada
+    def consultar_geometria(self, geometria):
+        posiciones, intersecciones = self.superponer(geometria)
+        seleccion = self.atributos(posiciones).copy()
+        seleccion["superficie"], seleccion["longitud"], seleccion["porcentaje"] = \
+            medir_intersecciones(intersecciones, geometria)
+        return seleccion
+
+    # Geometrías de las posiciones indicadas simplificadas con la tolerancia dada (en
+    # metros). Cada elemento se simplifica una sola vez por tolerancia y se guarda, de
+    # modo que sirven de nivel de detalle para los mapas a distintos zooms.
+    def simplificadas(self, tolerancia, posiciones):
+        posiciones = np.asarray(posiciones, dtype=np.intp)
+        with self._bloqueo:
+            guardadas = self._simplificadas.setdefault(tolerancia, {})
+            pendientes = np.array([p for p in posiciones.tolist() if p not in guardadas], dtype=np.intp)
+            if len(pendientes):
+                nuevas = shapely.simplify(self.geometrias[pendientes], tolerancia, preserve_topology=True)
+                guardadas.update(zip(pendientes.tolist(), nuevas))
+            return np.array([guardadas[p] for p in posiciones.tolist()], dtype=object)
+
+
+# Intersecciones que cuentan como afección: si la consultada y el elemento son
+# superficies, las de al menos SUPERFICIE_MINIMA m²; si alguno es una línea, las de al
+# menos LONGITUD_MINIMA m; con un punto, todas. La misma regla sirve a las consultas
+# individuales y a las de lotes.
+def superposicion_significativa(intersecciones, consultadas, elementos):
+    dimension = np.minimum(shapely.get_dimensions(consultadas), shapely.get_dimensions(elementos))
+    return np.where(dimension == 2, shapely.area(intersecciones) >= config.SUPERFICIE_MINIMA,
+                    np.where(dimension == 1, shapely.length(intersecciones) >= config.LONGITUD_MINIMA, True))
+
+
+# Superficie, longitud (solo de las intersecciones lineales) y porcentaje sobre la
+# geometría consultada, que puede ser una sola o una por intersección
+def medir_intersecciones(intersecciones, consultadas):
+    superficie = shapely.area(intersecciones)
+    lineales = shapely.get_dimensions(intersecciones) == 1
+    longitud = np.where(lineales, shapely.length(intersecciones), 0.0)
+
+    # Porcentaje sobre el área de la geometría consultada o, si no tiene, sobre su longitud
+    area, largo = shapely.area(consultadas), shapely.length(consultadas)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        porcentaje = np.where(area > 0, 100 * superficie / area,
+                              np.where(largo > 0, 100 * longitud / largo, 100.0))
+    return superficie, longitud, porcentaje
+
+
+_capas = {}
+# Capas que no se han podido leer: origen -> (versión de los datos, excepción)
+_fallos = {}
+_bloqueos = {}
+_bloqueo_registro = threading.Lock()
+
+
+# Versión de los datos sin arrancar el hilo de comprobación (esto también se llama
+# en el proceso principal del servicio, antes del fork)
+def _version_datos():
+    from .versiones import obtener_versionado
+
+    return obtener_versionado(iniciar=False).version
+
+
+# Devuelve la capa asociada al fichero (ruta relativa en la fuente de datos),
+# leyéndola e indexándola la primera vez. Si no se ha podido leer, se repite el
+# mismo error sin volver a intentarlo hasta que cambie la versión de los datos.
+def obtener_capa(origen, nombre=None):
+    capa = _capas.get(origen)
+    if capa is not None:
+        return capa
+    fallo = _fallos.get(origen)
+    if fallo is not None and fallo[0] == _version_datos():
+        raise fallo[1].with_traceback(None)
+
+    # Un bloqueo por capa para que dos hilos no lean el mismo fichero a la vez
+    with _bloqueo_registro:
+        bloqueo = _bloqueos.setdefault(origen, threading.Lock())
+    with bloqueo:
+        capa = _capas.get(origen)
+        if capa is None:
+            try:
+                capa = _capas[origen] = leer_capa(origen, nombre)
+            except Exception as e:
+                _fallos[origen] = (_version_datos(), e)
+                raise
+            _fallos.pop(origen, None)
+    return capa
+
+
+# Lee e indexa la capa sin registrarla: del formato binario si está al día y, si no,
+# del fichero original
+def leer_capa(origen, nombre=None):
+    with metricas.etapa("carga_capa", capa=nombre or origen):
+        capa = _leer_binaria(origen, nombre)
+        if capa is None:
+            fichero = obtener_fuente().abrir(origen)
+            metricas.contar("afecciones_bytes_total", _tamano(fichero), origen="capas")
+            capa = Capa(nombre or origen, gpd.read_file(fichero))
+    return capa
+
+
+# Capa en formato binario si se ha generado en el directorio de datos y no es más
+# antigua que el fichero original
+def _leer_binaria(origen, nombre):
+    from .binario import leer_capa_binaria, ruta_binaria
+
+    binaria = config.DIRECTORIO_DATOS / ruta_binaria(origen)
+    original = config.DIRECTORIO_DATOS / origen
+    if not config.CAPAS_BINARIAS or not binaria.is_file():
+        return None
+    if original.is_file() and original.stat().st_mtime > binaria.stat().st_mtime:
+        return None
+    return leer_capa_binaria(binaria, nombre or origen)
+
+
+def _tamano(fichero):
+    return os.path.getsize(fichero) if isinstance(fichero, str) else len(fichero)
+
+
+# Elimina capas del registro (todas si no se indica ninguna) para forzar su recarga
+def descartar_capas(*origenes):
+    with _bloqueo_registro:
+        if not origenes:
+            _capas.clear()
+            _fallos.clear()
+        for origen in origenes:
+            _capas.pop(origen, None)
+            _fallos.pop(origen, None)
+
+
+# Capa registrada para el fichero, o None si aún no se ha cargado
+def capa_cargada(origen):
+    return _capas.get(origen)
+
+
+# Sustituye la capa registrada por otra ya construida. Las consultas en curso
+# terminan con la anterior, que siguen teniendo referenciada, y las siguientes usan la nueva.
+def sustituir_capa(origen, capa):
+    with _bloqueo_registro:
+        _capas[origen] = capa
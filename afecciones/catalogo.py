@@ -0,0 +1,169 @@
+# Catálogo de parcelas para el selector del modo "Por parcela": por cada municipio,
+# sus polígonos (MASA) y parcelas ordenados, con la envolvente y el centroide de
+# cada parcela, pero sin geometría. Se precalcula fuera de línea a partir de
+# CATASTRO/ en un .npz por municipio que se carga en milisegundos y solo cuando se
+# elige el municipio. La geometría de la parcela se lee después, únicamente la de
+# la parcela seleccionada.
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from .config import DIRECTORIO_CATALOGO, DIRECTORIO_DATOS
+from .fuentes import obtener_fuente
+
+
+# Paso de construcción fuera de línea: un índice de municipios y un .npz por municipio
+def construir_catalogo(directorio=DIRECTORIO_DATOS / "CATASTRO", salida=DIRECTORIO_CATALOGO):
+    directorio, salida = Path(directorio), Path(salida)
+    salida.mkdir(parents=True, exist_ok=True)
+
+    indice = {}
+    for shp in sorted(directorio.glob("*.shp")):
+        entrada = construir_municipio(shp, salida)
+        if entrada is not None:
+            indice[shp.stem] = entrada
+            print(f"{shp.stem}: {entrada['parcelas']} parcelas")
+
+    _escribir_indice(salida, indice)
+    return salida
+
+
+# .npz de un municipio a partir de su shapefile; devuelve su entrada del índice
+# (None si no tiene parcelas). Se escribe aparte y se sustituye de una vez.
+def construir_municipio(shp, salida=DIRECTORIO_CATALOGO):
+    shp, salida = Path(shp), Path(salida)
+    gdf = gpd.read_file(shp, columns=["MASA", "PARCELA"])
+    if gdf.empty:
+        return None
+    # Una parcela puede estar en varios recintos: se agrupa su geometría
+    gdf = gdf.dissolve(by=["MASA", "PARCELA"], as_index=False).sort_values(["MASA", "PARCELA"])
+    geometrias = gdf.geometry.to_numpy()
+    centroides = shapely.get_coordinates(shapely.centroid(geometrias))
+    temporal = salida / f".{shp.stem}.{os.getpid()}.tmp.npz"
+    np.savez(temporal,
+             masa=gdf["MASA"].to_numpy(dtype=str),
+             parcela=gdf["PARCELA"].to_numpy(dtype=str),
+             bbox=shapely.bounds(geometrias),
+             centroide=centroides)
+    os.replace(temporal, salida / f"{shp.stem}.npz")
+    return {"parcelas": len(gdf), "bbox": list(gdf.total_bounds)}
+
+
+def _escribir_indice(salida, indice):
+    temporal = salida / f".municipios.{os.getpid()}.tmp.json"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(indice, f, ensure_ascii=False)
+    os.replace(temporal, salida / "municipios.json")
+
+
+# Entrada del catálogo para un municipio; las listas se calculan al cargarlo
+class CatalogoMunicipio:
+    def __init__(self, nombre, datos):
+        self.nombre = nombre
+        self._masa = datos["masa"]
+        self._parcela = datos["parcela"]
+        self._bbox = datos["bbox"]
+        self._centroide = datos["centroide"]
+        # Las filas están ordenadas por (MASA, PARCELA): cada polígono es un tramo contiguo
+        self.masas, inicios = np.unique(self._masa, return_index=True)
+        self._tramos = dict(zip(self.masas.tolist(), zip(inicios, np.append(inicios[1:], len(self._masa)))))
+        self.masas = self.masas.tolist()
+
+    def parcelas(self, masa):
+        inicio, fin = self._tramos[masa]
+        return self._parcela[inicio:fin].tolist()
+
+    def _posicion(self, masa, parcela):
+        inicio, fin = self._tramos[masa]
+        posicion = inicio + int(np.searchsorted(self._parcela[inicio:fin], parcela))
+        if posicion >= fin or self._parcela[posicion] != parcela:
+            raise KeyError((masa, parcela))
+        return posicion
+
+    def bbox(self, masa, parcela):
+        return tuple(self._bbox[self._posicion(masa, parcela)].tolist())
+
+    def centroide(self, masa, parcela):
+        return tuple(self._centroide[self._posicion(masa, parcela)].tolist())
+
+
+class Catalogo:
+    def __init__(self, directorio=DIRECTORIO_CATALOGO):
+        self.directorio = Path(directorio)
+        with open(self.directorio / "municipios.json", encoding="utf-8") as f:
+            self.indice = json.load(f)
+        self._bloqueo = threading.Lock()
+        self._municipios = {}
+
+    @property
+    def municipios(self):
+        return sorted(self.indice)
+
+    def __contains__(self, municipio):
+        return municipio in self.indice
+
+    def __getitem__(self, municipio):
+        entrada = self._municipios.get(municipio)
+        if entrada is None:
+            if municipio not in self.indice:
+                raise KeyError(municipio)
+            with self._bloqueo:
+                entrada = self._municipios.get(municipio)
+                if entrada is None:
+                    with np.load(self.directorio / f"{municipio}.npz") as datos:
+                        entrada = CatalogoMunicipio(municipio, dict(datos))
+                    self._municipios[municipio] = entrada
+        return entrada
+
+    # Vuelve a leer el índice tras actualizar un municipio (en este u otro proceso) y
+    # descarta su entrada cargada sin tocar los demás
+    def recargar(self, municipio):
+        with open(self.directorio / "municipios.json", encoding="utf-8") as f:
+            indice = json.load(f)
+        with self._bloqueo:
+            self.indice = indice
+            self._municipios.pop(municipio, None)
+
+
+# Reconstruye en disco un municipio a partir de su shapefile (o lo quita del índice si
+# el shapefile ya no existe). Los catálogos cargados lo ven al llamar a recargar().
+def actualizar_catalogo(municipio, shp, salida=DIRECTORIO_CATALOGO):
+    shp, salida = Path(shp), Path(salida)
+    entrada = construir_municipio(shp, salida) if shp.is_file() else None
+    with open(salida / "municipios.json", encoding="utf-8") as f:
+        indice = json.load(f)
+    if entrada is None:
+        indice.pop(municipio, None)
+    else:
+        indice[municipio] = entrada
+    _escribir_indice(salida, indice)
+
+
+# Geometría de una sola parcela, leída del shapefile filtrando por su envolvente
+# para no cargar el municipio entero
+def leer_parcela_shapefile(catalogo, municipio, masa, parcela):
+    bbox = catalogo[municipio].bbox(masa, parcela)
+    gdf = gpd.read_file(obtener_fuente().ruta_shapefile(f"CATASTRO/{municipio}"), bbox=bbox)
+    return gdf[(gdf["MASA"] == masa) & (gdf["PARCELA"] == parcela)]
+
+
+_catalogo = None
+
+
+# Catálogo compartido por todo el proceso; None si aún no se ha construido
+def obtener_catalogo():
+    global _catalogo
+    if _catalogo is None and (DIRECTORIO_CATALOGO / "municipios.json").exists():
+        _catalogo = Catalogo(DIRECTORIO_CATALOGO)
+    return _catalogo
+
+
+if __name__ == "__main__":
+    # python -m afecciones.catalogo [directorio_shapefiles] [directorio_salida]
+    construir_catalogo(*sys.argv[1:3])
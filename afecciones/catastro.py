@@ -0,0 +1,209 @@
+# Almacén catastral: convierte los shapefiles de CATASTRO/ en un único GeoPackage
+# indexado por (MUNICIPIO, MASA, PARCELA) y permite consultar una parcela, o las
+# listas de polígonos y parcelas, sin cargar el municipio entero.
+import os
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+import geopandas as gpd
+import shapely
+
+from .config import DIRECTORIO_DATOS, RUTA_ALMACEN
+
+DIRECTORIO_CATASTRO = DIRECTORIO_DATOS / "CATASTRO"
+
+CAPA_PARCELAS = "parcelas"
+CAMPOS = ["MUNICIPIO", "MASA", "PARCELA", "REFCAT", "TM"]
+# Anchos (MASA, PARCELA) con que el catastro guarda las claves: rústica y urbana
+ANCHOS_CLAVE = [(3, 5), (4, 3)]
+
+
+# Paso de construcción fuera de línea: un GeoPackage con todas las parcelas
+def construir_almacen(directorio=DIRECTORIO_CATASTRO, salida=RUTA_ALMACEN):
+    directorio, salida = Path(directorio), Path(salida)
+    temporal = salida.with_suffix(".tmp.gpkg")
+    if temporal.exists():
+        temporal.unlink()
+
+    municipios = []
+    for shp in sorted(directorio.glob("*.shp")):
+        gdf = gpd.read_file(shp)
+        if gdf.empty:
+            continue
+        gdf = gdf[CAMPOS + [gdf.geometry.name]]
+        gdf.to_file(temporal, layer=CAPA_PARCELAS, driver="GPKG",
+                    mode="a" if municipios else "w")
+        municipios.append((shp.stem, int(gdf["MUNICIPIO"].iloc[0]), len(gdf)))
+        print(f"{shp.stem}: {len(gdf)} parcelas")
+
+    with sqlite3.connect(temporal) as con:
+        con.execute(f"CREATE INDEX idx_{CAPA_PARCELAS}_clave ON {CAPA_PARCELAS} (MUNICIPIO, MASA, PARCELA)")
+        con.execute("CREATE TABLE municipios (nombre TEXT PRIMARY KEY, codigo INTEGER NOT NULL, parcelas INTEGER)")
+        con.executemany("INSERT INTO municipios VALUES (?, ?, ?)", municipios)
+        con.execute("ANALYZE")
+
+    # Se sustituye de una vez para que nadie lea un almacén a medio construir
+    os.replace(temporal, salida)
+    return salida
+
+
+# Sustituye las parcelas de un municipio sin reconstruir el almacén entero (o las
+# quita si su shapefile ya no existe). Las nuevas se escriben con GDAL en un
+# GeoPackage aparte y se copian en una sola transacción: quien lee el almacén ve el
+# municipio anterior o el nuevo, nunca uno a medias.
+def actualizar_municipio(shp, ruta=RUTA_ALMACEN):
+    shp, ruta = Path(shp), Path(ruta)
+    gdf = gpd.read_file(shp) if shp.is_file() else None
+    temporal = ruta.with_name(f".{shp.stem}.{os.getpid()}.tmp.gpkg")
+    con = sqlite3.connect(ruta, timeout=30)
+    try:
+        _funciones_gpkg(con)
+        geometria = con.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?",
+                                (CAPA_PARCELAS,)).fetchone()[0]
+        if gdf is not None and not gdf.empty:
+            gdf = gdf[CAMPOS + [gdf.geometry.name]]
+            gdf.to_file(temporal, layer=CAPA_PARCELAS, driver="GPKG")
+            con.execute("ATTACH DATABASE ? AS nuevo", (str(temporal),))
+            geometria_nueva = con.execute("SELECT column_name FROM nuevo.gpkg_geometry_columns "
+                                          "WHERE table_name = ?", (CAPA_PARCELAS,)).fetchone()[0]
+        with con:
+            anterior = con.execute("SELECT codigo FROM municipios WHERE nombre = ?", (shp.stem,)).fetchone()
+            if anterior is not None:
+                con.execute(f"DELETE FROM {CAPA_PARCELAS} WHERE MUNICIPIO = ?", anterior)
+                con.execute("DELETE FROM municipios WHERE nombre = ?", (shp.stem,))
+            if gdf is not None and not gdf.empty:
+                campos = ", ".join(CAMPOS)
+                con.execute(f'INSERT INTO {CAPA_PARCELAS} ({campos}, "{geometria}") '
+                            f'SELECT {campos}, "{geometria_nueva}" FROM nuevo.{CAPA_PARCELAS}')
+                con.execute("INSERT INTO municipios VALUES (?, ?, ?)",
+                            (shp.stem, int(gdf["MUNICIPIO"].iloc[0]), len(gdf)))
+    finally:
+        con.close()
+        temporal.unlink(missing_ok=True)
+    return ruta
+
+
+# Funciones SQL que usan los disparadores del índice espacial del GeoPackage y que
+# normalmente aporta GDAL
+def _funciones_gpkg(con):
+    def caja(blob, i):
+        return float(shapely.bounds(_geometria_gpkg(blob))[i])
+
+    con.create_function("ST_IsEmpty", 1, lambda blob: int(_geometria_gpkg(blob).is_empty))
+    con.create_function("ST_MinX", 1, lambda blob: caja(blob, 0))
+    con.create_function("ST_MinY", 1, lambda blob: caja(blob, 1))
+    con.create_function("ST_MaxX", 1, lambda blob: caja(blob, 2))
+    con.create_function("ST_MaxY", 1, lambda blob: caja(blob, 3))
+
+
+# Geometría de un blob GeoPackage: cabecera 'GP' + envolvente opcional + WKB
+def _geometria_gpkg(blob):
+    flags = blob[3]
+    envolvente = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}[(flags >> 1) & 0b111]
+    return shapely.from_wkb(bytes(blob[8 + envolvente:]))
+
+
+# Acceso de solo lectura al almacén; una conexión sqlite por hilo
+class AlmacenCatastro:
+    def __init__(self, ruta=RUTA_ALMACEN):
+        self.ruta = Path(ruta)
+        if not self.ruta.exists():
+            raise FileNotFoundError(f"No existe el almacén catastral {self.ruta}; "
+                                    f"genéralo con 'python -m afecciones.catastro'")
+        self._local = threading.local()
+        self._codigos = dict(self._consulta("SELECT nombre, codigo FROM municipios"))
+        self.columna_geometria = self._consulta(
+            "SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?", (CAPA_PARCELAS,))[0][0]
+        self.crs = "EPSG:%d" % self._consulta(
+            "SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?", (CAPA_PARCELAS,))[0][0]
+
+    def _consulta(self, sql, parametros=()):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(f"file:{self.ruta}?mode=ro", uri=True, check_same_thread=False)
+            self._local.con = con
+        return con.execute(sql, parametros).fetchall()
+
+    # Vuelve a leer la lista de municipios tras actualizar alguno
+    def recargar_municipios(self):
+        self._codigos = dict(self._consulta("SELECT nombre, codigo FROM municipios"))
+
+    @property
+    def municipios(self):
+        return sorted(self._codigos)
+
+    def masas(self, municipio):
+        filas = self._consulta(f"SELECT DISTINCT MASA FROM {CAPA_PARCELAS} WHERE MUNICIPIO = ? ORDER BY MASA",
+                               (self._codigos[municipio],))
+        return [f[0] for f in filas]
+
+    def parcelas(self, municipio, masa):
+        filas = self._consulta(f"SELECT DISTINCT PARCELA FROM {CAPA_PARCELAS} "
+                               f"WHERE MUNICIPIO = ? AND MASA = ? ORDER BY PARCELA",
+                               (self._codigos[municipio], masa))
+        return [f[0] for f in filas]
+
+    # GeoDataFrame con la parcela indicada (puede tener varias filas si está partida)
+    def parcela(self, municipio, masa, parcela):
+        columnas = ", ".join(CAMPOS + [f'"{self.columna_geometria}"'])
+        filas = self._consulta(f"SELECT {columnas} FROM {CAPA_PARCELAS} "
+                               f"WHERE MUNICIPIO = ? AND MASA = ? AND PARCELA = ?",
+                               (self._codigos[municipio], masa, parcela))
+        registros = [dict(zip(CAMPOS, fila[:-1])) for fila in filas]
+        geometrias = [_geometria_gpkg(fila[-1]) for fila in filas]
+        return gpd.GeoDataFrame(registros, columns=CAMPOS, geometry=geometrias, crs=self.crs)
+
+
+    # Geometría (unión de sus recintos) de una parcela indicada como la escribiría un
+    # usuario: municipio con espacios, polígono y parcela con o sin ceros a la
+    # izquierda. Primero se busca el valor exacto; si no está y es numérico, se
+    # completa con ceros según los anchos del catastro: rústica (MASA de 3, PARCELA de
+    # 5) y después urbana (manzana de 4, parcela de 3). No se compara como entero
+    # porque "001"/"00002" y "0001"/"002" son parcelas distintas. None si no existe.
+    def geometria(self, municipio, masa, parcela):
+        municipio, masa, parcela = normalizar_clave(municipio, masa, parcela)
+        if municipio not in self._codigos:
+            return None
+        claves = [(masa, parcela)]
+        if masa.isdigit() and parcela.isdigit():
+            claves += [(masa.zfill(ancho_masa), parcela.zfill(ancho_parcela))
+                       for ancho_masa, ancho_parcela in ANCHOS_CLAVE]
+        for clave in dict.fromkeys(claves):
+            gdf = self.parcela(municipio, *clave)
+            if not gdf.empty:
+                return shapely.union_all(gdf.geometry.values)
+        return None
+
+
+def normalizar_clave(municipio, masa, parcela):
+    # Excel devuelve los números como float (5.0)
+    masa, parcela = (int(v) if isinstance(v, float) and v.is_integer() else v for v in (masa, parcela))
+    municipio = str(municipio).strip().upper().replace(" ", "_")
+    return municipio, str(masa).strip(), str(parcela).strip()
+
+
+_almacen = None
+
+
+# Las conexiones sqlite no deben cruzar un fork(): el hijo abre las suyas
+def _reiniciar_tras_fork():
+    if _almacen is not None:
+        _almacen._local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+# Almacén compartido por todo el proceso; None si aún no se ha construido
+def obtener_almacen():
+    global _almacen
+    if _almacen is None and RUTA_ALMACEN.exists():
+        _almacen = AlmacenCatastro(RUTA_ALMACEN)
+    return _almacen
+
+
+if __name__ == "__main__":
+    # python -m afecciones.catastro [directorio_shapefiles] [salida.gpkg]
+    construir_almacen(*sys.argv[1:3])
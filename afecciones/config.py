@@ -0,0 +1,67 @@
+# Configuración del núcleo de afecciones, tomada de variables de entorno
+import os
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parent.parent
+
+# Origen de los datos: "local", "http", "mmap" o "auto" (local y, si falta el fichero, HTTP)
+FUENTE_DATOS = os.environ.get("AFECCIONES_FUENTE", "auto")
+DIRECTORIO_DATOS = Path(os.environ.get("AFECCIONES_DATOS", RAIZ))
+URL_DATOS = os.environ.get("AFECCIONES_URL", "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/")
+
+# Almacén catastral (GeoPackage con todas las parcelas, catastro.py)
+RUTA_ALMACEN = Path(os.environ.get("AFECCIONES_CATASTRO", RAIZ / "catastro.gpkg"))
+# Catálogo de parcelas para el selector del modo "Por parcela" (catalogo.py)
+DIRECTORIO_CATALOGO = Path(os.environ.get("AFECCIONES_CATALOGO", RAIZ / "catalogo"))
+
+# Caché en disco de los ficheros descargados por HTTP y su caducidad en segundos (0 = no caduca)
+DIRECTORIO_CACHE = Path(os.environ.get("AFECCIONES_CACHE", RAIZ / ".cache" / "datos"))
+CADUCIDAD_CACHE = int(os.environ.get("AFECCIONES_CACHE_TTL", "0"))
+TIMEOUT_HTTP = float(os.environ.get("AFECCIONES_TIMEOUT_HTTP", "30"))
+
+# Caché persistente de resultados de consultas y mapas; tamaño máximo en bytes (0 = desactivada)
+RUTA_CACHE_RESULTADOS = Path(os.environ.get("AFECCIONES_CACHE_RESULTADOS", RAIZ / ".cache" / "resultados.sqlite"))
+TAMANO_CACHE_RESULTADOS = int(os.environ.get("AFECCIONES_CACHE_RESULTADOS_MAX", str(256 * 1024 * 1024)))
+# Segundos entre comprobaciones de cambios en los ficheros de datos, que hace un hilo en
+# segundo plano (versiones.py); 0 desactiva la actualización sin reinicio
+INTERVALO_VERSION_DATOS = float(os.environ.get("AFECCIONES_INTERVALO_VERSION", "5"))
+# Registro de la huella de los ficheros con que se han reconstruido por última vez los
+# derivados (formato binario, catálogo, almacén), compartido por todos los procesos
+RUTA_DERIVADOS = Path(os.environ.get("AFECCIONES_DERIVADOS", RAIZ / ".cache" / "derivados.json"))
+
+# Mapa estático del informe: plantilla de teselas remotas (vacía = sin red), directorio
+# local de teselas {z}/{x}/{y}.png, fichero MBTiles y caché en disco de teselas descargadas
+URL_TESELAS = os.environ.get("AFECCIONES_TESELAS_URL", "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png")
+DIRECTORIO_TESELAS = os.environ.get("AFECCIONES_TESELAS_DIR", "")
+RUTA_MBTILES = os.environ.get("AFECCIONES_MBTILES", "")
+DIRECTORIO_CACHE_TESELAS = Path(os.environ.get("AFECCIONES_CACHE_TESELAS", RAIZ / ".cache" / "teselas"))
+# Hilos que renderizan mapas a la vez y segundos máximos por mapa
+HILOS_MAPA = int(os.environ.get("AFECCIONES_HILOS_MAPA", "2"))
+TIMEOUT_MAPA = float(os.environ.get("AFECCIONES_TIMEOUT_MAPA", "20"))
+
+# Puerto local en el que la aplicación publica /metrics (0 = no se publica) y panel
+# de administración con las métricas en la barra lateral
+PUERTO_METRICAS = int(os.environ.get("AFECCIONES_PUERTO_METRICAS", "0"))
+PANEL_ADMIN = os.environ.get("AFECCIONES_ADMIN", "0") == "1"
+
+# Usar el formato binario de las capas (.arrow junto al GeoJSON) cuando exista y esté al día
+CAPAS_BINARIAS = os.environ.get("AFECCIONES_CAPAS_BINARIAS", "1") != "0"
+
+# Superposición mínima para dar un elemento por afectado: en m² cuando la geometría
+# consultada y el elemento son superficies y en m cuando alguno es una línea. Por
+# debajo son astillas de coma flotante a lo largo de los lindes compartidos.
+SUPERFICIE_MINIMA = float(os.environ.get("AFECCIONES_SUPERFICIE_MINIMA", "1"))
+LONGITUD_MINIMA = float(os.environ.get("AFECCIONES_LONGITUD_MINIMA", "1"))
+
+# Umbral (m) de las consultas de proximidad por capa, como "VP=100,ZEPA=250"; las capas
+# que no aparecen usan el de su definición en motor.py
+DISTANCIAS = {nombre.strip(): float(valor) for nombre, valor in
+              (par.split("=", 1) for par in os.environ.get("AFECCIONES_DISTANCIAS", "").split(",") if par.strip())}
+
+# Informe con la plantilla Word: fichero .docx, ejecutable de LibreOffice que lo pasa a PDF
+# (vacío = soffice o libreoffice del PATH), instancias de LibreOffice que convierten a la
+# vez y segundos máximos por conversión
+RUTA_PLANTILLA = Path(os.environ.get("AFECCIONES_PLANTILLA", RAIZ / "plantilla_informe_afecciones.docx"))
+EJECUTABLE_OFFICE = os.environ.get("AFECCIONES_SOFFICE", "")
+INSTANCIAS_OFFICE = int(os.environ.get("AFECCIONES_INSTANCIAS_OFFICE", "2"))
+TIMEOUT_CONVERSION = float(os.environ.get("AFECCIONES_TIMEOUT_CONVERSION", "60"))
@@ -0,0 +1,45 @@
+# Transformación de coordenadas entre sistemas de referencia. Construir el
+# Transformer (la tubería de PROJ) cuesta mucho más que transformar un punto,
+# así que se crea una vez por pareja de CRS y se reutiliza.
+import threading
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+ETRS89_UTM30 = "EPSG:25830"
+WGS84 = "EPSG:4326"
+
+# Un Transformer por hilo: los objetos de pyproj no deben compartirse entre hilos
+_local = threading.local()
+
+
+def obtener_transformer(origen=ETRS89_UTM30, destino=WGS84):
+    cache = getattr(_local, "transformers", None)
+    if cache is None:
+        cache = _local.transformers = {}
+    transformer = cache.get((origen, destino))
+    if transformer is None:
+        transformer = cache[(origen, destino)] = Transformer.from_crs(origen, destino, always_xy=True)
+    return transformer
+
+
+# Un punto; por defecto de ETRS89 / UTM 30 a WGS84 (lon, lat)
+def transformar(x, y, origen=ETRS89_UTM30, destino=WGS84):
+    return obtener_transformer(origen, destino).transform(x, y)
+
+
+# Arrays de coordenadas en una sola llamada a PROJ
+def transformar_array(xs, ys, origen=ETRS89_UTM30, destino=WGS84):
+    xs = np.asarray(xs, dtype="float64")
+    ys = np.asarray(ys, dtype="float64")
+    return obtener_transformer(origen, destino).transform(xs, ys)
+
+
+# Geometría (o array de geometrías) de shapely con todas sus coordenadas transformadas
+def transformar_geometria(geometria, origen=ETRS89_UTM30, destino=WGS84):
+    def transformar_coordenadas(coordenadas):
+        xs, ys = transformar_array(coordenadas[:, 0], coordenadas[:, 1], origen, destino)
+        return np.column_stack([xs, ys])
+
+    return shapely.transform(geometria, transformar_coordenadas)
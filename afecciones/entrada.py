@@ -0,0 +1,137 @@
+# Geometrías de entrada dibujadas fuera de la aplicación: WKT, GeoJSON o KML,
+# pegados como texto o subidos en un fichero. Se devuelven como una lista de
+# (nombre, geometría) en ETRS89 / UTM 30, el sistema de las capas de afección.
+import json
+import xml.etree.ElementTree as ET
+
+import shapely
+from pyproj import CRS
+from shapely.geometry import LineString, Point, Polygon, shape
+
+from .crs import ETRS89_UTM30, WGS84, transformar_geometria
+
+FORMATOS = ("wkt", "geojson", "kml")
+
+# Extensiones de fichero aceptadas para cada formato
+EXTENSIONES = {".wkt": "wkt", ".txt": "wkt", ".geojson": "geojson", ".json": "geojson", ".kml": "kml"}
+
+# Propiedades que se usan como nombre de cada elemento, por este orden
+CAMPOS_NOMBRE = ("nombre", "name", "NOMBRE", "Name", "id", "ID")
+
+
+def detectar_formato(texto):
+    texto = texto.lstrip()
+    if texto.startswith("{"):
+        return "geojson"
+    if texto.startswith("<"):
+        return "kml"
+    return "wkt"
+
+
+# Lista de (nombre, geometría) en ETRS89 / UTM 30. crs es el sistema de las coordenadas
+# de entrada; si no se indica, se toma el del GeoJSON o, según el rango de las
+# coordenadas, WGS84 (grados) o ETRS89 / UTM 30 (metros). El KML siempre es WGS84.
+def leer_geometrias(contenido, formato=None, crs=None):
+    if isinstance(contenido, (bytes, bytearray)):
+        contenido = contenido.decode("utf-8-sig")
+    formato = formato or detectar_formato(contenido)
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato desconocido: {formato} (opciones: {', '.join(FORMATOS)})")
+
+    try:
+        if formato == "wkt":
+            elementos = _leer_wkt(contenido)
+        elif formato == "geojson":
+            elementos, crs_geojson = _leer_geojson(contenido)
+            crs = crs or crs_geojson
+        else:
+            elementos, crs = _leer_kml(contenido), WGS84
+    except (ValueError, KeyError, TypeError, AttributeError, ET.ParseError, shapely.errors.GEOSException) as e:
+        raise ValueError(f"No se pudo leer la geometría ({formato}): {e}") from None
+
+    elementos = [(nombre, g) for nombre, g in elementos if g is not None and not g.is_empty]
+    if not elementos:
+        raise ValueError("La entrada no contiene ninguna geometría")
+
+    crs = crs or _crs_probable([g for _, g in elementos])
+    if CRS.from_user_input(crs) != CRS.from_user_input(ETRS89_UTM30):
+        elementos = [(nombre, transformar_geometria(g, crs, ETRS89_UTM30)) for nombre, g in elementos]
+    return [(nombre, shapely.make_valid(g) if not g.is_valid else g) for nombre, g in elementos]
+
+
+# WGS84 si todas las coordenadas caben en grados, ETRS89 / UTM 30 en otro caso
+def _crs_probable(geometrias):
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geometrias)
+    if -180 <= xmin and xmax <= 180 and -90 <= ymin and ymax <= 90:
+        return WGS84
+    return ETRS89_UTM30
+
+
+# Una geometría por línea, o una sola en todo el texto; las colecciones se separan
+def _leer_wkt(texto):
+    lineas = [l.strip() for l in texto.strip().splitlines() if l.strip()]
+    try:
+        geometrias = [shapely.from_wkt(" ".join(lineas))]
+    except shapely.errors.GEOSException:
+        geometrias = [shapely.from_wkt(l) for l in lineas]
+    partes = []
+    for geometria in geometrias:
+        if geometria.geom_type == "GeometryCollection":
+            partes.extend(shapely.get_parts(geometria))
+        else:
+            partes.append(geometria)
+    return [(f"Geometría {i}", g) for i, g in enumerate(partes, 1)]
+
+
+def _leer_geojson(texto):
+    datos = json.loads(texto)
+    crs = datos.get("crs", {}).get("properties", {}).get("name")
+    if datos.get("type") == "FeatureCollection":
+        entidades = datos["features"]
+    elif datos.get("type") == "Feature":
+        entidades = [datos]
+    else:
+        entidades = [{"type": "Feature", "properties": {}, "geometry": datos}]
+
+    elementos = []
+    for i, entidad in enumerate(entidades, 1):
+        if not entidad.get("geometry"):
+            continue
+        propiedades = entidad.get("properties") or {}
+        nombre = next((str(propiedades[c]) for c in CAMPOS_NOMBRE if propiedades.get(c) not in (None, "")),
+                      f"Elemento {i}")
+        elementos.append((nombre, shape(entidad["geometry"])))
+    return elementos, crs
+
+
+def _etiqueta(elemento):
+    return elemento.tag.rsplit("}", 1)[-1]
+
+
+def _hijos(elemento, etiqueta):
+    return [e for e in elemento.iter() if _etiqueta(e) == etiqueta]
+
+
+def _coordenadas(elemento):
+    texto = next((e.text for e in elemento.iter() if _etiqueta(e) == "coordinates"), "") or ""
+    return [tuple(float(v) for v in tupla.split(",")[:2]) for tupla in texto.split()]
+
+
+# Geometrías de los Placemark de un KML (Point, LineString, Polygon y MultiGeometry)
+def _leer_kml(texto):
+    raiz = ET.fromstring(texto.encode("utf-8"))
+    elementos = []
+    for i, marca in enumerate(_hijos(raiz, "Placemark"), 1):
+        nombre = next((e.text for e in marca if _etiqueta(e) == "name" and e.text), f"Elemento {i}")
+        partes = []
+        for punto in _hijos(marca, "Point"):
+            partes.append(Point(_coordenadas(punto)[0]))
+        for linea in _hijos(marca, "LineString"):
+            partes.append(LineString(_coordenadas(linea)))
+        for poligono in _hijos(marca, "Polygon"):
+            exterior = _coordenadas(_hijos(poligono, "outerBoundaryIs")[0])
+            interiores = [_coordenadas(e) for e in _hijos(poligono, "innerBoundaryIs")]
+            partes.append(Polygon(exterior, interiores))
+        if partes:
+            elementos.append((nombre, partes[0] if len(partes) == 1 else shapely.GeometryCollection(partes)))
+    return elementos
@@ -0,0 +1,173 @@
+# Fuentes de datos: el resto del código pide los ficheros por su ruta relativa
+# ("GeoJSON/ENP.json", "CATASTRO/OJOS.shp", "logos.jpg") y la fuente configurada
+# decide si se leen del disco, de GitHub con caché local o mapeados en memoria.
+import mmap
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from . import config, metricas
+
+EXTENSIONES_SHAPEFILE = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+# Ficheros del directorio de datos (por defecto, la propia copia del repositorio)
+class FuenteLocal:
+    def __init__(self, directorio=config.DIRECTORIO_DATOS):
+        self.directorio = Path(directorio)
+
+    def existe(self, nombre):
+        return (self.directorio / nombre).is_file()
+
+    # Ruta en disco del fichero, para las librerías que solo leen de ficheros (GDAL, FPDF)
+    def ruta(self, nombre):
+        ruta = self.directorio / nombre
+        if not ruta.is_file():
+            raise FileNotFoundError(f"No se encuentra {nombre} en {self.directorio}")
+        return ruta
+
+    def leer(self, nombre):
+        return self.ruta(nombre).read_bytes()
+
+    # Lo que se pasa a gpd.read_file
+    def abrir(self, nombre):
+        return str(self.ruta(nombre))
+
+    # Ruta del .shp; sus ficheros auxiliares están en el mismo directorio
+    def ruta_shapefile(self, nombre_base):
+        return self.ruta(nombre_base + ".shp")
+
+
+# Ficheros del repositorio remoto, descargados una vez y guardados en una caché en disco
+class FuenteHTTP:
+    def __init__(self, url=config.URL_DATOS, cache=config.DIRECTORIO_CACHE,
+                 caducidad=config.CADUCIDAD_CACHE, timeout=config.TIMEOUT_HTTP):
+        self.url = url.rstrip("/") + "/"
+        self.cache = Path(cache)
+        self.caducidad = caducidad
+        self.timeout = timeout
+        self._sesion = requests.Session()
+        self._bloqueo = threading.Lock()
+
+    def existe(self, nombre):
+        return True
+
+    def _vigente(self, ruta):
+        if not ruta.is_file():
+            return False
+        return not self.caducidad or time.time() - ruta.stat().st_mtime < self.caducidad
+
+    def ruta(self, nombre):
+        ruta = self.cache / nombre
+        if self._vigente(ruta):
+            metricas.cache("datos_http", True)
+            return ruta
+        with self._bloqueo:
+            if not self._vigente(ruta):
+                metricas.cache("datos_http", False)
+                with metricas.etapa("descarga_datos"):
+                    respuesta = self._sesion.get(self.url + nombre, timeout=self.timeout)
+                respuesta.raise_for_status()
+                metricas.contar("afecciones_bytes_total", len(respuesta.content), origen="http")
+                ruta.parent.mkdir(parents=True, exist_ok=True)
+                # Escritura atómica: otro proceso nunca ve un fichero a medias
+                temporal = ruta.with_name(f".{ruta.name}.{os.getpid()}.tmp")
+                temporal.write_bytes(respuesta.content)
+                os.replace(temporal, ruta)
+        return ruta
+
+    def leer(self, nombre):
+        return self.ruta(nombre).read_bytes()
+
+    def abrir(self, nombre):
+        return str(self.ruta(nombre))
+
+    # Se descargan todos los ficheros del shapefile al mismo directorio de la caché
+    def ruta_shapefile(self, nombre_base):
+        rutas = [self.ruta(nombre_base + ext) for ext in EXTENSIONES_SHAPEFILE]
+        return rutas[0]
+
+
+# Ficheros locales mapeados en memoria: los procesos que leen el mismo fichero
+# comparten sus páginas en lugar de tener cada uno su copia
+class FuenteMmap(FuenteLocal):
+    def __init__(self, directorio=config.DIRECTORIO_DATOS):
+        super().__init__(directorio)
+        self._mapas = {}
+        self._bloqueo = threading.Lock()
+
+    def _mapear(self, nombre):
+        with open(self.ruta(nombre), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def leer(self, nombre):
+        mapa = self._mapas.get(nombre)
+        if mapa is None:
+            with self._bloqueo:
+                mapa = self._mapas.get(nombre)
+                if mapa is None:
+                    mapa = self._mapas[nombre] = self._mapear(nombre)
+        return memoryview(mapa)
+
+    # Un mapa nuevo por lectura, porque GDAL lo consume como un fichero con su propia posición;
+    # los shapefiles se abren por ruta para que GDAL encuentre sus ficheros auxiliares
+    def abrir(self, nombre):
+        if nombre.lower().endswith(".shp"):
+            return str(self.ruta(nombre))
+        return self._mapear(nombre)
+
+
+# Local primero y, para lo que no esté en la copia local, HTTP con caché
+class FuenteAuto:
+    def __init__(self, local=None, remota=None):
+        self.local = local or FuenteLocal()
+        self.remota = remota or FuenteHTTP()
+
+    def _fuente(self, nombre):
+        return self.local if self.local.existe(nombre) else self.remota
+
+    def existe(self, nombre):
+        return self._fuente(nombre).existe(nombre)
+
+    def ruta(self, nombre):
+        return self._fuente(nombre).ruta(nombre)
+
+    def leer(self, nombre):
+        return self._fuente(nombre).leer(nombre)
+
+    def abrir(self, nombre):
+        return self._fuente(nombre).abrir(nombre)
+
+    def ruta_shapefile(self, nombre_base):
+        return self._fuente(nombre_base + ".shp").ruta_shapefile(nombre_base)
+
+
+FUENTES = {
+    "local": FuenteLocal,
+    "http": FuenteHTTP,
+    "mmap": FuenteMmap,
+    "auto": FuenteAuto,
+}
+
+_fuente = None
+
+
+# Fuente de datos del proceso, según AFECCIONES_FUENTE
+def obtener_fuente():
+    global _fuente
+    if _fuente is None:
+        try:
+            _fuente = FUENTES[config.FUENTE_DATOS]()
+        except KeyError:
+            raise ValueError(f"Fuente de datos desconocida: {config.FUENTE_DATOS!r} "
+                             f"(opciones: {', '.join(FUENTES)})") from None
+    return _fuente
+
+
+# Sustituye la fuente del proceso (por ejemplo, para apuntar a otro directorio)
+def establecer_fuente(fuente):
+    global _fuente
+    _fuente = fuente
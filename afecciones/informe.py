@@ -0,0 +1,304 @@
+# Informe PDF de afecciones a partir de los datos de la solicitud y del
+# resultado estructurado de la consulta
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
+
+from fpdf import FPDF
+from PIL import Image
+from shapely.geometry import Point
+
+from . import metricas
+from .cache import clave, obtener_cache
+from .fuentes import obtener_fuente
+from .mapa_estatico import renderizar_mapa_completo
+
+
+# Orden en el que aparecen las afecciones en el informe
+ORDEN_AFECCIONES = ("MUP", "VP", "ENP", "ZEPA", "LIC", "TM")
+
+
+# Datos del informe a partir del resultado de la consulta y de los datos del solicitante
+def componer_datos(resultado, fecha_solicitud="", nombre="", apellidos="", dni="", direccion="",
+                   telefono="", email="", objeto="", municipio="N/A", poligono="N/A", parcela="N/A"):
+    capas = sorted((r.capa for r in resultado),
+                   key=lambda c: ORDEN_AFECCIONES.index(c) if c in ORDEN_AFECCIONES else len(ORDEN_AFECCIONES))
+    datos = {
+        "fecha_solicitud": fecha_solicitud,
+        "fecha_informe": datetime.today().strftime('%d/%m/%Y'),
+        "nombre": nombre,
+        "apellidos": apellidos,
+        "dni": dni,
+        "dirección": direccion,
+        "teléfono": telefono,
+        "email": email,
+        "objeto de la solicitud": objeto,
+        **{f"afección {capa}": resultado[capa].texto for capa in capas},
+        "coordenadas_x": resultado.x,
+        "coordenadas_y": resultado.y,
+        "municipio": municipio,
+        "polígono": poligono,
+        "parcela": parcela,
+        "version_datos": resultado.version or "",
+        "resultado_afecciones": resultado
+    }
+    return datos
+
+
+# Imagen estática del mapa de localización, como buffer JPEG en memoria. Con geometria
+# y resultado se dibujan el contorno de la parcela y las capas afectadas.
+def generar_imagen_estatica_mapa(x, y, zoom=16, size=(800, 600), geometria=None, resultado=None):
+    return BytesIO(_renderizar_mapa_cache(x, y, zoom, size, geometria, resultado))
+
+
+# JPEG del mapa, reutilizando el de una consulta anterior en el mismo punto si lo hay.
+# Un mapa con teselas en blanco no se guarda, para no seguir sirviéndolo cuando
+# vuelva la red.
+def _renderizar_mapa_cache(x, y, zoom, size, geometria, resultado):
+    def renderizar():
+        return renderizar_mapa_completo(x, y, zoom, size, geometria=geometria, resultado=resultado)
+
+    cache = obtener_cache()
+    if cache is None:
+        return renderizar()[0]
+    afectadas = tuple(r.capa for r in resultado if r.afectado) if resultado is not None else ()
+    consultada = geometria if geometria is not None else Point(x, y)
+    contenido, _ = cache.memoizar(clave("mapa", consultada, round(x, 2), round(y, 2), zoom, size, afectadas),
+                                  renderizar, guardable=lambda valor: valor[1])
+    return contenido
+
+
+# Datos de imagen en el formato interno de FPDF para un JPEG en memoria (lo mismo
+# que obtiene FPDF._parsejpg de un fichero), para no pasar por el disco
+def _info_jpeg(contenido):
+    with Image.open(BytesIO(contenido)) as imagen:
+        ancho, alto = imagen.size
+        espacio = {"L": "DeviceGray", "CMYK": "DeviceCMYK"}.get(imagen.mode, "DeviceRGB")
+    return {"w": ancho, "h": alto, "cs": espacio, "bpc": 8, "f": "DCTDecode", "data": contenido}
+
+
+# Logo del informe, leído y analizado una sola vez por proceso
+@lru_cache(maxsize=1)
+def _info_logo():
+    try:
+        return _info_jpeg(bytes(obtener_fuente().leer("logos.jpg")))
+    except Exception:
+        return None
+
+
+class InformePDF(FPDF):
+    # Inserta una imagen ya analizada (ver _info_jpeg) bajo un nombre interno
+    def imagen_memoria(self, nombre, info, x=None, y=None, w=0, h=0):
+        if nombre not in self.images:
+            self.images[nombre] = dict(info, i=len(self.images) + 1)
+        self.image(nombre, x=x, y=y, w=w, h=h, type="jpg")
+
+
+# Función para generar el PDF con los datos de la solicitud
+
+# Devuelve el PDF como BytesIO o, si se indica filename, lo escribe en ese fichero
+def generar_pdf(datos, x, y, filename=None):
+    with metricas.etapa("informe_pdf"):
+        return _generar_pdf(datos, x, y, filename)
+
+
+def _generar_pdf(datos, x, y, filename=None):
+    pdf = InformePDF()
+    pdf.add_page()
+
+    # Insertar el logo
+    logo = _info_logo()
+    if logo:
+        page_width = pdf.w - 2 * pdf.l_margin
+        logo_width = page_width
+        pdf.imagen_memoria("logo", logo, x=pdf.l_margin, y=10, w=logo_width)
+
+        logo_height = logo_width * 0.2
+        pdf.set_y(10 + logo_height + 5)
+
+    # Título principal
+    pdf.set_font("Arial", "B", size=16)
+    pdf.set_text_color(0, 0, 0)
+    pdf.cell(0, 10, "Informe de Afecciones Ambientales", ln=True, align="C")
+    pdf.ln(10)
+
+    azul_rgb = (141, 179, 226)
+
+    # Lista de campos que deben aparecer en orden y en negrita
+    campos_orden = [
+        "Fecha solicitud", "Fecha informe", "Nombre", "Apellidos", "Dni", "Dirección",
+        "Teléfono", "Email", "Objeto de la solicitud"
+    ]
+
+    # Campos de localización
+    campos_localizacion = ["Municipio", "Polígono", "Parcela"]
+    
+    def seccion_titulo(texto):
+        pdf.set_fill_color(*azul_rgb)
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font("Arial", "B", 13)
+        pdf.cell(0, 10, texto, ln=True, fill=True)
+        pdf.ln(2)
+
+    def campo_orden(titulo, valor):
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(50, 8, f"{titulo}:", ln=0)
+        pdf.set_font("Arial", "", 12)
+        pdf.multi_cell(0, 8, valor if valor else "No especificado")
+ 
+    # 1. Datos del solicitante
+    seccion_titulo("1. Datos del solicitante")
+    campos_orden = [
+        ("Fecha solicitud", datos.get("fecha_solicitud", "").strip()),
+        ("Fecha informe", datos.get("fecha_informe", "").strip()),
+        ("Nombre", datos.get("nombre", "").strip()),
+        ("Apellidos", datos.get("apellidos", "").strip()),
+        ("DNI", datos.get("dni", "").strip()),
+        ("Dirección", datos.get("dirección", "").strip()),
+        ("Teléfono", datos.get("teléfono", "").strip()),
+        ("Email", datos.get("email", "").strip()),
+    ]
+    for titulo, valor in campos_orden:
+        campo_orden(titulo, valor)
+
+    # Objeto de la solicitud
+    objeto = datos.get("objeto de la solicitud", "").strip()
+    pdf.ln(2)
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 8, "Objeto de la solicitud:", ln=True)
+    pdf.set_font("Arial", "", 12)
+    pdf.multi_cell(0, 8, objeto if objeto else "No especificado")
+
+    # 2. Afecciones detectadas
+    seccion_titulo("2. Afecciones detectadas")
+    afecciones_keys = [k for k in datos if k.lower().startswith("afección")]
+    resultado_mup = datos["resultado_afecciones"].get("MUP") if "resultado_afecciones" in datos else None
+
+    if afecciones_keys:
+        for key in afecciones_keys:
+            valor = datos[key].strip()
+            pdf.set_font("Arial", "B", 12)
+            pdf.cell(0, 8, f"{key.capitalize()}:", ln=True)
+            pdf.set_font("Arial", "", 12)
+
+            if key.lower() == "afección mup" and resultado_mup is not None and resultado_mup.afectado:
+                pdf.multi_cell(0, 8, "Dentro de MUP:")
+
+                # Cabecera tabla
+                pdf.set_fill_color(200, 200, 200)
+                pdf.set_font("Arial", "B", 11)
+                pdf.cell(30, 8, "ID", border=1, fill=True)
+                pdf.cell(80, 8, "Nombre", border=1, fill=True)
+                pdf.cell(40, 8, "Municipio", border=1, fill=True)
+                pdf.cell(40, 8, "Propiedad", border=1, ln=True, fill=True)
+
+                # Una fila por cada monte afectado, con los atributos estructurados del resultado
+                pdf.set_font("Arial", "", 11)
+                for monte in resultado_mup.elementos:
+                    pdf.cell(30, 8, str(monte.get("ID_MONTE", "")), border=1)
+                    pdf.cell(80, 8, str(monte.get("NOMBREMONT", "")), border=1)
+                    pdf.cell(40, 8, str(monte.get("MUNICIPIO", "")), border=1)
+                    pdf.cell(40, 8, str(monte.get("PROPIEDAD", "")), border=1, ln=True)
+            else:
+                pdf.multi_cell(0, 8, valor)
+    else:
+        pdf.set_font("Arial", "", 12)
+        pdf.cell(0, 8, "No se han detectado afecciones.", ln=True)
+
+    # Superficie afectada de cada elemento (solo en las consultas por parcela)
+    resultado = datos.get("resultado_afecciones")
+    if resultado is not None and resultado.geometria is not None:
+        elementos = [(r, e) for r in resultado if r.capa != "TM" for e in r.elementos]
+        if elementos:
+            pdf.ln(2)
+            pdf.set_font("Arial", "B", 12)
+            pdf.cell(0, 8, "Superficie afectada por elemento:", ln=True)
+
+            pdf.set_fill_color(200, 200, 200)
+            pdf.set_font("Arial", "B", 11)
+            pdf.cell(25, 8, "Capa", border=1, fill=True)
+            pdf.cell(95, 8, "Elemento", border=1, fill=True)
+            pdf.cell(40, 8, "Afección", border=1, fill=True)
+            pdf.cell(30, 8, "% parcela", border=1, ln=True, fill=True)
+
+            pdf.set_font("Arial", "", 10)
+            for r, e in elementos:
+                pdf.cell(25, 8, r.capa, border=1)
+                pdf.cell(95, 8, str(e.get(r.campo_nombre, ""))[:55], border=1)
+                pdf.cell(40, 8, e.cantidad, border=1)
+                pdf.cell(30, 8, f"{e.porcentaje:.2f} %", border=1, ln=True)
+
+    # Proximidad: umbral de cada capa y distancia a los elementos cercanos
+    proximidad = [r for r in resultado if r.distancia_umbral is not None and not r.error] \
+        if resultado is not None else []
+    if proximidad:
+        pdf.ln(2)
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(0, 8, "Proximidad a las capas de afección:", ln=True)
+
+        pdf.set_fill_color(200, 200, 200)
+        pdf.set_font("Arial", "B", 11)
+        pdf.cell(25, 8, "Capa", border=1, fill=True)
+        pdf.cell(25, 8, "Umbral", border=1, fill=True)
+        pdf.cell(95, 8, "Elemento", border=1, fill=True)
+        pdf.cell(45, 8, "Distancia", border=1, ln=True, fill=True)
+
+        pdf.set_font("Arial", "", 10)
+        for r in proximidad:
+            filas = [(e.get(r.campo_nombre, ""), "Dentro") for e in r.elementos]
+            filas += [(e.get(r.campo_nombre, ""), f"{e.distancia:.2f} m") for e in r.cercanos]
+            if not filas and r.mas_cercano is not None:
+                filas = [(r.mas_cercano.get(r.campo_nombre, ""), f"{r.mas_cercano.distancia:.2f} m (fuera)")]
+            for nombre, distancia in filas or [("Sin elementos en la capa", "")]:
+                pdf.cell(25, 8, r.capa, border=1)
+                pdf.cell(25, 8, f"{r.distancia_umbral:g} m", border=1)
+                pdf.cell(95, 8, str(nombre)[:55], border=1)
+                pdf.cell(45, 8, distancia, border=1, ln=True)
+
+    # Afecciones adicionales que no se han mostrado
+    for key in ["afección vp", "afección enp", "afección zepa", "afección lic", "afección tm"]:
+        valor = datos.get(key, "").strip()
+        if valor:
+            pdf.set_font("Arial", "B", 12)
+            pdf.cell(0, 8, f"{key.capitalize()}:", ln=True)
+            pdf.set_font("Arial", "", 12)
+            pdf.multi_cell(0, 8, valor)
+
+    # 3. Localización
+    seccion_titulo("3. Localización")
+    for campo in ["municipio", "polígono", "parcela"]:
+        valor = datos.get(campo, "").strip()
+        campo_orden(campo.capitalize(), valor if valor else "No disponible")
+
+    # Coordenadas
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 10, f"Coordenadas ETRS89: X = {x}, Y = {y}", ln=True)
+    # Versión de los datos con los que se ha hecho la consulta, para poder reproducirla
+    if datos.get("version_datos"):
+        pdf.set_font("Arial", "", 10)
+        pdf.cell(0, 6, f"Versión de los datos: {datos['version_datos']}", ln=True)
+
+    # Insertar imagen del mapa si se ha podido generar
+    try:
+        resultado = datos.get("resultado_afecciones")
+        geometria = resultado.geometria if resultado is not None else None
+        imagen_mapa = generar_imagen_estatica_mapa(x, y, geometria=geometria, resultado=resultado)
+    except Exception:
+        imagen_mapa = None
+
+    if imagen_mapa is not None:
+        epw = pdf.w - 2 * pdf.l_margin  # Calcular el ancho útil de la página
+
+        pdf.ln(5)
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(0, 8, "Mapa de localización:", ln=True)
+        pdf.imagen_memoria("mapa", _info_jpeg(imagen_mapa.getvalue()), x=pdf.l_margin, w=epw)
+
+    # FPDF guarda el documento como texto latin-1
+    contenido = pdf.output(dest="S").encode("latin1")
+    metricas.contar("afecciones_bytes_total", len(contenido), origen="pdf")
+    if filename is None:
+        return BytesIO(contenido)
+    with open(filename, "wb") as f:
+        f.write(contenido)
+    return filename
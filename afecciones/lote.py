@@ -0,0 +1,241 @@
+# Modo por lotes: lee un CSV o Excel con coordenadas (X, Y) o parcelas
+# (municipio, polígono, parcela), evalúa las afecciones por bloques con uniones
+# espaciales y va escribiendo la tabla de resultados en disco, de modo que la
+# memoria no crece con el tamaño de la entrada. Opcionalmente genera un informe por
+# fila: el PDF de FPDF o, con la plantilla Word, DOCX o PDF.
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+from shapely.geometry import Point
+
+from .catastro import obtener_almacen
+from .crs import transformar_array
+from . import config
+from .informe import componer_datos, generar_pdf
+from .motor import CAPAS_AFECCION, consultar_afecciones_lote
+from .plantilla import generar_informe
+
+TAMANO_BLOQUE = 500
+
+# Nombres de columna aceptados en la entrada (se comparan en minúsculas y sin tildes)
+COLUMNAS_X = ("x", "coordenada_x", "coord_x", "utm_x")
+COLUMNAS_Y = ("y", "coordenada_y", "coord_y", "utm_y")
+COLUMNAS_MUNICIPIO = ("municipio",)
+COLUMNAS_POLIGONO = ("poligono", "masa")
+COLUMNAS_PARCELA = ("parcela",)
+
+
+def _normalizar(nombre):
+    nombre = str(nombre).strip().lower()
+    for con, sin in zip("áéíóú", "aeiou"):
+        nombre = nombre.replace(con, sin)
+    return nombre.replace(" ", "_")
+
+
+def _columna(columnas, candidatas):
+    for columna in columnas:
+        if _normalizar(columna) in candidatas:
+            return columna
+    return None
+
+
+# Bloques de filas de la entrada sin cargarla entera
+def leer_entrada(ruta, tamano_bloque=TAMANO_BLOQUE):
+    ruta = Path(ruta)
+    if ruta.suffix.lower() in (".xlsx", ".xlsm"):
+        yield from _leer_excel(ruta, tamano_bloque)
+    else:
+        yield from pd.read_csv(ruta, sep=None, engine="python", chunksize=tamano_bloque, dtype=str)
+
+
+def _leer_excel(ruta, tamano_bloque):
+    from openpyxl import load_workbook
+
+    libro = load_workbook(ruta, read_only=True, data_only=True)
+    try:
+        filas = libro.active.iter_rows(values_only=True)
+        cabecera = [str(c) for c in next(filas)]
+        bloque = []
+        for fila in filas:
+            bloque.append(fila)
+            if len(bloque) == tamano_bloque:
+                yield pd.DataFrame(bloque, columns=cabecera)
+                bloque = []
+        if bloque:
+            yield pd.DataFrame(bloque, columns=cabecera)
+    finally:
+        libro.close()
+
+
+# Geometría de cada fila del bloque (punto o parcela) y, si no se puede obtener, el motivo
+def geometrias_bloque(bloque):
+    col_x, col_y = _columna(bloque.columns, COLUMNAS_X), _columna(bloque.columns, COLUMNAS_Y)
+    col_mun = _columna(bloque.columns, COLUMNAS_MUNICIPIO)
+    col_pol = _columna(bloque.columns, COLUMNAS_POLIGONO)
+    col_par = _columna(bloque.columns, COLUMNAS_PARCELA)
+
+    if col_x and col_y:
+        xs = pd.to_numeric(bloque[col_x].astype(str).str.replace(",", "."), errors="coerce")
+        ys = pd.to_numeric(bloque[col_y].astype(str).str.replace(",", "."), errors="coerce")
+        return [(Point(x, y), None) if pd.notna(x) and pd.notna(y) else (None, "Coordenadas no válidas")
+                for x, y in zip(xs, ys)]
+
+    if col_mun and col_pol and col_par:
+        almacen = obtener_almacen()
+        if almacen is None:
+            raise RuntimeError("El modo por parcelas necesita el almacén catastral "
+                               "(python -m afecciones.catastro)")
+        geometrias = []
+        for municipio, masa, parcela in zip(bloque[col_mun], bloque[col_pol], bloque[col_par]):
+            geometria = almacen.geometria(municipio, masa, parcela)
+            geometrias.append((geometria, None) if geometria is not None else (None, "Parcela no encontrada"))
+        return geometrias
+
+    raise ValueError("La entrada debe tener columnas X e Y, o municipio, polígono y parcela")
+
+
+# Fila de la tabla de resultados: una columna por capa con los elementos afectados
+# y, para parcelas, otra con la superficie afectada
+def fila_resultado(resultado, capas=CAPAS_AFECCION):
+    fila = {"x_resultado": round(resultado.x, 2), "y_resultado": round(resultado.y, 2)}
+    for definicion in capas:
+        afeccion = resultado[definicion.nombre]
+        if afeccion.error:
+            fila[definicion.nombre] = f"Error: {afeccion.error}"
+        else:
+            fila[definicion.nombre] = "; ".join(str(e.get(definicion.campo_nombre, "")) for e in afeccion.elementos)
+        if resultado.geometria is not None:
+            fila[f"{definicion.nombre}_m2"] = round(sum(e.superficie or 0 for e in afeccion.elementos), 2)
+    return fila
+
+
+# Filas de detalle de una geometría de entrada: una por cada elemento afectado de cada
+# capa, con la superficie, la longitud y el porcentaje afectados
+def filas_por_elemento(nombre, resultado, capas=CAPAS_AFECCION):
+    filas = []
+    for definicion in capas:
+        afeccion = resultado[definicion.nombre]
+        if afeccion.error:
+            filas.append({"entrada": nombre, "capa": definicion.nombre, "elemento": f"Error: {afeccion.error}"})
+        for elemento in afeccion.elementos:
+            filas.append({
+                "entrada": nombre,
+                "capa": definicion.nombre,
+                "elemento": str(elemento.get(definicion.campo_nombre, "")),
+                "superficie_m2": round(elemento.superficie, 2) if elemento.superficie is not None else None,
+                "longitud_m": round(elemento.longitud, 2) if elemento.longitud is not None else None,
+                "porcentaje": round(elemento.porcentaje, 2) if elemento.porcentaje is not None else None,
+            })
+    return filas
+
+
+# Columnas de la tabla de resultados, fijas para todo el lote: cada bloque se ajusta
+# a ellas aunque no tenga ninguna fila válida o le falte alguna capa
+def columnas_resultado(bloque, capas=CAPAS_AFECCION):
+    columnas = list(bloque.columns) + ["fila", "error", "x_resultado", "y_resultado"]
+    por_parcela = not (_columna(bloque.columns, COLUMNAS_X) and _columna(bloque.columns, COLUMNAS_Y))
+    for definicion in capas:
+        columnas.append(definicion.nombre)
+        if por_parcela:
+            columnas.append(f"{definicion.nombre}_m2")
+    return columnas + ["lon", "lat"]
+
+
+def _generar_pdf_fila(resultado, solicitud, ruta, formato=None):
+    datos = componer_datos(resultado, **solicitud)
+    if formato is None:
+        return generar_pdf(datos, resultado.x, resultado.y, ruta)
+    return generar_informe(datos, resultado.x, resultado.y, formato, ruta)
+
+
+# Cada proceso de trabajo compila la plantilla una vez y usa una sola instancia de
+# LibreOffice durante todo el lote
+def _iniciar_proceso():
+    config.INSTANCIAS_OFFICE = 1
+
+
+# Procesa la entrada completa. progreso(filas_procesadas) se llama tras cada bloque.
+# formato None genera los PDF con FPDF; "docx" o "pdf", con la plantilla Word.
+def procesar_lote(entrada, salida, directorio_pdf=None, tamano_bloque=TAMANO_BLOQUE,
+                  procesos=None, progreso=None, capas=CAPAS_AFECCION, formato=None):
+    salida = Path(salida)
+    if directorio_pdf:
+        Path(directorio_pdf).mkdir(parents=True, exist_ok=True)
+    pool = ProcessPoolExecutor(max_workers=procesos, initializer=_iniciar_proceso) if directorio_pdf else None
+
+    procesadas = 0
+    pendientes = []
+    columnas = None
+    try:
+        for numero, bloque in enumerate(leer_entrada(entrada, tamano_bloque)):
+            geometrias = geometrias_bloque(bloque)
+            if columnas is None:
+                columnas = columnas_resultado(bloque, capas)
+            validas = [i for i, (g, _) in enumerate(geometrias) if g is not None]
+            resultados = dict(zip(validas, consultar_afecciones_lote([geometrias[i][0] for i in validas], capas)))
+
+            filas = []
+            for i, (_, motivo) in enumerate(geometrias):
+                fila = {"fila": procesadas + i + 1, "error": motivo or ""}
+                if i in resultados:
+                    fila.update(fila_resultado(resultados[i], capas))
+                    if pool is not None:
+                        ruta_pdf = os.path.join(directorio_pdf,
+                                                f"informe_{procesadas + i + 1:06d}.{formato or 'pdf'}")
+                        solicitud = _solicitud(bloque.iloc[i])
+                        pendientes.append(pool.submit(_generar_pdf_fila, resultados[i], solicitud, ruta_pdf,
+                                                      formato))
+                filas.append(fila)
+
+            tabla = pd.concat([bloque.reset_index(drop=True), pd.DataFrame(filas)], axis=1)
+            tabla = tabla.reindex(columns=columnas)
+            if tabla["x_resultado"].notna().any():
+                # Longitud y latitud de todo el bloque en una sola transformación
+                tabla["lon"], tabla["lat"] = transformar_array(tabla["x_resultado"], tabla["y_resultado"])
+            tabla.to_csv(salida, mode="w" if numero == 0 else "a", header=numero == 0, index=False)
+
+            procesadas += len(bloque)
+            # Se espera a los PDF del bloque para no acumular resultados en memoria
+            for futuro in pendientes:
+                futuro.result()
+            pendientes.clear()
+            if progreso:
+                progreso(procesadas)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return procesadas
+
+
+# Datos del solicitante que traiga la fila de entrada, para el PDF
+def _solicitud(fila):
+    campos = {"nombre": "nombre", "apellidos": "apellidos", "dni": "dni", "direccion": "direccion",
+              "telefono": "telefono", "email": "email", "objeto": "objeto",
+              "municipio": "municipio", "poligono": "poligono", "parcela": "parcela"}
+    valores = {_normalizar(k): v for k, v in fila.items() if pd.notna(v)}
+    return {destino: str(valores[origen]) for origen, destino in campos.items() if origen in valores}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Informe de afecciones por lotes")
+    parser.add_argument("entrada", help="CSV o Excel con columnas X, Y o municipio, polígono, parcela")
+    parser.add_argument("salida", help="CSV de resultados")
+    parser.add_argument("--pdf", metavar="DIRECTORIO", help="genera un informe PDF por fila en el directorio")
+    parser.add_argument("--bloque", type=int, default=TAMANO_BLOQUE, help="filas por bloque")
+    parser.add_argument("--procesos", type=int, default=None, help="procesos para generar los PDF")
+    parser.add_argument("--plantilla", choices=("docx", "pdf"),
+                        help="genera los informes con la plantilla Word, en DOCX o en PDF")
+    args = parser.parse_args(argv)
+
+    total = procesar_lote(args.entrada, args.salida, args.pdf, args.bloque, args.procesos,
+                          progreso=lambda n: print(f"{n} filas procesadas", file=sys.stderr),
+                          formato=args.plantilla)
+    print(f"Resultados de {total} filas en {args.salida}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
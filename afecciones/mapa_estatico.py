@@ -0,0 +1,216 @@
+# Servicio de renderizado del mapa estático de los informes. Las teselas se buscan
+# por este orden: directorio local, MBTiles, caché en disco y, por último, el
+# servidor remoto (guardándolas en la caché). Sin red, las que falten se dejan en
+# blanco y el mapa sigue mostrando la parcela y las capas afectadas, que se dibujan
+# a partir de los datos locales. Los mapas se renderizan en un grupo acotado de
+# hilos con tiempo máximo.
+import math
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import requests
+import shapely
+from PIL import Image
+from staticmap import StaticMap, CircleMarker, Line
+
+from . import config, metricas
+from .capas import obtener_capa
+from .crs import transformar, transformar_array
+from .motor import CAPAS_AFECCION
+
+# La plantilla interna permite recuperar z, x, y en StaticMap.get
+PLANTILLA_TESELA = "tesela://{z}/{x}/{y}"
+
+COLORES_CAPAS = {
+    "ENP": "#2e7d32",
+    "ZEPA": "#1565c0",
+    "LIC": "#00838f",
+    "VP": "#ef6c00",
+    "MUP": "#6a1b9a",
+}
+COLOR_PARCELA = "#d50000"
+
+
+def _tesela_vacia(tamano=256):
+    salida = BytesIO()
+    Image.new("RGB", (tamano, tamano), (242, 239, 233)).save(salida, format="PNG")
+    return salida.getvalue()
+
+
+TESELA_VACIA = _tesela_vacia()
+
+
+# Origen de teselas compartido por todos los renderizados del proceso
+class OrigenTeselas:
+    def __init__(self, url=config.URL_TESELAS, directorio=config.DIRECTORIO_TESELAS,
+                 mbtiles=config.RUTA_MBTILES, cache=config.DIRECTORIO_CACHE_TESELAS):
+        self.url = url
+        self.directorio = Path(directorio) if directorio else None
+        self.mbtiles = Path(mbtiles) if mbtiles else None
+        self.cache = Path(cache)
+        self._local = threading.local()
+
+    def _sesion(self):
+        sesion = getattr(self._local, "sesion", None)
+        if sesion is None:
+            sesion = self._local.sesion = requests.Session()
+            sesion.headers["User-Agent"] = "Afecciones_UDIF"
+        return sesion
+
+    def _desde_mbtiles(self, z, x, y):
+        con = getattr(self._local, "mbtiles", None)
+        if con is None:
+            con = self._local.mbtiles = sqlite3.connect(f"file:{self.mbtiles}?mode=ro", uri=True)
+        # MBTiles usa el origen TMS: la fila se cuenta desde abajo
+        fila = con.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                           (z, x, (1 << z) - 1 - y)).fetchone()
+        return fila[0] if fila else None
+
+    def obtener(self, z, x, y, timeout=None):
+        origen, contenido = self._obtener(z, x, y, timeout)
+        metricas.contar("afecciones_teselas_total", origen=origen)
+        return contenido
+
+    # Origen de la tesela ("directorio", "mbtiles", "cache", "remoto" o "vacia") y contenido
+    def _obtener(self, z, x, y, timeout=None):
+        if self.directorio is not None:
+            ruta = self.directorio / str(z) / str(x) / f"{y}.png"
+            if ruta.is_file():
+                return "directorio", ruta.read_bytes()
+        if self.mbtiles is not None and self.mbtiles.is_file():
+            contenido = self._desde_mbtiles(z, x, y)
+            if contenido:
+                return "mbtiles", contenido
+
+        ruta = self.cache / str(z) / str(x) / f"{y}.png"
+        if ruta.is_file():
+            return "cache", ruta.read_bytes()
+        if not self.url:
+            return "vacia", None
+        try:
+            with metricas.etapa("descarga_tesela"):
+                respuesta = self._sesion().get(self.url.format(z=z, x=x, y=y), timeout=timeout)
+        except requests.RequestException:
+            return "vacia", None
+        if respuesta.status_code != 200:
+            return "vacia", None
+        metricas.contar("afecciones_bytes_total", len(respuesta.content), origen="teselas")
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_name(f".{ruta.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temporal.write_bytes(respuesta.content)
+        os.replace(temporal, ruta)
+        return "remoto", respuesta.content
+
+
+class StaticMapLocal(StaticMap):
+    def __init__(self, width, height, origen, timeout=None, **kwargs):
+        super().__init__(width, height, url_template=PLANTILLA_TESELA, tile_request_timeout=timeout, **kwargs)
+        self.origen = origen
+        # Teselas que se han dejado en blanco (las descargas van en varios hilos)
+        self.vacias = []
+
+    # Sustituye la descarga directa de StaticMap por el origen de teselas
+    def get(self, url, timeout=None, **kwargs):
+        z, x, y = (int(v) for v in url[len("tesela://"):].split("/"))
+        contenido = self.origen.obtener(z, x, y, timeout=timeout)
+        if contenido is None:
+            self.vacias.append((z, x, y))
+            return 200, TESELA_VACIA
+        return 200, contenido
+
+
+_origen = None
+_pool = ThreadPoolExecutor(max_workers=config.HILOS_MAPA, thread_name_prefix="mapa")
+
+
+def _reiniciar_tras_fork():
+    global _pool, _origen
+    _pool = ThreadPoolExecutor(max_workers=config.HILOS_MAPA, thread_name_prefix="mapa")
+    _origen = None
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+def obtener_origen_teselas():
+    global _origen
+    if _origen is None:
+        _origen = OrigenTeselas()
+    return _origen
+
+
+# Metros por píxel (Web Mercator) en la latitud y zoom indicados
+def _resolucion(lat, zoom):
+    return 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+# Líneas (lon, lat) de los contornos de una geometría en ETRS89, recortada al rectángulo
+# visible y simplificada a un píxel
+def _contornos(geometria, caja, tolerancia):
+    geometria = shapely.clip_by_rect(geometria, *caja)
+    if geometria.is_empty:
+        return []
+    geometria = shapely.simplify(geometria, tolerancia)
+    partes = shapely.get_parts(shapely.boundary(geometria) if geometria.area > 0 else geometria)
+    lineas = []
+    for parte in partes:
+        coords = shapely.get_coordinates(parte)
+        if len(coords) >= 2:
+            lon, lat = transformar_array(coords[:, 0], coords[:, 1])
+            lineas.append(list(zip(lon, lat)))
+    return lineas
+
+
+def _dibujar(x, y, zoom, size, geometria, resultado, definiciones):
+    with metricas.etapa("mapa_estatico"):
+        return _dibujar_mapa(x, y, zoom, size, geometria, resultado, definiciones)
+
+
+def _dibujar_mapa(x, y, zoom, size, geometria, resultado, definiciones):
+    lon, lat = transformar(x, y)
+    mapa = StaticMapLocal(size[0], size[1], obtener_origen_teselas(), timeout=config.TIMEOUT_MAPA)
+
+    resolucion = _resolucion(lat, zoom)
+    medio_ancho, medio_alto = resolucion * size[0] * 0.6, resolucion * size[1] * 0.6
+    caja = (x - medio_ancho, y - medio_alto, x + medio_ancho, y + medio_alto)
+
+    # Capas afectadas, dibujadas desde los datos locales
+    if resultado is not None:
+        for definicion in definiciones:
+            afeccion = resultado.get(definicion.nombre)
+            if afeccion is None or not afeccion.afectado or definicion.nombre not in COLORES_CAPAS:
+                continue
+            capa = obtener_capa(definicion.origen, definicion.nombre)
+            for posicion in capa.indice.query(shapely.box(*caja)):
+                for linea in _contornos(capa.geometrias[posicion], caja, resolucion):
+                    mapa.add_line(Line(linea, COLORES_CAPAS[definicion.nombre], 2))
+
+    if geometria is not None and not geometria.geom_type == "Point":
+        for linea in _contornos(geometria, caja, resolucion):
+            mapa.add_line(Line(linea, COLOR_PARCELA, 3))
+    mapa.add_marker(CircleMarker((lon, lat), 'red', 12))
+
+    imagen = mapa.render(zoom=zoom, center=(lon, lat))
+    salida = BytesIO()
+    imagen.convert("RGB").save(salida, format="JPEG", quality=90)
+    return salida.getvalue(), not mapa.vacias
+
+
+# JPEG del mapa de localización centrado en (x, y) en ETRS89 / UTM 30. Opcionalmente
+# dibuja el contorno de la geometría consultada y las capas afectadas del resultado.
+# Lanza TimeoutError si no termina en timeout segundos.
+def renderizar_mapa(x, y, zoom=16, size=(800, 600), geometria=None, resultado=None,
+                    definiciones=CAPAS_AFECCION, timeout=config.TIMEOUT_MAPA):
+    return renderizar_mapa_completo(x, y, zoom, size, geometria, resultado, definiciones, timeout)[0]
+
+
+# Como renderizar_mapa, pero devuelve (JPEG, completo): completo es False si alguna
+# tesela se ha dejado en blanco (sin red o con errores del servidor)
+def renderizar_mapa_completo(x, y, zoom=16, size=(800, 600), geometria=None, resultado=None,
+                             definiciones=CAPAS_AFECCION, timeout=config.TIMEOUT_MAPA):
+    futuro = _pool.submit(metricas.en_contexto(_dibujar), x, y, zoom, size, geometria, resultado, definiciones)
+    return futuro.result(timeout=timeout)
@@ -0,0 +1,233 @@
+# Instrumentación del proceso: tiempos por etapa, bytes leídos o descargados y
+# aciertos/fallos de las cachés. Los valores se acumulan en memoria (por proceso)
+# y se exportan en el formato de texto de Prometheus. Cada petición (un informe en
+# la aplicación, una llamada al servicio HTTP) lleva un identificador de
+# correlación y al terminar escribe una línea JSON con sus etapas en el registro.
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Límites (en segundos) de los intervalos de los histogramas de tiempos
+LIMITES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+AYUDA = {
+    "afecciones_etapa_segundos": ("histogram", "Duración de cada etapa del proceso"),
+    "afecciones_peticion_segundos": ("histogram", "Duración total de cada petición"),
+    "afecciones_peticiones_total": ("counter", "Peticiones atendidas"),
+    "afecciones_bytes_total": ("counter", "Bytes leídos, descargados o generados"),
+    "afecciones_cache_total": ("counter", "Consultas a las cachés, por resultado"),
+    "afecciones_teselas_total": ("counter", "Teselas del mapa estático, por origen"),
+    "afecciones_errores_total": ("counter", "Errores, por etapa"),
+    "afecciones_actualizaciones_total": ("counter", "Ficheros de datos actualizados sin reiniciar"),
+}
+
+registro = logging.getLogger("afecciones")
+if os.environ.get("AFECCIONES_LOG", "1") != "0" and not registro.handlers:
+    _salida = logging.StreamHandler()
+    _salida.setFormatter(logging.Formatter("%(message)s"))
+    registro.addHandler(_salida)
+    registro.setLevel(logging.INFO)
+    registro.propagate = False
+
+_bloqueo = threading.Lock()
+_contadores = {}
+_histogramas = {}
+
+# Petición en curso en este contexto (o None)
+_peticion = contextvars.ContextVar("afecciones_peticion", default=None)
+
+
+def _clave(nombre, etiquetas):
+    return nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+
+def contar(nombre, valor=1, **etiquetas):
+    clave = _clave(nombre, etiquetas)
+    with _bloqueo:
+        _contadores[clave] = _contadores.get(clave, 0) + valor
+        peticion = _peticion.get()
+        if peticion is not None and nombre == "afecciones_bytes_total":
+            origen = etiquetas.get("origen", "")
+            peticion["bytes"][origen] = peticion["bytes"].get(origen, 0) + valor
+
+
+def observar(nombre, segundos, **etiquetas):
+    clave = _clave(nombre, etiquetas)
+    with _bloqueo:
+        histograma = _histogramas.get(clave)
+        if histograma is None:
+            histograma = _histogramas[clave] = [[0] * len(LIMITES), 0.0, 0]
+        for i, limite in enumerate(LIMITES):
+            if segundos <= limite:
+                histograma[0][i] += 1
+        histograma[1] += segundos
+        histograma[2] += 1
+
+
+# Cuenta un acierto o un fallo de la caché indicada
+def cache(nombre, acierto):
+    contar("afecciones_cache_total", cache=nombre, resultado="acierto" if acierto else "fallo")
+
+
+# Mide el bloque como una etapa: al histograma global y a la petición en curso
+@contextmanager
+def etapa(nombre, **etiquetas):
+    inicio = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        contar("afecciones_errores_total", etapa=nombre)
+        raise
+    finally:
+        segundos = time.perf_counter() - inicio
+        observar("afecciones_etapa_segundos", segundos, etapa=nombre, **etiquetas)
+        peticion = _peticion.get()
+        if peticion is not None:
+            with _bloqueo:
+                peticion["etapas"][nombre] = round(peticion["etapas"].get(nombre, 0) + segundos * 1000, 3)
+
+
+# Petición con identificador de correlación. Las etapas medidas dentro (también en
+# los hilos lanzados con en_contexto) se acumulan en ella y al salir se escribe
+# una línea JSON con el identificador, la duración, las etapas y los bytes. El bloque
+# puede fijar datos["estado"] (por ejemplo, para una respuesta de error sin excepción).
+@contextmanager
+def peticion(tipo, identificador=None, **campos):
+    datos = {"id": identificador or uuid.uuid4().hex, "tipo": tipo, "etapas": {}, "bytes": {}, **campos}
+    testigo = _peticion.set(datos)
+    inicio = time.perf_counter()
+    estado = "ok"
+    try:
+        yield datos
+        estado = datos.get("estado", estado)
+    except Exception as e:
+        estado = "error"
+        datos["error"] = repr(e)
+        raise
+    finally:
+        _peticion.reset(testigo)
+        segundos = time.perf_counter() - inicio
+        observar("afecciones_peticion_segundos", segundos, tipo=tipo)
+        contar("afecciones_peticiones_total", tipo=tipo, estado=estado)
+        datos.update(estado=estado, duracion_ms=round(segundos * 1000, 3), pid=os.getpid(),
+                     fecha=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        registro.info(json.dumps(datos, ensure_ascii=False, default=str))
+
+
+# Identificador de la petición en curso, o None
+def identificador():
+    datos = _peticion.get()
+    return datos["id"] if datos is not None else None
+
+
+# Envuelve funcion para que se ejecute en el contexto actual (para ThreadPoolExecutor.submit)
+def en_contexto(funcion):
+    contexto = contextvars.copy_context()
+    return lambda *args, **kwargs: contexto.run(funcion, *args, **kwargs)
+
+
+def _etiquetas(etiquetas, extra=()):
+    pares = list(etiquetas) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}"
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# Todas las métricas del proceso en el formato de texto de Prometheus
+def texto_prometheus():
+    with _bloqueo:
+        contadores = dict(_contadores)
+        histogramas = {k: ([*v[0]], v[1], v[2]) for k, v in _histogramas.items()}
+
+    lineas = []
+    nombres = sorted({n for n, _ in contadores} | {n for n, _ in histogramas})
+    for nombre in nombres:
+        tipo, ayuda = AYUDA.get(nombre, ("untyped", nombre))
+        lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        for (n, etiquetas), valor in sorted(contadores.items()):
+            if n == nombre:
+                lineas.append(f"{nombre}{_etiquetas(etiquetas)} {valor}")
+        for (n, etiquetas), (cubetas, suma, cuenta) in sorted(histogramas.items()):
+            if n != nombre:
+                continue
+            for limite, acumulado in zip(LIMITES, cubetas):
+                lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas, [('le', limite)])} {acumulado}")
+            lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas, [('le', '+Inf')])} {cuenta}")
+            lineas.append(f"{nombre}_sum{_etiquetas(etiquetas)} {suma}")
+            lineas.append(f"{nombre}_count{_etiquetas(etiquetas)} {cuenta}")
+    return "\n".join(lineas) + "\n"
+
+
+# Resumen para el panel de administración: por etapa, número de mediciones y tiempo
+# medio, y los contadores tal cual
+def resumen():
+    with _bloqueo:
+        acumulado = {}
+        for (nombre, etiquetas), (_, suma, cuenta) in _histogramas.items():
+            etiquetas = dict(etiquetas)
+            nombre_etapa = etiquetas.get("etapa") or f"peticion_{etiquetas.get('tipo', '')}"
+            total = acumulado.setdefault(nombre_etapa, [0.0, 0])
+            total[0] += suma
+            total[1] += cuenta
+        contadores = [{"métrica": n, **dict(e), "valor": v} for (n, e), v in sorted(_contadores.items())]
+    etapas = {e: {"mediciones": c, "media_ms": round(1000 * s / c, 3)} for e, (s, c) in sorted(acumulado.items()) if c}
+    return etapas, contadores
+
+
+def reiniciar():
+    with _bloqueo:
+        _contadores.clear()
+        _histogramas.clear()
+
+
+_servidor = None
+
+
+# El hijo de un fork() empieza con sus propias métricas y sin el servidor del padre
+def _reiniciar_tras_fork():
+    global _bloqueo, _servidor
+    _bloqueo = threading.Lock()
+    _servidor = None
+    _contadores.clear()
+    _histogramas.clear()
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+# Servidor local que publica /metrics para los procesos que no tienen uno propio
+# (la aplicación Streamlit). Se arranca una sola vez por proceso.
+def servir_metricas(puerto, host="127.0.0.1"):
+    global _servidor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ManejadorMetricas(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            cuerpo = texto_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass
+
+    with _bloqueo:
+        if _servidor is None:
+            _servidor = ThreadingHTTPServer((host, puerto), ManejadorMetricas)
+            threading.Thread(target=_servidor.serve_forever, daemon=True, name="metricas").start()
+    return _servidor
@@ -0,0 +1,384 @@
+# Motor de consulta de afecciones: lanza la comprobación de cada capa en paralelo
+# y devuelve un resultado estructurado en lugar de cadenas de texto sueltas.
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from dataclasses import dataclass, field, replace
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Point
+
+from . import config, metricas
+from .cache import clave, obtener_cache
+from .capas import medir_intersecciones, obtener_capa, superposicion_significativa
+from .versiones import version_datos
+
+DIRECTORIO_GEOJSON = "GeoJSON/"
+
+# Segundos que se espera a cada capa antes de darla por fallida
+TIMEOUT_CAPA = 30
+
+
+# Descripción de una capa de afección y de los campos que interesan de ella. distancia
+# es el umbral (m) de las consultas de proximidad; con 0 la capa no se comprueba por distancia.
+@dataclass(frozen=True)
+class DefinicionCapa:
+    nombre: str
+    origen: str
+    campo_nombre: str
+    campos: tuple = ()
+    articulo: str = "ninguna"
+    distancia: float = 0
+
+
+# Elemento de una capa afectado por la consulta. En las consultas por polígono o
+# línea se incluye la superficie (m²) o longitud (m) de la intersección y el
+# porcentaje que supone sobre la geometría consultada. En las consultas de proximidad,
+# distancia (m) es la que separa el elemento de la geometría consultada.
+@dataclass
+class ElementoAfectado:
+    atributos: dict
+    superficie: float = None
+    longitud: float = None
+    porcentaje: float = None
+    distancia: float = None
+
+    def get(self, campo, defecto=None):
+        return self.atributos.get(campo, defecto)
+
+    def como_dict(self):
+        return {"atributos": {k: _valor_json(v) for k, v in self.atributos.items()},
+                "superficie": self.superficie, "longitud": self.longitud, "porcentaje": self.porcentaje,
+                "distancia": self.distancia}
+
+    # Texto con la medida de la afección, vacío en las consultas por punto
+    @property
+    def medida(self):
+        if self.porcentaje is None:
+            return ""
+        return f"{self.cantidad}, {self.porcentaje:.2f} %"
+
+    @property
+    def cantidad(self):
+        if self.superficie:
+            return f"{self.superficie:.2f} m²"
+        return f"{self.longitud or 0:.2f} m"
+
+
+# Resultado de comprobar una capa: afectada o no, y atributos de los elementos afectados.
+# En las consultas de proximidad, distancia_umbral es el umbral aplicado, cercanos los
+# elementos no afectados a menos de esa distancia y mas_cercano, si la capa no está
+# afectada, el elemento más próximo aunque quede fuera del umbral.
+@dataclass
+class ResultadoAfeccion:
+    capa: str
+    afectado: bool = False
+    elementos: list = field(default_factory=list)
+    error: str = None
+    campo_nombre: str = "nombre"
+    articulo: str = "ninguna"
+    distancia_umbral: float = None
+    cercanos: list = field(default_factory=list)
+    mas_cercano: ElementoAfectado = None
+
+    @property
+    def atributos(self):
+        return self.elementos[0].atributos if self.elementos else {}
+
+    @property
+    def nombre(self):
+        return self.atributos.get(self.campo_nombre, f"{self.capa} encontrado")
+
+    # Distancia al elemento más cercano: 0 si la capa está afectada
+    @property
+    def distancia(self):
+        if self.afectado:
+            return 0.0
+        return self.mas_cercano.distancia if self.mas_cercano is not None else None
+
+    def como_dict(self):
+        datos = {"capa": self.capa, "afectado": self.afectado, "error": self.error, "texto": self.texto,
+                 "elementos": [e.como_dict() for e in self.elementos]}
+        if self.distancia_umbral is not None:
+            datos.update(distancia_umbral=self.distancia_umbral, distancia=self.distancia,
+                         cercanos=[e.como_dict() for e in self.cercanos],
+                         mas_cercano=self.mas_cercano.como_dict() if self.mas_cercano is not None else None)
+        return datos
+
+    # Texto descriptivo con el mismo formato que mostraba la aplicación
+    @property
+    def texto(self):
+        if self.error:
+            return f"Error al consultar {self.capa}"
+        if not self.afectado:
+            return f"No se encuentra en {self.articulo} {self.capa}" + self._texto_proximidad()
+        medida = self.elementos[0].medida
+        if self.capa == "MUP":
+            a = self.atributos
+            texto = (f"Dentro de MUP:\nID: {a.get('ID_MONTE', 'Desconocido')}\n"
+                     f"Nombre: {a.get('NOMBREMONT', 'Desconocido')}\n"
+                     f"Municipio: {a.get('MUNICIPIO', 'Desconocido')}\n"
+                     f"Propiedad: {a.get('PROPIEDAD', 'Desconocido')}")
+            return texto + (f"\nSuperficie afectada: {medida}" if medida else "")
+        texto = f"Dentro de {self.capa}: {self.nombre}" + (f" ({medida})" if medida else "")
+        if len(self.elementos) > 1:
+            texto += f" y {len(self.elementos) - 1} más"
+        return texto
+
+
+    def _texto_proximidad(self):
+        if self.mas_cercano is None:
+            return ""
+        nombre = self.mas_cercano.get(self.campo_nombre, f"{self.capa} encontrado")
+        distancia = self.mas_cercano.distancia
+        if not self.cercanos:
+            return (f" ni a menos de {self.distancia_umbral:g} m"
+                    f" (el más cercano, {nombre}, está a {distancia:.2f} m)")
+        texto = f", pero está a {distancia:.2f} m de {nombre} (umbral de {self.distancia_umbral:g} m)"
+        if len(self.cercanos) > 1:
+            texto += f" y de {len(self.cercanos) - 1} más"
+        return texto
+
+
+# Conjunto de resultados de una consulta, accesible por nombre de capa.
+# geometria es None en las consultas por punto; version es la de los datos consultados.
+@dataclass
+class ResultadoConsulta:
+    x: float
+    y: float
+    afecciones: list = field(default_factory=list)
+    geometria: object = None
+    version: str = None
+
+    def __getitem__(self, capa):
+        for resultado in self.afecciones:
+            if resultado.capa == capa:
+                return resultado
+        raise KeyError(capa)
+
+    def get(self, capa, defecto=None):
+        try:
+            return self[capa]
+        except KeyError:
+            return defecto
+
+    def __iter__(self):
+        return iter(self.afecciones)
+
+    @property
+    def textos(self):
+        return [r.texto for r in self.afecciones]
+
+    def como_dict(self):
+        return {"x": self.x, "y": self.y, "version_datos": self.version,
+                "geometria": self.geometria.wkt if self.geometria is not None else None,
+                "afecciones": [r.como_dict() for r in self.afecciones]}
+
+
+# Valor de un atributo apto para JSON: sin NaN y con fechas como texto
+def _valor_json(valor):
+    if valor is None or isinstance(valor, (bool, int, str)):
+        return valor
+    if isinstance(valor, float):
+        return None if math.isnan(valor) else valor
+    return str(valor)
+
+
+# Definiciones con los umbrales de proximidad indicados ({capa: metros}) en lugar de los suyos
+def con_distancias(distancias, capas=None):
+    capas = CAPAS_AFECCION if capas is None else capas
+    return tuple(replace(d, distancia=float(distancias[d.nombre])) if d.nombre in distancias else d
+                 for d in capas)
+
+
+CAPAS_AFECCION = con_distancias(config.DISTANCIAS, (
+    DefinicionCapa("ENP", DIRECTORIO_GEOJSON + "ENP.json", "nombre", distancia=100),
+    DefinicionCapa("ZEPA", DIRECTORIO_GEOJSON + "ZEPA.json", "SITE_NAME", distancia=100),
+    DefinicionCapa("LIC", DIRECTORIO_GEOJSON + "LIC.json", "SITE_NAME", distancia=100),
+    DefinicionCapa("VP", DIRECTORIO_GEOJSON + "VP.json", "VP_NB", distancia=100),
+    DefinicionCapa("TM", DIRECTORIO_GEOJSON + "TM.json", "NAMEUNIT"),
+    DefinicionCapa("MUP", DIRECTORIO_GEOJSON + "MUP.json", "NOMBREMONT",
+                   campos=("ID_MONTE", "NOMBREMONT", "MUNICIPIO", "PROPIEDAD"), articulo="ningún", distancia=100),
+))
+
+MEDIDAS = ["superficie", "longitud", "porcentaje"]
+
+_pool = ThreadPoolExecutor(max_workers=len(CAPAS_AFECCION), thread_name_prefix="afecciones")
+
+
+# Los hilos no sobreviven a fork(): cada proceso hijo necesita su propio grupo
+def _reiniciar_pool():
+    global _pool
+    _pool = ThreadPoolExecutor(max_workers=len(CAPAS_AFECCION), thread_name_prefix="afecciones")
+
+
+os.register_at_fork(after_in_child=_reiniciar_pool)
+
+
+# Elementos afectados a partir de las filas seleccionadas, con atributos en tipos nativos de Python
+def _elementos(seleccion, campos=()):
+    geometria = [seleccion.geometry.name] if isinstance(seleccion, gpd.GeoDataFrame) else []
+    atributos = seleccion.drop(columns=geometria + MEDIDAS, errors="ignore")
+    if campos:
+        atributos = atributos[[c for c in campos if c in atributos.columns]]
+    registros = [{k: (v.item() if hasattr(v, "item") else v) for k, v in fila.items()}
+                 for fila in atributos.to_dict("records")]
+    if "superficie" not in seleccion.columns:
+        return [ElementoAfectado(r) for r in registros]
+    return [ElementoAfectado(r, float(sup), float(lon), float(pct))
+            for r, sup, lon, pct in zip(registros, seleccion["superficie"],
+                                        seleccion["longitud"], seleccion["porcentaje"])]
+
+
+def _resultado(definicion, error=None):
+    return ResultadoAfeccion(definicion.nombre, error=error,
+                             campo_nombre=definicion.campo_nombre, articulo=definicion.articulo)
+
+
+# Comprueba una capa para un punto o, si se indica, para una geometría completa.
+# Con proximidad se buscan además los elementos cercanos (ver _proximidad).
+def consultar_capa(definicion, x, y, geometria=None, proximidad=False):
+    resultado = _resultado(definicion)
+    capa = obtener_capa(definicion.origen, definicion.nombre)
+    with metricas.etapa("consulta_capa", capa=definicion.nombre):
+        if geometria is None:
+            seleccion = capa.consultar_punto(x, y)
+        else:
+            seleccion = capa.consultar_geometria(geometria)
+    if not seleccion.empty:
+        resultado.afectado = True
+        resultado.elementos = _elementos(seleccion, definicion.campos)
+    if proximidad and definicion.distancia > 0:
+        with metricas.etapa("proximidad", capa=definicion.nombre):
+            consultada = geometria if geometria is not None else Point(x, y)
+            _proximidad(resultado, capa, definicion, consultada, seleccion.index.to_numpy())
+    return resultado
+
+
+# Elementos a menos del umbral de la capa que no están ya entre los afectados y, si la
+# capa no está afectada, el más cercano. Todo sale del índice espacial: no se amplía
+# ningún polígono ni se mide la distancia a los elementos que el índice descarta.
+def _proximidad(resultado, capa, definicion, consultada, afectadas):
+    resultado.distancia_umbral = float(definicion.distancia)
+    posiciones, distancias = capa.cercanos(consultada, definicion.distancia)
+    libres = ~np.isin(posiciones, afectadas)
+    resultado.cercanos = _elementos_distancia(capa, definicion, posiciones[libres], distancias[libres])
+    if resultado.afectado:
+        return
+    if resultado.cercanos:
+        resultado.mas_cercano = resultado.cercanos[0]
+    else:
+        posicion, distancia = capa.mas_cercano(consultada)
+        if posicion is not None:
+            resultado.mas_cercano = _elementos_distancia(capa, definicion, [posicion], [distancia])[0]
+
+
+def _elementos_distancia(capa, definicion, posiciones, distancias):
+    if len(posiciones) == 0:
+        return []
+    elementos = _elementos(capa.atributos(np.asarray(posiciones)), definicion.campos)
+    for elemento, distancia in zip(elementos, distancias):
+        elemento.distancia = float(distancia)
+    return elementos
+
+
+# Consulta todas las capas a la vez; el tiempo total lo marca la capa más lenta.
+# Con geometria (por ejemplo, el polígono de una parcela) se evalúa la superposición
+# completa en lugar del punto (x, y). Los resultados sin errores se guardan en la
+# caché persistente, de modo que repetir una consulta no vuelve a tocar las capas.
+# Con proximidad, cada capa con umbral (DefinicionCapa.distancia) informa también de
+# los elementos cercanos y de la distancia al más próximo.
+def consultar_afecciones(x, y, capas=CAPAS_AFECCION, timeout=TIMEOUT_CAPA, geometria=None, usar_cache=True,
+                         proximidad=False):
+    cache = obtener_cache() if usar_cache else None
+    if cache is None:
+        return _consultar_afecciones(x, y, capas, timeout, geometria, proximidad)
+
+    consultada = geometria if geometria is not None else Point(x, y)
+    k = clave("afecciones", consultada, round(x, 2), round(y, 2), repr(capas), proximidad)
+    return cache.memoizar(k, lambda: _consultar_afecciones(x, y, capas, timeout, geometria, proximidad),
+                          guardable=lambda r: not any(a.error for a in r))
+
+
+def _consultar_afecciones(x, y, capas, timeout, geometria, proximidad=False):
+    futuros = [(d, _pool.submit(metricas.en_contexto(consultar_capa), d, x, y, geometria, proximidad))
+               for d in capas]
+    limite = time.monotonic() + timeout
+
+    resultado = ResultadoConsulta(x, y, geometria=geometria, version=version_datos())
+    for definicion, futuro in futuros:
+        try:
+            afeccion = futuro.result(timeout=max(0, limite - time.monotonic()))
+        except FuturesTimeoutError:
+            afeccion = _resultado(definicion, f"Tiempo de espera agotado ({timeout} s)")
+        except Exception as e:
+            afeccion = _resultado(definicion, str(e))
+        resultado.afecciones.append(afeccion)
+    return resultado
+
+
+# Consulta por lotes: cruza todas las geometrías de entrada con cada capa en una sola
+# consulta al índice espacial en lugar de comprobar fila a fila. Los puntos se
+# evalúan por contención y el resto de geometrías por superposición.
+def consultar_afecciones_lote(geometrias, capas=CAPAS_AFECCION, crs="EPSG:25830"):
+    entrada = gpd.GeoDataFrame(geometry=list(geometrias), crs=crs).reset_index(drop=True)
+    puntuales = (entrada.geom_type == "Point").to_numpy()
+    centros = entrada.geometry.representative_point()
+
+    version = version_datos()
+    resultados = [ResultadoConsulta(c.x, c.y, geometria=None if p else g, version=version)
+                  for c, p, g in zip(centros, puntuales, entrada.geometry)]
+    for definicion in capas:
+        try:
+            capa = obtener_capa(definicion.origen, definicion.nombre)
+            afecciones = _cruzar_capa(entrada, puntuales, capa, definicion)
+            for resultado, afeccion in zip(resultados, afecciones):
+                resultado.afecciones.append(afeccion)
+        except Exception as e:
+            for resultado in resultados:
+                resultado.afecciones.append(_resultado(definicion, str(e)))
+    return resultados
+
+
+def _cruzar_capa(entrada, puntuales, capa, definicion):
+    todas = entrada.geometry.to_numpy()
+    pares = []
+    if puntuales.any():
+        filas = np.flatnonzero(puntuales)
+        izquierda, posiciones = capa.cruzar(todas[filas], "within")
+        pares.append((filas[izquierda], posiciones, None))
+    if not puntuales.all():
+        filas = np.flatnonzero(~puntuales)
+        izquierda, posiciones = capa.cruzar(todas[filas], "intersects")
+        izquierda = filas[izquierda]
+        geometrias = todas[izquierda]
+        # Geometrías de la capa de cada par, pedidas una vez para el borde y la intersección
+        elementos_capa = capa.geometrias_de(posiciones)
+        # Como en las consultas individuales, no cuentan los elementos que solo comparten
+        # borde ni los que se superponen en una astilla
+        validos = ~shapely.touches(geometrias, elementos_capa)
+        izquierda, posiciones, geometrias, elementos_capa = \
+            izquierda[validos], posiciones[validos], geometrias[validos], elementos_capa[validos]
+        intersecciones = shapely.intersection(elementos_capa, geometrias)
+        validas = superposicion_significativa(intersecciones, geometrias, elementos_capa)
+        pares.append((izquierda[validas], posiciones[validas], intersecciones[validas]))
+
+    afecciones = [_resultado(definicion) for _ in range(len(entrada))]
+    for izquierda, posiciones, intersecciones in pares:
+        if len(izquierda) == 0:
+            continue
+        orden = np.lexsort((posiciones, izquierda))
+        izquierda, posiciones = izquierda[orden], posiciones[orden]
+        seleccion = capa.atributos(posiciones).copy()
+        geometrias = todas[izquierda]
+        if intersecciones is not None:
+            seleccion["superficie"], seleccion["longitud"], seleccion["porcentaje"] = \
+                medir_intersecciones(intersecciones[orden], geometrias)
+        elementos = _elementos(seleccion, definicion.campos)
+        for fila, elemento in zip(izquierda, elementos):
+            afecciones[fila].afectado = True
+            afecciones[fila].elementos.append(elemento)
+    return afecciones
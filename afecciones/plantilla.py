@@ -0,0 +1,348 @@
+# Informes a partir de la plantilla Word del repositorio (plantilla_informe_afecciones.docx,
+# con marcas Jinja de docxtpl). La plantilla se lee, se prepara y se compila una vez
+# por proceso, y cada informe solo rellena el XML ya compilado con el resultado de la
+# consulta, de modo que cambiar el diseño del informe es editar el .docx. El paso a
+# PDF lo hace un grupo de instancias de LibreOffice que se arrancan una vez y atienden
+# todas las conversiones; sin LibreOffice se usa docx2pdf (Word) y, si tampoco está,
+# el PDF se genera con FPDF (informe.generar_pdf).
+import os
+import queue
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+from docx.shared import Mm
+from docxtpl import DocxTemplate, InlineImage, Listing
+from jinja2 import Environment
+
+from . import config, metricas
+from .informe import generar_imagen_estatica_mapa, generar_pdf
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+except ImportError:
+    uno = None
+
+try:
+    import docx2pdf
+except ImportError:
+    docx2pdf = None
+
+FORMATOS = ("docx", "pdf")
+
+ANCHO_MAPA = Mm(160)
+
+# Los valores se escapan para que un "&" o un "<" de los datos no rompa el XML del documento
+ENTORNO = Environment(autoescape=True)
+
+
+# Plantilla preparada (las marcas Jinja que Word parte en varios fragmentos, ya unidas)
+# y compilada. Sirve para cualquier número de informes y desde varios hilos a la vez.
+class PlantillaInforme:
+    def __init__(self, ruta=config.RUTA_PLANTILLA):
+        self.ruta = Path(ruta)
+        self.contenido = self.ruta.read_bytes()
+        plantilla = DocxTemplate(BytesIO(self.contenido))
+        plantilla.init_docx()
+        xml = plantilla.patch_xml(plantilla.get_xml())
+        # Lo mismo que hace DocxTemplate.render_xml_part antes de compilar
+        self.cuerpo = ENTORNO.from_string(re.sub(r"<w:p([ >])", r"\n<w:p\1", xml))
+
+    # Informe DOCX (bytes) con los datos de componer_datos y, si se da, la imagen JPEG del mapa
+    def renderizar(self, datos, imagen_mapa=None):
+        documento = _Documento(self)
+        documento.render(contexto(documento, datos, imagen_mapa), ENTORNO)
+        salida = BytesIO()
+        documento.save(salida)
+        return salida.getvalue()
+
+
+# Documento de un informe: una copia del .docx de la plantilla cuyo cuerpo se rellena
+# con la plantilla ya compilada en lugar de prepararla y compilarla otra vez
+class _Documento(DocxTemplate):
+    def __init__(self, plantilla):
+        super().__init__(BytesIO(plantilla.contenido))
+        self.plantilla = plantilla
+
+    def build_xml(self, context, jinja_env=None):
+        # Las imágenes del contexto se añaden a la parte que se está rellenando
+        self.current_rendering_part = self.docx._part
+        xml = self.plantilla.cuerpo.render(context)
+        xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", xml)
+        xml = xml.replace("{_{", "{{").replace("}_}", "}}").replace("{_%", "{%").replace("%_}", "%}")
+        return self.resolve_listing(xml)
+
+
+# Variables de la plantilla. Además de las que usa la plantilla del repositorio se
+# pasan la lista completa de afecciones, con sus elementos, y la versión de los datos,
+# para que una plantilla modificada pueda recorrerlas.
+def contexto(documento, datos, imagen_mapa=None):
+    resultado = datos.get("resultado_afecciones")
+    afecciones = {r.capa: r for r in resultado} if resultado is not None else {}
+
+    def texto(capa):
+        return Listing(datos.get(f"afección {capa}", ""))
+
+    mup = afecciones.get("MUP")
+    monte = mup.atributos if mup is not None and mup.afectado else {}
+    tm = afecciones.get("TM")
+    terminos = ", ".join(str(e.get(tm.campo_nombre, "")) for e in tm.elementos) if tm is not None else ""
+
+    return {
+        "fecha_solicitud": datos.get("fecha_solicitud", ""),
+        "fecha_informe": datos.get("fecha_informe", ""),
+        "nombre": datos.get("nombre", ""),
+        "apellidos": datos.get("apellidos", ""),
+        "dni": datos.get("dni", ""),
+        "direccion": datos.get("dirección", ""),
+        "telefono": datos.get("teléfono", ""),
+        "email": datos.get("email", ""),
+        "objeto": Listing(datos.get("objeto de la solicitud", "") or "No especificado"),
+        "municipio": datos.get("municipio", ""),
+        "poligono": datos.get("polígono", ""),
+        "parcela": datos.get("parcela", ""),
+        "coordenadas_x": f"{datos.get('coordenadas_x', 0):.2f}",
+        "coordenadas_y": f"{datos.get('coordenadas_y', 0):.2f}",
+        "mup_id": monte.get("ID_MONTE", "No afecta"),
+        "mup_nombre": monte.get("NOMBREMONT", "-"),
+        "mup_municipio": monte.get("MUNICIPIO", "-"),
+        "mup_propiedad": monte.get("PROPIEDAD", "-"),
+        "tm": terminos or texto("TM"),
+        "vp": texto("VP"),
+        "enp": texto("ENP"),
+        "zepa": texto("ZEPA"),
+        "lic": texto("LIC"),
+        "mapa": InlineImage(documento, BytesIO(imagen_mapa), width=ANCHO_MAPA) if imagen_mapa else "",
+        "version_datos": datos.get("version_datos", ""),
+        "afecciones": [_afeccion(r) for r in afecciones.values()],
+    }
+
+
+def _afeccion(resultado):
+    def elemento(e):
+        return {"nombre": e.get(resultado.campo_nombre, ""), "medida": e.medida, "distancia": e.distancia,
+                "atributos": e.atributos}
+
+    return {"capa": resultado.capa, "afectado": resultado.afectado, "error": resultado.error,
+            "texto": Listing(resultado.texto), "elementos": [elemento(e) for e in resultado.elementos],
+            "distancia_umbral": resultado.distancia_umbral,
+            "cercanos": [elemento(e) for e in resultado.cercanos]}
+
+
+_plantillas = {}
+_bloqueo_plantillas = threading.Lock()
+
+
+# Plantilla compilada del fichero; se vuelve a compilar si el fichero cambia
+def obtener_plantilla(ruta=config.RUTA_PLANTILLA):
+    ruta = Path(ruta)
+    clave = (ruta, ruta.stat().st_mtime_ns)
+    plantilla = _plantillas.get(clave)
+    if plantilla is None:
+        with _bloqueo_plantillas:
+            plantilla = _plantillas.get(clave)
+            if plantilla is None:
+                with metricas.etapa("compilacion_plantilla"):
+                    plantilla = PlantillaInforme(ruta)
+                for anterior in [c for c in _plantillas if c[0] == ruta]:
+                    del _plantillas[anterior]
+                _plantillas[clave] = plantilla
+    return plantilla
+
+
+def _puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Una instancia de LibreOffice sin interfaz con su propio perfil. Con el puente UNO
+# (el módulo uno de LibreOffice) el proceso se arranca una vez y se le mandan los
+# documentos; sin él, cada conversión es una llamada a soffice --convert-to, que al
+# menos reutiliza el perfil ya inicializado.
+class _InstanciaOffice:
+    def __init__(self, ejecutable):
+        self.ejecutable = ejecutable
+        self.perfil = Path(tempfile.mkdtemp(prefix="afecciones-office-"))
+        self.proceso = None
+        self._escritorio = None
+
+    def _opciones(self):
+        return [self.ejecutable, "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+                f"-env:UserInstallation={self.perfil.as_uri()}"]
+
+    def _arrancar(self):
+        puerto = _puerto_libre()
+        conexion = f"socket,host=127.0.0.1,port={puerto};urp;StarOffice.ComponentContext"
+        self.proceso = subprocess.Popen(self._opciones() + [f"--accept={conexion}"],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        local = uno.getComponentContext()
+        resolvedor = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        limite = time.monotonic() + config.TIMEOUT_CONVERSION
+        while True:
+            try:
+                contexto_office = resolvedor.resolve(f"uno:{conexion}")
+                break
+            except NoConnectException:
+                if time.monotonic() > limite or self.proceso.poll() is not None:
+                    self.cerrar()
+                    raise RuntimeError("No se ha podido arrancar LibreOffice")
+                time.sleep(0.25)
+        self._escritorio = contexto_office.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", contexto_office)
+
+    def convertir(self, contenido):
+        with tempfile.TemporaryDirectory(dir=self.perfil) as directorio:
+            entrada = Path(directorio) / "informe.docx"
+            salida = entrada.with_suffix(".pdf")
+            entrada.write_bytes(contenido)
+            if uno is None:
+                subprocess.run(self._opciones() + ["--convert-to", "pdf", "--outdir", directorio, str(entrada)],
+                               check=True, capture_output=True, timeout=config.TIMEOUT_CONVERSION)
+            else:
+                if self.proceso is None or self.proceso.poll() is not None:
+                    self._arrancar()
+                try:
+                    self._convertir_uno(entrada, salida)
+                except Exception:
+                    # Se arranca una instancia nueva en la siguiente conversión
+                    self.cerrar()
+                    raise
+            return salida.read_bytes()
+
+    def _convertir_uno(self, entrada, salida):
+        documento = self._escritorio.loadComponentFromURL(
+            uno.systemPathToFileUrl(str(entrada)), "_blank", 0, (_propiedad("Hidden", True),))
+        try:
+            documento.storeToURL(uno.systemPathToFileUrl(str(salida)),
+                                 (_propiedad("FilterName", "writer_pdf_Export"),))
+        finally:
+            documento.close(True)
+
+    def cerrar(self, borrar_perfil=False):
+        self._escritorio = None
+        if self.proceso is not None and self.proceso.poll() is None:
+            self.proceso.terminate()
+            try:
+                self.proceso.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proceso.kill()
+        self.proceso = None
+        if borrar_perfil:
+            shutil.rmtree(self.perfil, ignore_errors=True)
+
+
+def _propiedad(nombre, valor):
+    propiedad = PropertyValue()
+    propiedad.Name, propiedad.Value = nombre, valor
+    return propiedad
+
+
+# Conversión con Word a través de docx2pdf (Windows y macOS)
+class _InstanciaWord:
+    def convertir(self, contenido):
+        with tempfile.TemporaryDirectory() as directorio:
+            entrada = Path(directorio) / "informe.docx"
+            entrada.write_bytes(contenido)
+            docx2pdf.convert(str(entrada), str(entrada.with_suffix(".pdf")))
+            return entrada.with_suffix(".pdf").read_bytes()
+
+    def cerrar(self, borrar_perfil=False):
+        pass
+
+
+# Grupo de instancias de conversión: cada conversión toma una libre y la devuelve al
+# terminar, de modo que como mucho se hacen tantas a la vez como instancias hay
+class ConversorPDF:
+    def __init__(self, instancias):
+        self.instancias = list(instancias)
+        self._libres = queue.Queue()
+        for instancia in self.instancias:
+            self._libres.put(instancia)
+
+    def convertir(self, contenido):
+        instancia = self._libres.get()
+        try:
+            with metricas.etapa("conversion_pdf"):
+                return instancia.convertir(contenido)
+        finally:
+            self._libres.put(instancia)
+
+    def cerrar(self):
+        for instancia in self.instancias:
+            instancia.cerrar(borrar_perfil=True)
+
+
+_conversor = None
+_bloqueo_conversor = threading.Lock()
+
+
+# Los procesos de LibreOffice pertenecen al proceso que los arrancó: el hijo crea los suyos
+def _reiniciar_tras_fork():
+    global _conversor, _bloqueo_conversor
+    _conversor = None
+    _bloqueo_conversor = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+# Conversor del proceso; None si no hay LibreOffice ni Word
+def obtener_conversor():
+    global _conversor
+    if _conversor is None:
+        with _bloqueo_conversor:
+            if _conversor is None:
+                ejecutable = (config.EJECUTABLE_OFFICE or shutil.which("soffice")
+                              or shutil.which("libreoffice"))
+                if ejecutable:
+                    _conversor = ConversorPDF(_InstanciaOffice(ejecutable)
+                                              for _ in range(max(1, config.INSTANCIAS_OFFICE)))
+                elif docx2pdf is not None and sys.platform in ("win32", "darwin"):
+                    _conversor = ConversorPDF([_InstanciaWord()])
+                else:
+                    return None
+                # Se cierran al salir del proceso, también en los procesos de trabajo de
+                # multiprocessing, que no ejecutan los manejadores de atexit
+                Finalize(None, _conversor.cerrar, exitpriority=0)
+    return _conversor
+
+
+# Informe en DOCX o PDF a partir de la plantilla. Devuelve un BytesIO o, si se indica
+# filename, lo escribe en ese fichero. Sin conversor disponible, el PDF es el de FPDF.
+def generar_informe(datos, x, y, formato="pdf", filename=None):
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato de informe desconocido: {formato} (opciones: {', '.join(FORMATOS)})")
+    conversor = obtener_conversor() if formato == "pdf" else None
+    if formato == "pdf" and conversor is None:
+        return generar_pdf(datos, x, y, filename)
+
+    with metricas.etapa("informe_plantilla", formato=formato):
+        contenido = obtener_plantilla().renderizar(datos, _imagen_mapa(datos, x, y))
+        if conversor is not None:
+            contenido = conversor.convertir(contenido)
+    metricas.contar("afecciones_bytes_total", len(contenido), origen=formato)
+    if filename is None:
+        return BytesIO(contenido)
+    with open(filename, "wb") as f:
+        f.write(contenido)
+    return filename
+
+
+def _imagen_mapa(datos, x, y):
+    try:
+        resultado = datos.get("resultado_afecciones")
+        geometria = resultado.geometria if resultado is not None else None
+        return generar_imagen_estatica_mapa(x, y, geometria=geometria, resultado=resultado).getvalue()
+    except Exception:
+        return None
@@ -0,0 +1,285 @@
+# Banco de pruebas de rendimiento de la consulta, el mapa y el informe. Funciona sin
+# red: lee los datos de CATASTRO/ y GeoJSON/ del propio repositorio y sirve las
+# teselas desde un servidor local de pega. Mide la latencia (p50/p95), el
+# rendimiento y la memoria máxima del proceso de cada escenario y, si se indica,
+# los compara con una referencia guardada. Las capas se leen siempre del GeoJSON,
+# aunque haya ficheros .arrow (no versionados) en el directorio de datos; la carga
+# del formato binario se mide aparte, con ficheros convertidos en un directorio
+# temporal.
+#
+#   python -m afecciones.rendimiento                       # mide y muestra la tabla
+#   python -m afecciones.rendimiento --guardar             # y la guarda como referencia
+#   python -m afecciones.rendimiento --comparar            # sale con 1 si algo empeora
+import argparse
+import json
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import Point
+
+from . import config, mapa_estatico
+from .binario import convertir_capa, leer_capa_binaria
+from .capas import descartar_capas, obtener_capa
+from .fuentes import FuenteLocal, establecer_fuente
+from .informe import componer_datos, generar_pdf
+from .motor import CAPAS_AFECCION, consultar_afecciones, consultar_afecciones_lote
+from .plantilla import generar_informe
+from .superposicion import capas_vectoriales
+
+RUTA_REFERENCIA = config.RAIZ / "rendimiento_referencia.json"
+
+# Empeoramiento admitido respecto a la referencia antes de darlo por regresión
+TOLERANCIA = 1.25
+SEMILLA = 20240601
+# Formato del que se leen las capas en los escenarios; se guarda en la referencia y
+# solo se comparan medidas tomadas con el mismo
+FORMATO_CAPAS = "geojson"
+
+
+# Servidor de teselas y WMS de pega: responde a cualquier ruta con la misma imagen
+class _ManejadorTeselas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(mapa_estatico.TESELA_VACIA)))
+        self.end_headers()
+        self.wfile.write(mapa_estatico.TESELA_VACIA)
+
+    def log_message(self, *args):
+        pass
+
+
+def _servidor_teselas():
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), _ManejadorTeselas)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# Memoria residente máxima del proceso hasta ahora, en MB
+def _rss_maximo():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Ejecuta funcion(argumento) para cada argumento y resume las latencias
+def medir(nombre, funcion, argumentos, unidades=1):
+    tiempos = []
+    inicio = time.perf_counter()
+    for argumento in argumentos:
+        t = time.perf_counter()
+        funcion(argumento)
+        tiempos.append(time.perf_counter() - t)
+    total = time.perf_counter() - inicio
+    tiempos = np.array(tiempos) * 1000
+    return {
+        "escenario": nombre,
+        "repeticiones": len(tiempos),
+        "p50_ms": round(float(np.percentile(tiempos, 50)), 3),
+        "p95_ms": round(float(np.percentile(tiempos, 95)), 3),
+        "media_ms": round(float(tiempos.mean()), 3),
+        "por_segundo": round(len(tiempos) * unidades / total, 2) if total > 0 else None,
+        "rss_max_mb": round(_rss_maximo(), 1),
+    }
+
+
+# Capas de afección presentes en el directorio de datos
+def _capas_disponibles():
+    return tuple(d for d in CAPAS_AFECCION if (config.DIRECTORIO_DATOS / d.origen).exists())
+
+
+# Puntos aleatorios (reproducibles) dentro de la extensión de las capas
+def _puntos(capas, cantidad, generador):
+    cajas = np.array([obtener_capa(d.origen, d.nombre).extension for d in capas])
+    xmin, ymin = cajas[:, :2].min(axis=0)
+    xmax, ymax = cajas[:, 2:].max(axis=0)
+    return list(zip(generador.uniform(xmin, xmax, cantidad), generador.uniform(ymin, ymax, cantidad)))
+
+
+# Parcelas de muestra de los primeros shapefiles de CATASTRO/ con datos
+def _parcelas(cantidad, generador):
+    for shp in sorted((config.DIRECTORIO_DATOS / "CATASTRO").glob("*.shp")):
+        gdf = gpd.read_file(shp)
+        if len(gdf) >= cantidad:
+            elegidas = generador.choice(len(gdf), cantidad, replace=False)
+            return shp, list(gdf.geometry.iloc[elegidas])
+    raise FileNotFoundError("No hay shapefiles de parcelas en CATASTRO/")
+
+
+def ejecutar(repeticiones=50, tamano_lote=1000):
+    generador = np.random.default_rng(SEMILLA)
+    capas = _capas_disponibles()
+    if not capas:
+        raise FileNotFoundError(f"No hay capas de afección en {config.DIRECTORIO_DATOS / 'GeoJSON'}")
+
+    # Entorno aislado: datos locales, capas leídas del GeoJSON, sin caché de resultados
+    # y teselas del servidor de pega
+    establecer_fuente(FuenteLocal())
+    config.TAMANO_CACHE_RESULTADOS = 0
+    capas_binarias, config.CAPAS_BINARIAS = config.CAPAS_BINARIAS, False
+    descartar_capas()
+    servidor = _servidor_teselas()
+    cache_teselas = tempfile.TemporaryDirectory()
+    mapa_estatico._origen = mapa_estatico.OrigenTeselas(
+        url=f"http://127.0.0.1:{servidor.server_port}/{{z}}/{{x}}/{{y}}.png",
+        directorio="", mbtiles="", cache=cache_teselas.name)
+
+    resultados = []
+    try:
+        def carga_fria(_):
+            descartar_capas()
+            for definicion in capas:
+                obtener_capa(definicion.origen, definicion.nombre)
+
+        resultados.append(medir("carga_fria_capas", carga_fria, range(3)))
+
+        binarias = tempfile.TemporaryDirectory()
+        try:
+            rutas = [convertir_capa(config.DIRECTORIO_DATOS / d.origen, Path(binarias.name) / f"{d.nombre}.arrow")
+                     for d in capas]
+
+            def carga_fria_binaria(_):
+                for definicion, ruta in zip(capas, rutas):
+                    leer_capa_binaria(ruta, definicion.nombre)
+
+            resultados.append(medir("carga_fria_capas_binarias", carga_fria_binaria, range(3)))
+        finally:
+            binarias.cleanup()
+
+        shp, parcelas = _parcelas(repeticiones, generador)
+        resultados.append(medir("carga_shapefile_municipio", lambda _: gpd.read_file(shp), range(3)))
+
+        puntos = _puntos(capas, repeticiones, generador)
+        consultar = lambda p: consultar_afecciones(p[0], p[1], capas=capas, usar_cache=False)
+        consultar(puntos[0])
+        resultados.append(medir("consulta_punto", consultar, puntos))
+
+        def consultar_parcela(geometria):
+            centro = geometria.centroid
+            consultar_afecciones(centro.x, centro.y, capas=capas, geometria=geometria, usar_cache=False)
+
+        resultados.append(medir("consulta_parcela", consultar_parcela, parcelas))
+
+        lote = [Point(x, y) for x, y in _puntos(capas, tamano_lote, generador)]
+        resultados.append(medir(f"lote_{tamano_lote}_puntos", lambda _: consultar_afecciones_lote(lote, capas),
+                                range(3), unidades=tamano_lote))
+
+        resultados.append(medir("capas_mapa_interactivo", lambda p: capas_vectoriales(p[0], p[1], capas),
+                                puntos[:10]))
+
+        def mapa(parcela):
+            centro = parcela.centroid
+            resultado = consultar_afecciones(centro.x, centro.y, capas=capas, geometria=parcela, usar_cache=False)
+            return mapa_estatico.renderizar_mapa(centro.x, centro.y, geometria=parcela, resultado=resultado,
+                                                 definiciones=capas)
+
+        resultados.append(medir("mapa_estatico", mapa, parcelas[:10]))
+
+        def informe(parcela):
+            centro = parcela.centroid
+            resultado = consultar_afecciones(centro.x, centro.y, capas=capas, geometria=parcela, usar_cache=False)
+            datos = componer_datos(resultado, fecha_solicitud="01/01/2024", nombre="Prueba", objeto="Rendimiento")
+            generar_pdf(datos, centro.x, centro.y)
+
+        resultados.append(medir("informe_pdf", informe, parcelas[:10]))
+
+        def informe_plantilla(parcela):
+            centro = parcela.centroid
+            resultado = consultar_afecciones(centro.x, centro.y, capas=capas, geometria=parcela, usar_cache=False)
+            datos = componer_datos(resultado, fecha_solicitud="01/01/2024", nombre="Prueba", objeto="Rendimiento")
+            generar_informe(datos, centro.x, centro.y, "docx")
+
+        resultados.append(medir("informe_plantilla_docx", informe_plantilla, parcelas[:10]))
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+        cache_teselas.cleanup()
+        config.CAPAS_BINARIAS = capas_binarias
+        descartar_capas()
+
+    return {
+        "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "maquina": platform.machine(),
+        "capas": [d.nombre for d in capas],
+        "formato_capas": FORMATO_CAPAS,
+        "escenarios": resultados,
+    }
+
+
+# Cociente entre la medida actual y la de referencia para cada escenario común
+def comparar(actual, referencia, tolerancia=TOLERANCIA):
+    previos = {e["escenario"]: e for e in referencia["escenarios"]}
+    comparacion = []
+    for escenario in actual["escenarios"]:
+        previo = previos.get(escenario["escenario"])
+        if previo is None:
+            continue
+        cociente = escenario["p50_ms"] / previo["p50_ms"] if previo["p50_ms"] else None
+        comparacion.append({"escenario": escenario["escenario"], "p50_ref_ms": previo["p50_ms"],
+                            "p50_ms": escenario["p50_ms"], "cociente": cociente,
+                            "regresion": cociente is not None and cociente > tolerancia})
+    return comparacion
+
+
+def _tabla(filas, columnas):
+    anchos = [max(len(c), *(len(_texto(f.get(c))) for f in filas)) for c in columnas]
+    lineas = ["  ".join(c.ljust(a) for c, a in zip(columnas, anchos))]
+    for fila in filas:
+        lineas.append("  ".join(_texto(fila.get(c)).ljust(a) for c, a in zip(columnas, anchos)))
+    return "\n".join(lineas)
+
+
+def _texto(valor):
+    if isinstance(valor, float):
+        return f"{valor:.2f}"
+    return "" if valor is None else str(valor)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de pruebas de rendimiento de afecciones")
+    parser.add_argument("--repeticiones", type=int, default=50, help="consultas por escenario")
+    parser.add_argument("--lote", type=int, default=1000, help="puntos del escenario por lotes")
+    parser.add_argument("--referencia", type=Path, default=RUTA_REFERENCIA, help="fichero JSON de referencia")
+    parser.add_argument("--guardar", action="store_true", help="guarda el resultado como nueva referencia")
+    parser.add_argument("--comparar", action="store_true", help="compara con la referencia y falla si empeora")
+    parser.add_argument("--tolerancia", type=float, default=TOLERANCIA,
+                        help="cociente p50 actual/referencia a partir del cual hay regresión")
+    parser.add_argument("--json", type=Path, help="escribe también el resultado en este fichero")
+    args = parser.parse_args(argv)
+
+    actual = ejecutar(args.repeticiones, args.lote)
+    print(_tabla(actual["escenarios"], ["escenario", "repeticiones", "p50_ms", "p95_ms", "media_ms",
+                                        "por_segundo", "rss_max_mb"]))
+    if args.json:
+        args.json.write_text(json.dumps(actual, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    codigo = 0
+    if args.comparar:
+        if not args.referencia.exists():
+            print(f"No existe la referencia {args.referencia}", file=sys.stderr)
+            return 2
+        referencia = json.loads(args.referencia.read_text(encoding="utf-8"))
+        if referencia.get("formato_capas") != actual["formato_capas"]:
+            print(f"La referencia {args.referencia} no se midió leyendo las capas de {actual['formato_capas']}; "
+                  f"vuelve a generarla con --guardar", file=sys.stderr)
+            return 2
+        comparacion = comparar(actual, referencia, args.tolerancia)
+        print()
+        print(_tabla(comparacion, ["escenario", "p50_ref_ms", "p50_ms", "cociente", "regresion"]))
+        if any(c["regresion"] for c in comparacion):
+            codigo = 1
+    if args.guardar:
+        args.referencia.write_text(json.dumps(actual, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Referencia guardada en {args.referencia}", file=sys.stderr)
+    return codigo
+
+
+if __name__ == "__main__":
+    sys.exit(main())
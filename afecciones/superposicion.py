@@ -0,0 +1,84 @@
+# Capas vectoriales propias (ENP, ZEPA, LIC, VP, MUP) para el mapa interactivo.
+# Para cada nivel de zoom se usan las geometrías de la capa simplificadas con una
+# tolerancia acorde a ese nivel, recortadas a un recuadro alrededor del punto
+# consultado y con las coordenadas redondeadas, en lugar de los polígonos completos.
+# Medido en OJOS, MUP (la capa más densa) lleva unos 30 KB de GeoJSON en el zoom
+# 14-20 y unos 90 KB en el 11-13; ENP, menos de 15 KB.
+import json
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry import Point, mapping
+
+from . import metricas
+from .cache import clave, obtener_cache
+from .capas import obtener_capa
+from .crs import transformar_array
+from .motor import CAPAS_AFECCION
+
+# Niveles de detalle: (zoom mínimo, zoom máximo, semilado del recuadro en metros,
+# tolerancia de simplificación en metros, decimales de las coordenadas geográficas).
+# La tolerancia es del orden de un píxel en el zoom intermedio del nivel y el redondeo
+# queda por debajo de ella (1e-5 grados son un metro; 1e-4, unos diez). Por debajo
+# del zoom 11 no se superpone nada: ahí bastan las capas WMS.
+NIVELES = (
+    (14, 20, 2500, 2.0, 5),
+    (11, 13, 15000, 30.0, 4),
+)
+
+# Capas que se superponen (el término municipal no aporta nada en el mapa)
+CAPAS_MAPA = ("ENP", "ZEPA", "LIC", "VP", "MUP")
+
+def _a_geograficas(coordenadas, decimales):
+    lon, lat = transformar_array(coordenadas[:, 0], coordenadas[:, 1])
+    return np.round(np.column_stack([lon, lat]), decimales)
+
+
+# FeatureCollection con los elementos de la capa dentro del recuadro, recortados a él
+def _geojson_nivel(definicion, caja, tolerancia, decimales):
+    capa = obtener_capa(definicion.origen, definicion.nombre)
+    posiciones = np.sort(capa.indice.query(shapely.box(*caja)))
+    geometrias = shapely.clip_by_rect(capa.simplificadas(tolerancia, posiciones), *caja)
+    vacias = shapely.is_empty(geometrias)
+    posiciones, geometrias = posiciones[~vacias], shapely.transform(
+        geometrias[~vacias], lambda coordenadas: _a_geograficas(coordenadas, decimales))
+
+    nombres = capa.gdf[definicion.campo_nombre].iloc[posiciones] \
+        if definicion.campo_nombre in capa.gdf.columns else [""] * len(posiciones)
+    return {
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature", "properties": {"nombre": str(nombre)}, "geometry": mapping(geometria)}
+                     for nombre, geometria in zip(nombres, geometrias)],
+    }
+
+
+# Por cada capa, la lista de niveles (zoom mínimo, zoom máximo, GeoJSON) alrededor
+# del punto (x, y) en ETRS89 / UTM 30. Las capas que no se pueden leer se omiten
+# y el error queda en el registro y en afecciones_errores_total.
+def capas_vectoriales(x, y, definiciones=CAPAS_AFECCION, niveles=NIVELES):
+    definiciones = tuple(d for d in definiciones if d.nombre in CAPAS_MAPA)
+
+    def calcular():
+        capas = {}
+        with metricas.etapa("capas_mapa"):
+            for definicion in definiciones:
+                try:
+                    capas[definicion.nombre] = [
+                        (zoom_min, zoom_max, _geojson_nivel(definicion, (x - lado, y - lado, x + lado, y + lado),
+                                                            tolerancia, decimales))
+                        for zoom_min, zoom_max, lado, tolerancia, decimales in niveles]
+                except Exception as e:
+                    # La capa falta en el mapa: se cuenta y se registra, como los errores de las consultas
+                    metricas.contar("afecciones_errores_total", etapa="capas_mapa", capa=definicion.nombre)
+                    metricas.registro.warning(json.dumps({"tipo": "capas_mapa", "capa": definicion.nombre,
+                                                          "error": repr(e), "id": metricas.identificador(),
+                                                          "pid": os.getpid()}, ensure_ascii=False))
+        return capas
+
+    cache = obtener_cache()
+    if cache is None:
+        return calcular()
+    return cache.memoizar(clave("superposicion", Point(x, y), round(x, 2), round(y, 2),
+                                repr(definiciones), niveles), calcular,
+                          guardable=lambda capas: len(capas) == len(definiciones))
@@ -0,0 +1,281 @@
+# Versionado de los datos sin reiniciar la aplicación. Se guarda la huella de cada
+# fichero de GeoJSON/ y CATASTRO/ (tamaño, fecha y SHA-256 del contenido, que solo
+# se recalcula si cambian el tamaño o la fecha). Un hilo en segundo plano comprueba
+# los ficheros cada INTERVALO_VERSION_DATOS segundos y reconstruye únicamente lo que
+# depende de los que han cambiado: la capa de afección de un GeoJSON, o el catálogo
+# y el almacén catastral de un municipio. Lo nuevo se construye aparte y se sustituye
+# de una vez. Los ficheros derivados los reconstruye un solo proceso, con un bloqueo
+# sobre el fichero config.RUTA_DERIVADOS, donde anota la huella de los datos con que
+# los ha generado; los demás procesos, al ver que ya están al día, solo los vuelven a
+# cargar. La versión del conjunto de datos cambia después de la sustitución, de
+# modo que la caché de resultados y los informes siempre llevan la versión de los
+# datos con los que se han calculado.
+#
+#   python -m afecciones.versiones          # versión actual y huella de cada fichero
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from . import config, metricas
+from .capas import capa_cargada, leer_capa, sustituir_capa
+
+DIRECTORIOS_VERSIONADOS = ("GeoJSON", "CATASTRO")
+
+# Ficheros que genera la propia aplicación a partir de los datos y no forman parte de la versión
+EXTENSIONES_DERIVADAS = (".arrow",)
+
+# Segundos sin modificarse antes de dar por terminado un fichero que se está copiando
+ESPERA_ESTABLE = 2.0
+
+
+def _sha256(ruta):
+    huella = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            huella.update(bloque)
+    return huella.hexdigest()
+
+
+# Huella de un conjunto de ficheros {ruta relativa: (tamaño, fecha, sha256)}
+def _version(huellas):
+    huella = hashlib.sha256()
+    for ruta in sorted(huellas):
+        huella.update(f"{ruta}|{huellas[ruta][2]}\n".encode())
+    return huella.hexdigest()[:16]
+
+
+class Versionado:
+    def __init__(self, raices=None, intervalo=None):
+        # Directorio de datos y caché de descargas; si un fichero está en los dos, manda el primero
+        self.raices = [Path(r) for r in (raices or (config.DIRECTORIO_DATOS, config.DIRECTORIO_CACHE))]
+        self.intervalo = config.INTERVALO_VERSION_DATOS if intervalo is None else intervalo
+        self._bloqueo = threading.Lock()
+        self._hilo = None
+        self.huellas, _ = self._escanear({})
+        self.version = _version(self.huellas)
+        self.actualizada = time.time()
+
+    # Huellas actuales de los ficheros y rutas que se han dejado para la siguiente
+    # comprobación porque aún se están escribiendo
+    def _escanear(self, previas):
+        huellas, pendientes = {}, []
+        for raiz in self.raices:
+            for directorio in DIRECTORIOS_VERSIONADOS:
+                if not (raiz / directorio).is_dir():
+                    continue
+                for ruta in sorted((raiz / directorio).rglob("*")):
+                    relativa = ruta.relative_to(raiz).as_posix()
+                    if (relativa in huellas or not ruta.is_file() or ruta.name.startswith(".")
+                            or ruta.suffix in EXTENSIONES_DERIVADAS):
+                        continue
+                    estado = ruta.stat()
+                    previa = previas.get(relativa)
+                    if previa is not None and previa[:2] == (estado.st_size, estado.st_mtime_ns):
+                        huellas[relativa] = previa
+                    elif previas and time.time() - estado.st_mtime < ESPERA_ESTABLE:
+                        pendientes.append(relativa)
+                        if previa is not None:
+                            huellas[relativa] = previa
+                    else:
+                        huellas[relativa] = (estado.st_size, estado.st_mtime_ns, _sha256(ruta))
+        return huellas, pendientes
+
+    # Comprueba los ficheros y reconstruye lo que dependa de los que han cambiado de
+    # contenido. Devuelve las rutas cambiadas.
+    def actualizar(self):
+        with self._bloqueo:
+            huellas, pendientes = self._escanear(self.huellas)
+            cambiados = sorted(r for r in set(huellas) | set(self.huellas)
+                               if (huellas.get(r) or (None,) * 3)[2] != (self.huellas.get(r) or (None,) * 3)[2])
+            if not cambiados:
+                self.huellas = huellas
+                return []
+
+            with metricas.etapa("actualizacion_datos"), _registro_derivados() as derivados:
+                for reconstruir, recargar, argumentos, rutas in _tareas(cambiados, self.raices):
+                    try:
+                        # Huella de cada fichero de la tarea ("" si se ha borrado)
+                        nuevas = {r: (huellas.get(r) or ("",) * 3)[2] for r in rutas}
+                        if any(derivados.get(r) != h for r, h in nuevas.items()):
+                            reconstruir(*argumentos)
+                            derivados.update(nuevas)
+                            _guardar_derivados(derivados)
+                        recargar(*argumentos)
+                    except Exception as e:
+                        # Se sigue sirviendo lo anterior y se reintenta en la siguiente comprobación
+                        metricas.contar("afecciones_errores_total", etapa="actualizacion_datos")
+                        metricas.registro.warning(json.dumps({"tipo": "actualizacion_datos", "error": repr(e),
+                                                              "ficheros": rutas, "pid": os.getpid()},
+                                                             ensure_ascii=False))
+                        for ruta in rutas:
+                            if ruta in self.huellas:
+                                huellas[ruta] = self.huellas[ruta]
+                            else:
+                                huellas.pop(ruta, None)
+                            cambiados.remove(ruta)
+                            pendientes.append(ruta)
+            anterior, self.huellas = self.version, huellas
+            self.version, self.actualizada = _version(huellas), time.time()
+            metricas.contar("afecciones_actualizaciones_total", len(cambiados))
+            metricas.registro.info(json.dumps({"tipo": "actualizacion_datos", "version_anterior": anterior,
+                                               "version": self.version, "ficheros": cambiados,
+                                               "pendientes": pendientes, "pid": os.getpid()},
+                                              ensure_ascii=False))
+            return cambiados
+
+    # Hilo en segundo plano que llama a actualizar() cada intervalo segundos (ninguno si es 0)
+    def iniciar(self):
+        if self.intervalo <= 0 or (self._hilo is not None and self._hilo.is_alive()):
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="afecciones-versiones", daemon=True)
+        self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.actualizar()
+            except Exception as e:
+                metricas.contar("afecciones_errores_total", etapa="actualizacion_datos")
+                metricas.registro.warning(json.dumps({"tipo": "actualizacion_datos", "error": repr(e),
+                                                      "pid": os.getpid()}, ensure_ascii=False))
+
+    # Huella del contenido de los ficheros cuya ruta sin extensión es base (por ejemplo,
+    # "CATASTRO/OJOS" para todos los ficheros del shapefile); None si no hay ninguno
+    def huella(self, base):
+        partes = [f"{r}|{h[2]}" for r, h in sorted(self.huellas.items()) if r.split(".", 1)[0] == base]
+        return hashlib.sha256("\n".join(partes).encode()).hexdigest()[:16] if partes else None
+
+    def como_dict(self):
+        return {"version": self.version, "actualizada": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                                                      time.localtime(self.actualizada)),
+                "ficheros": {r: h[2][:16] for r, h in sorted(self.huellas.items())}}
+
+
+# Registro {ruta: sha256} de los datos con que se han generado los derivados, abierto
+# en exclusiva: mientras un proceso reconstruye, los demás esperan y después ven que
+# ya no tienen que hacerlo
+@contextmanager
+def _registro_derivados():
+    config.RUTA_DERIVADOS.parent.mkdir(parents=True, exist_ok=True)
+    with open(config.RUTA_DERIVADOS.with_suffix(".lock"), "w") as cerrojo:
+        fcntl.flock(cerrojo, fcntl.LOCK_EX)
+        try:
+            with open(config.RUTA_DERIVADOS, encoding="utf-8") as f:
+                derivados = json.load(f)
+        except (FileNotFoundError, ValueError):
+            derivados = {}
+        try:
+            yield derivados
+        finally:
+            fcntl.flock(cerrojo, fcntl.LOCK_UN)
+
+
+def _guardar_derivados(derivados):
+    temporal = config.RUTA_DERIVADOS.with_name(f".{config.RUTA_DERIVADOS.name}.{os.getpid()}.tmp")
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(derivados, f, ensure_ascii=False)
+    temporal.replace(config.RUTA_DERIVADOS)
+
+
+# Trabajo necesario para los ficheros cambiados: una tarea por capa y por municipio,
+# como (reconstrucción de los ficheros derivados, recarga de lo que tenga cargado el
+# proceso, argumentos, rutas de las que depende)
+def _tareas(cambiados, raices):
+    tareas = {}
+    for relativa in cambiados:
+        directorio, nombre = relativa.split("/", 1)
+        if directorio == "GeoJSON":
+            tareas.setdefault(("capa", relativa), (_convertir_capa, _recargar_capa, (relativa,), []))[3].append(relativa)
+        elif directorio == "CATASTRO" and "/" not in nombre:
+            municipio = nombre.split(".", 1)[0]
+            shp = next((r / "CATASTRO" / f"{municipio}.shp" for r in raices
+                        if (r / "CATASTRO" / f"{municipio}.shp").is_file()),
+                       raices[0] / "CATASTRO" / f"{municipio}.shp")
+            tarea = tareas.setdefault(("municipio", municipio),
+                                      (_actualizar_municipio, _recargar_municipio, (municipio, shp), []))
+            tarea[3].append(relativa)
+    return list(tareas.values())
+
+
+# Vuelve a generar el formato binario de la capa, si lo tiene
+def _convertir_capa(origen):
+    from .binario import convertir_capa, ruta_binaria
+
+    original = config.DIRECTORIO_DATOS / origen
+    binaria = config.DIRECTORIO_DATOS / ruta_binaria(origen)
+    if binaria.is_file() and original.is_file():
+        convertir_capa(original, binaria)
+
+
+# Sustituye la capa cargada por una nueva. Las capas que no se han cargado todavía
+# se leerán ya al día.
+def _recargar_capa(origen):
+    anterior = capa_cargada(origen)
+    if anterior is not None:
+        sustituir_capa(origen, leer_capa(origen, anterior.nombre))
+
+
+# Catálogo y almacén catastral de un municipio en disco, si se han construido
+def _actualizar_municipio(municipio, shp):
+    from .catalogo import DIRECTORIO_CATALOGO, actualizar_catalogo
+    from .catastro import RUTA_ALMACEN, actualizar_municipio
+
+    if (DIRECTORIO_CATALOGO / "municipios.json").exists():
+        actualizar_catalogo(municipio, shp, DIRECTORIO_CATALOGO)
+    if RUTA_ALMACEN.exists():
+        actualizar_municipio(shp, RUTA_ALMACEN)
+
+
+# Catálogo y almacén cargados en el proceso, con el municipio ya actualizado en disco
+def _recargar_municipio(municipio, shp):
+    from .catalogo import obtener_catalogo
+    from .catastro import obtener_almacen
+
+    catalogo = obtener_catalogo()
+    if catalogo is not None:
+        catalogo.recargar(municipio)
+    almacen = obtener_almacen()
+    if almacen is not None:
+        almacen.recargar_municipios()
+
+
+_versionado = None
+_bloqueo_versionado = threading.Lock()
+
+
+# El hilo no sobrevive a fork(): el proceso hijo arranca el suyo al pedir la versión
+def _reiniciar_tras_fork():
+    if _versionado is not None:
+        _versionado._bloqueo = threading.Lock()
+        _versionado._hilo = None
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+# Versionado compartido por todo el proceso, con su hilo de comprobación en marcha
+# (salvo con iniciar=False, en el proceso principal antes de crear los de trabajo)
+def obtener_versionado(iniciar=True):
+    global _versionado
+    if _versionado is None:
+        with _bloqueo_versionado:
+            if _versionado is None:
+                _versionado = Versionado()
+    if iniciar:
+        _versionado.iniciar()
+    return _versionado
+
+
+# Versión actual del conjunto de datos
+def version_datos():
+    return obtener_versionado().version
+
+
+if __name__ == "__main__":
+    print(json.dumps(Versionado(intervalo=0).como_dict(), indent=2, ensure_ascii=False))
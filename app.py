@@ -1,21 +1,33 @@
 import streamlit as st
 import folium
 from streamlit.components.v1 import html
-from fpdf import FPDF
-from pyproj import Transformer
-import requests
 import xml.etree.ElementTree as ET
 import geopandas as gpd
 import tempfile
 import os
-from shapely.geometry import Point
+import shapely
 import uuid
-from datetime import datetime
+import hashlib
+import zipfile
 from docx import Document
 from branca.element import Template, MacroElement
 from io import BytesIO
 from html2image import Html2Image
-from staticmap import StaticMap, CircleMarker
+import pandas as pd
+from afecciones.capas import obtener_capa
+from afecciones.motor import CAPAS_AFECCION, con_distancias, consultar_afecciones, consultar_afecciones_lote
+from afecciones.crs import transformar, transformar_geometria
+from afecciones.entrada import EXTENSIONES, leer_geometrias
+from afecciones.catastro import obtener_almacen
+from afecciones.catalogo import obtener_catalogo, leer_parcela_shapefile
+from afecciones.fuentes import obtener_fuente
+from afecciones.informe import componer_datos, generar_pdf
+from afecciones.plantilla import generar_informe
+from afecciones.lote import procesar_lote, filas_por_elemento
+from afecciones import config, metricas
+from afecciones.mapa_estatico import COLORES_CAPAS
+from afecciones.superposicion import capas_vectoriales
+from afecciones.versiones import obtener_versionado
 
 # Diccionario con los nombres de municipios y sus nombres base de archivo
 shp_urls = {
@@ -67,78 +79,172 @@ shp_urls = {
 
 }
 
-# Función para cargar shapefiles desde GitHub
+# Función para cargar el shapefile de un municipio desde la fuente de datos configurada.
+# La huella de sus ficheros forma parte de la clave de st.cache_data: si el shapefile
+# cambia se vuelve a leer sin reiniciar la aplicación
+def cargar_shapefile(base_name):
+    return _cargar_shapefile(base_name, obtener_versionado().huella(f"CATASTRO/{base_name}"))
+
 @st.cache_data
-def cargar_shapefile_desde_github(base_name):
-    base_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/CATASTRO/"
-    exts = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
-    
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_paths = {}
-        for ext in exts:
-            filename = base_name + ext
-            url = base_url + filename
-            local_path = os.path.join(tmpdir, filename)
-            
-            response = requests.get(url)
-            if response.status_code != 200:
-                st.error(f"Error al descargar {url}")
-                return None  # Si falta algún archivo esencial, falla todo
-            
-            with open(local_path, "wb") as f:
-                f.write(response.content)
-            local_paths[ext] = local_path
-        
-        shp_path = local_paths[".shp"]
-        gdf = gpd.read_file(shp_path)
-        return gdf
+def _cargar_shapefile(base_name, huella):
+    try:
+        with metricas.etapa("carga_shapefile"):
+            return gpd.read_file(obtener_fuente().ruta_shapefile(f"CATASTRO/{base_name}"))
+    except Exception as e:
+        st.error(f"Error al cargar el shapefile {base_name}: {e}")
+        return None  # Si falta algún archivo esencial, falla todo
             
+# Función para obtener los polígonos de un municipio (almacén, catálogo o shapefile)
+def masas_municipio(municipio):
+    almacen = obtener_almacen()
+    if almacen is not None and municipio in almacen.municipios:
+        return almacen.masas(municipio)
+    catalogo = obtener_catalogo()
+    if catalogo is not None and municipio in catalogo:
+        return catalogo[municipio].masas
+    gdf = cargar_shapefile(shp_urls[municipio])
+    return sorted(gdf["MASA"].unique()) if gdf is not None else []
+
+# Función para obtener las parcelas de un polígono
+def parcelas_masa(municipio, masa):
+    almacen = obtener_almacen()
+    if almacen is not None and municipio in almacen.municipios:
+        return almacen.parcelas(municipio, masa)
+    catalogo = obtener_catalogo()
+    if catalogo is not None and municipio in catalogo:
+        return catalogo[municipio].parcelas(masa)
+    gdf = cargar_shapefile(shp_urls[municipio])
+    return sorted(gdf[gdf["MASA"] == masa]["PARCELA"].unique()) if gdf is not None else []
+
+# Función para obtener los recintos de una parcela (almacén, catálogo o shapefile), o None
+def recintos_parcela(municipio, masa, parcela):
+    almacen = obtener_almacen()
+    catalogo = obtener_catalogo()
+    if almacen is not None and municipio in almacen.municipios:
+        return almacen.parcela(municipio, masa, parcela)
+    if catalogo is not None and municipio in catalogo:
+        return leer_parcela_shapefile(catalogo, municipio, masa, parcela)
+    gdf = cargar_shapefile(shp_urls[municipio])
+    return gdf[(gdf["MASA"] == masa) & (gdf["PARCELA"] == parcela)] if gdf is not None else None
+
+# Función para obtener la geometría (unión de sus recintos) de una parcela, o None
+def geometria_de_parcela(municipio, masa, parcela):
+    gdf = recintos_parcela(municipio, masa, parcela)
+    if gdf is None or gdf.empty:
+        return None
+    return shapely.union_all(gdf.geometry.values)
+
+# Función para obtener la geometría de una parcela y su centro (el centroide del primer
+# recinto): None si no se encuentra y False si no es un polígono
+def cargar_parcela(municipio, masa, parcela):
+    gdf = recintos_parcela(municipio, masa, parcela)
+    if gdf is None or gdf.empty:
+        return None
+    if not gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon']).all():
+        return False
+    punto_centro = gdf.geometry.iloc[0].centroid
+    return shapely.union_all(gdf.geometry.values), punto_centro.x, punto_centro.y
+
+# Grafo de cálculo de la sesión. Streamlit vuelve a ejecutar todo el script en cada
+# interacción; cada nodo (parcela, geometría, coordenadas, afecciones, mapa, informes)
+# guarda en st.session_state su último valor junto con las entradas con que se calculó,
+# y solo se recalcula si cambian ellas o la versión de los datos. Lo que se comparte
+# entre sesiones (índices de las capas, almacén catastral) se queda en el proceso.
+def nodo(nombre, entradas, calcular):
+    nodos = st.session_state.setdefault('nodos', {})
+    entradas = (obtener_versionado().version, *entradas)
+    guardado = nodos.get(nombre)
+    if guardado is not None and guardado[0] == entradas:
+        metricas.cache("sesion", True)
+        return guardado[1]
+    metricas.cache("sesion", False)
+    valor = calcular()
+    nodos[nombre] = (entradas, valor)
+    return valor
+
+# Último valor calculado de un nodo del grafo de la sesión, o None
+def valor_nodo(nombre):
+    guardado = st.session_state.get('nodos', {}).get(nombre)
+    return guardado[1] if guardado is not None else None
+
+# Función para cargar una vez por proceso, y no por sesión, las capas de afección y los
+# índices del catastro
+@st.cache_resource
+def precargar_recursos():
+    for definicion in CAPAS_AFECCION:
+        try:
+            obtener_capa(definicion.origen, definicion.nombre)
+        except Exception:
+            pass  # El error se mostrará al consultar la capa
+    obtener_almacen()
+    obtener_catalogo()
+
 # Función para transformar coordenadas de ETRS89 a WGS84 (Long, Lat)
 def transformar_coordenadas(x, y):
-    transformer = Transformer.from_crs("EPSG:25830", "EPSG:4326", always_xy=True)
-    lon, lat = transformer.transform(x, y)
-    return lon, lat
-
-# Función para consultar si el punto está dentro de algún polígono del GeoJSON
-def consultar_geojson(x, y, geojson_url, nombre_afeccion="Afección", campo_nombre="nombre"):
-    try:
-        gdf = gpd.read_file(geojson_url)
-        punto = Point(x, y)
-        seleccion = gdf[gdf.contains(punto)]
-        if not seleccion.empty:
-            props = seleccion.iloc[0]
-            nombre = props.get(campo_nombre, f"{nombre_afeccion} encontrado")
-            return f"Dentro de {nombre_afeccion}: {nombre}"
-        else:
-            return f"No se encuentra en ninguna {nombre_afeccion}"
-    except Exception as e:
-        st.error(f"Error al leer GeoJSON de {nombre_afeccion}: {e}")
-        return f"Error al consultar {nombre_afeccion}"
+    return transformar(x, y)
+
+# Plantilla que muestra en cada capa vectorial solo el nivel de detalle del zoom actual
+PLANTILLA_NIVELES = """
+{% macro script(this, kwargs) %}
+(function() {
+    var mapa = {{ this._parent.get_name() }};
+    var niveles = [
+    {%- for capa, nivel, zoom_min, zoom_max in this.niveles %}
+        [{{ capa }}, {{ nivel }}, {{ zoom_min }}, {{ zoom_max }}],
+    {%- endfor %}
+    ];
+    function actualizar() {
+        var zoom = mapa.getZoom();
+        niveles.forEach(function(n) {
+            var visible = zoom >= n[2] && zoom <= n[3];
+            if (visible && !n[0].hasLayer(n[1])) { n[0].addLayer(n[1]); }
+            if (!visible && n[0].hasLayer(n[1])) { n[0].removeLayer(n[1]); }
+        });
+    }
+    mapa.on("zoomend", actualizar);
+    actualizar();
+})();
+{% endmacro %}
+"""
 
-# Función para consultar si el punto está dentro de algún MUP del GeoJSON
-def consultar_mup(x, y, geojson_url):
-    try:
-        gdf = gpd.read_file(geojson_url)
-        punto = Point(x, y)
-        seleccion = gdf[gdf.contains(punto)]
-        if not seleccion.empty:
-            props = seleccion.iloc[0]
-            id_monte = props.get("ID_MONTE", "Desconocido")
-            nombre_monte = props.get("NOMBREMONT", "Desconocido")
-            municipio = props.get("MUNICIPIO", "Desconocido")
-            propiedad = props.get("PROPIEDAD", "Desconocido")
-            return (f"Dentro de MUP:\nID: {id_monte}\nNombre: {nombre_monte}\nMunicipio: {municipio}\nPropiedad: {propiedad}")
-        else:
-            return "No se encuentra en ningún MUP"
-    except Exception as e:
-        st.error(f"Error al consultar MUP: {e}")
-        return "Error al consultar MUP"
+# Función para añadir al mapa nuestras capas de afección (GeoJSON local recortado y
+# simplificado por niveles de zoom) alrededor del punto (x_utm, y_utm) en ETRS89
+def agregar_capas_vectoriales(m, x_utm, y_utm):
+    niveles = []
+    for nombre, geojson_niveles in capas_vectoriales(x_utm, y_utm).items():
+        color = COLORES_CAPAS.get(nombre, "#555555")
+        capa = folium.FeatureGroup(name=f"{nombre} (datos locales)", control=True)
+        for zoom_min, zoom_max, geojson in geojson_niveles:
+            if not geojson["features"]:
+                continue
+            nivel = folium.FeatureGroup(control=False)
+            folium.GeoJson(
+                geojson,
+                style_function=lambda _, color=color: {"color": color, "weight": 2, "fillOpacity": 0.1},
+                tooltip=folium.GeoJsonTooltip(fields=["nombre"], labels=False),
+            ).add_to(nivel)
+            nivel.add_to(capa)
+            niveles.append((capa.get_name(), nivel.get_name(), zoom_min, zoom_max))
+        capa.add_to(m)
+
+    selector = MacroElement()
+    selector._template = Template(PLANTILLA_NIVELES)
+    selector.niveles = niveles
+    m.add_child(selector)
 
 # Función para crear el mapa con afecciones específicas
-def crear_mapa(x, y, afecciones=[]):
+def crear_mapa(x, y, afecciones=[], x_utm=None, y_utm=None, geometria=None):
     m = folium.Map(location=[y, x], zoom_start=16)
     folium.Marker([y, x], popup=f"Coordenadas transformadas: {x}, {y}").add_to(m)
 
+    # Contorno de la parcela o de las geometrías consultadas
+    if geometria is not None and geometria.geom_type != "Point":
+        folium.GeoJson(
+            shapely.geometry.mapping(transformar_geometria(geometria)),
+            name="Geometría consultada",
+            style_function=lambda _: {"color": "#d50000", "weight": 3, "fillOpacity": 0.05},
+        ).add_to(m)
+
     # Agregar capas WMS
     folium.raster_layers.WmsTileLayer(
         url="https://ovc.catastro.meh.es/Cartografia/WMS/ServidorWMS.aspx",
@@ -169,6 +275,9 @@ def crear_mapa(x, y, afecciones=[]):
         control=True
     ).add_to(m)
 
+    if x_utm is not None and y_utm is not None:
+        agregar_capas_vectoriales(m, x_utm, y_utm)
+
     folium.LayerControl().add_to(m)
 
     # Añadir leyenda personalizada
@@ -206,180 +315,26 @@ def crear_mapa(x, y, afecciones=[]):
     for afeccion in afecciones:
         folium.Marker([y, x], popup=afeccion).add_to(m)
 
-    uid = uuid.uuid4().hex[:8]
-    mapa_html = f"mapa_{uid}.html"
-    m.save(mapa_html)
+    # HTML del mapa en memoria, sin escribir ficheros en el directorio de trabajo
+    mapa_html = BytesIO(m.get_root().render().encode("utf-8"))
 
     return mapa_html, afecciones
 
-# Función auxiliar para convertir el mapa HTML en imagen PNG
-def generar_imagen_estatica_mapa(x, y, zoom=16, size=(800, 600)):
-    mapa = StaticMap(size[0], size[1])
-    marcador = CircleMarker((x, y), 'red', 12)
-    mapa.add_marker(marcador)
-    image = mapa.render(zoom=zoom)
-
-    temp_dir = tempfile.mkdtemp()
-    output_path = os.path.join(temp_dir, "mapa.png")
-    image.save(output_path)
-    return output_path
-
-# Función para generar el PDF con los datos de la solicitud
-
-def generar_pdf(datos, x, y, filename):
-    pdf = FPDF()
-    pdf.add_page()
-
-    # Descargar e insertar el logo
-    logo_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/logos.jpg"
-    response = requests.get(logo_url)
-    if response.status_code == 200:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_img:
-            tmp_img.write(response.content)
-            tmp_img_path = tmp_img.name
-
-        page_width = pdf.w - 2 * pdf.l_margin
-        logo_width = page_width
-        pdf.image(tmp_img_path, x=pdf.l_margin, y=10, w=logo_width)
-
-        logo_height = logo_width * 0.2
-        pdf.set_y(10 + logo_height + 5)
-
-    # Título principal
-    pdf.set_font("Arial", "B", size=16)
-    pdf.set_text_color(0, 0, 0)
-    pdf.cell(0, 10, "Informe de Afecciones Ambientales", ln=True, align="C")
-    pdf.ln(10)
-
-    azul_rgb = (141, 179, 226)
-
-    # Lista de campos que deben aparecer en orden y en negrita
-    campos_orden = [
-        "Fecha solicitud", "Fecha informe", "Nombre", "Apellidos", "Dni", "Dirección",
-        "Teléfono", "Email", "Objeto de la solicitud"
-    ]
-
-    # Campos de localización
-    campos_localizacion = ["Municipio", "Polígono", "Parcela"]
-    
-    def seccion_titulo(texto):
-        pdf.set_fill_color(*azul_rgb)
-        pdf.set_text_color(0, 0, 0)
-        pdf.set_font("Arial", "B", 13)
-        pdf.cell(0, 10, texto, ln=True, fill=True)
-        pdf.ln(2)
-
-    def campo_orden(titulo, valor):
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 8, f"{titulo}:", ln=0)
-        pdf.set_font("Arial", "", 12)
-        pdf.multi_cell(0, 8, valor if valor else "No especificado")
- 
-    # 1. Datos del solicitante
-    seccion_titulo("1. Datos del solicitante")
-    campos_orden = [
-        ("Fecha solicitud", datos.get("fecha_solicitud", "").strip()),
-        ("Fecha informe", datos.get("fecha_informe", "").strip()),
-        ("Nombre", datos.get("nombre", "").strip()),
-        ("Apellidos", datos.get("apellidos", "").strip()),
-        ("DNI", datos.get("dni", "").strip()),
-        ("Dirección", datos.get("dirección", "").strip()),
-        ("Teléfono", datos.get("teléfono", "").strip()),
-        ("Email", datos.get("email", "").strip()),
-    ]
-    for titulo, valor in campos_orden:
-        campo_orden(titulo, valor)
-
-    # Objeto de la solicitud
-    objeto = datos.get("objeto de la solicitud", "").strip()
-    pdf.ln(2)
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 8, "Objeto de la solicitud:", ln=True)
-    pdf.set_font("Arial", "", 12)
-    pdf.multi_cell(0, 8, objeto if objeto else "No especificado")
-
-    # 2. Afecciones detectadas
-    seccion_titulo("2. Afecciones detectadas")
-    afecciones_keys = [k for k in datos if k.lower().startswith("afección")]
-
-    if afecciones_keys:
-        for key in afecciones_keys:
-            valor = datos[key].strip()
-            pdf.set_font("Arial", "B", 12)
-            pdf.cell(0, 8, f"{key.capitalize()}:", ln=True)
-            pdf.set_font("Arial", "", 12)
-
-            if key.lower() == "afección mup" and valor.lower().startswith("dentro de mup"):
-                lines = valor.split("\n")
-                resumen = lines[0]
-                pdf.multi_cell(0, 8, resumen)
-                if len(lines) > 4:
-                    # Cabecera tabla
-                    pdf.set_fill_color(200, 200, 200)
-                    pdf.set_font("Arial", "B", 11)
-                    pdf.cell(30, 8, "ID", border=1, fill=True)
-                    pdf.cell(80, 8, "Nombre", border=1, fill=True)
-                    pdf.cell(40, 8, "Municipio", border=1, fill=True)
-                    pdf.cell(40, 8, "Propiedad", border=1, ln=True, fill=True)
-
-                    # Obtener los campos por líneas (se asume estructura tipo 'ID: valor')
-                    datos_mup = {}
-                    for line in lines[1:]:
-                        if ":" in line:
-                            clave, valor_linea = line.split(":", 1)
-                            datos_mup[clave.strip().lower()] = valor_linea.strip()
-
-                    pdf.set_font("Arial", "", 11)
-                    pdf.cell(30, 8, datos_mup.get("id", ""), border=1)
-                    pdf.cell(80, 8, datos_mup.get("nombre", ""), border=1)
-                    pdf.cell(40, 8, datos_mup.get("municipio", ""), border=1)
-                    pdf.cell(40, 8, datos_mup.get("propiedad", ""), border=1, ln=True)
-                else:
-                    pdf.multi_cell(0, 8, "\n".join(lines[1:]))
-            else:
-                pdf.multi_cell(0, 8, valor)
-    else:
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(0, 8, "No se han detectado afecciones.", ln=True)
-
-    # Afecciones adicionales que no se han mostrado
-    for key in ["afección vp", "afección enp", "afección zepa", "afección lic", "afección tm"]:
-        valor = datos.get(key, "").strip()
-        if valor:
-            pdf.set_font("Arial", "B", 12)
-            pdf.cell(0, 8, f"{key.capitalize()}:", ln=True)
-            pdf.set_font("Arial", "", 12)
-            pdf.multi_cell(0, 8, valor)
-
-    # 3. Localización
-    seccion_titulo("3. Localización")
-    for campo in ["municipio", "polígono", "parcela"]:
-        valor = datos.get(campo, "").strip()
-        campo_orden(campo.capitalize(), valor if valor else "No disponible")
-
-    # Coordenadas
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, f"Coordenadas ETRS89: X = {x}, Y = {y}", ln=True)
-
-    # Insertar imagen del mapa si existe
-    imagen_mapa_path = generar_imagen_estatica_mapa(x, y)
-
-    if os.path.exists(imagen_mapa_path):
-        epw = pdf.w - 2 * pdf.l_margin  # Calcular el ancho útil de la página
-
-        pdf.ln(5)
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(0, 8, "Mapa de localización:", ln=True)
-        pdf.image(imagen_mapa_path, x=pdf.l_margin, w=epw)
-
-    pdf.output(filename)
-    return filename
-    
+# Función para publicar las métricas en formato Prometheus, una sola vez por proceso
+@st.cache_resource
+def iniciar_servidor_metricas(puerto):
+    return metricas.servir_metricas(puerto)
+
+if config.PUERTO_METRICAS:
+    iniciar_servidor_metricas(config.PUERTO_METRICAS)
+precargar_recursos()
+
 # Interfaz de Streamlit  
-st.image("https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/logos.jpg", use_container_width=True)
+st.image(bytes(obtener_fuente().leer("logos.jpg")), use_container_width=True)
 st.title("Informe básico de Afecciones UDIF")
 
-modo = st.radio("Selecciona el modo de búsqueda", ["Por coordenadas", "Por parcela"])
+modo = st.radio("Selecciona el modo de búsqueda",
+                ["Por coordenadas", "Por parcela", "Varias parcelas", "Por geometría", "Por lote"])
 
 # Variables iniciales de coordenadas y de selección (para el modo parcela)
 x = 0.0
@@ -387,40 +342,144 @@ y = 0.0
 municipio_sel = ""
 masa_sel = ""
 parcela_sel = ""
+geometria_parcela = None
+# Geometrías consultadas a la vez en los modos "Varias parcelas" y "Por geometría": (nombre, geometría)
+elementos_entrada = []
+# Identifica la entrada de los modos parcela y geometría en las claves del grafo de la sesión
+clave_entrada = None
 
 if modo == "Por parcela":
     municipio_sel = st.selectbox("Municipio", sorted(shp_urls.keys()))
-    archivo_base = shp_urls[municipio_sel]
-    
-    # Cargar el shapefile del municipio seleccionado
-    gdf = cargar_shapefile_desde_github(archivo_base)
-    
-    if gdf is not None:
-        masa_sel = st.selectbox("Polígono", sorted(gdf["MASA"].unique()))
-        parcela_sel = st.selectbox("Parcela", sorted(gdf[gdf["MASA"] == masa_sel]["PARCELA"].unique()))
-        parcela = gdf[(gdf["MASA"] == masa_sel) & (gdf["PARCELA"] == parcela_sel)]
-        
-        if parcela.geometry.geom_type.isin(['Polygon', 'MultiPolygon']).all():
-            # Calcular el centroide y asignar coordenadas
-            puntos = parcela.copy()
-            puntos["geometry"] = puntos.geometry.centroid
-            puntos["longitude"] = puntos.geometry.x
-            puntos["latitude"] = puntos.geometry.y
-            parcela = puntos  
-          
-            punto_centro = parcela.geometry.iloc[0]
-            x = punto_centro.x
-            y = punto_centro.y         
-                    
-            st.success("Parcela cargada correctamente.")
-            st.write(f"Municipio: {municipio_sel}")
-            st.write(f"Polígono: {masa_sel}")
-            st.write(f"Parcela: {parcela_sel}")
-        else:
-            st.error("La geometría seleccionada no es un polígono válido.")
+    # Del almacén o del catálogo solo se leen las listas y la parcela elegida
+    masa_sel = st.selectbox("Polígono", nodo("masas", (municipio_sel,), lambda: masas_municipio(municipio_sel)))
+    parcela_sel = st.selectbox("Parcela", nodo("parcelas", (municipio_sel, masa_sel),
+                                               lambda: parcelas_masa(municipio_sel, masa_sel)))
+    clave_entrada = ("parcela", municipio_sel, masa_sel, parcela_sel)
+    parcela = nodo("parcela", clave_entrada, lambda: cargar_parcela(municipio_sel, masa_sel, parcela_sel))
+
+    if parcela:
+        # Polígono completo para evaluar la superposición con cada capa, y su centro
+        geometria_parcela, x, y = parcela
+
+        st.success("Parcela cargada correctamente.")
+        st.write(f"Municipio: {municipio_sel}")
+        st.write(f"Polígono: {masa_sel}")
+        st.write(f"Parcela: {parcela_sel}")
+    elif parcela is False:
+        st.error("La geometría seleccionada no es un polígono válido.")
     else:
         st.error(f"No se pudo cargar el shapefile para el municipio: {municipio_sel}")
 
+# Varias parcelas: se van añadiendo a una selección que se consulta de una vez
+if modo == "Varias parcelas":
+    seleccion_parcelas = st.session_state.setdefault('seleccion_parcelas', [])
+    municipio_sel = st.selectbox("Municipio", sorted(shp_urls.keys()))
+    masa_sel = st.selectbox("Polígono", nodo("masas", (municipio_sel,), lambda: masas_municipio(municipio_sel)))
+    marcadas = st.multiselect("Parcelas", nodo("parcelas", (municipio_sel, masa_sel),
+                                               lambda: parcelas_masa(municipio_sel, masa_sel)))
+
+    col_anadir, col_vaciar = st.columns(2)
+    if col_anadir.button("Añadir a la selección"):
+        elegidas = {(p["municipio"], p["masa"], p["parcela"]) for p in seleccion_parcelas}
+        for parcela_marcada in marcadas:
+            if (municipio_sel, masa_sel, parcela_marcada) in elegidas:
+                continue
+            geometria = geometria_de_parcela(municipio_sel, masa_sel, parcela_marcada)
+            if geometria is None:
+                st.error(f"No se encontró la parcela {masa_sel}/{parcela_marcada} de {municipio_sel}")
+                continue
+            seleccion_parcelas.append({"municipio": municipio_sel, "masa": masa_sel,
+                                       "parcela": parcela_marcada, "geometria": geometria})
+    if col_vaciar.button("Vaciar selección"):
+        seleccion_parcelas.clear()
+
+    elementos_entrada = [(f"{p['municipio']} {p['masa']}/{p['parcela']}", p["geometria"])
+                         for p in seleccion_parcelas]
+    clave_entrada = ("parcelas", *((p["municipio"], p["masa"], p["parcela"]) for p in seleccion_parcelas))
+    municipio_sel = ", ".join(sorted({p["municipio"] for p in seleccion_parcelas}))
+    masa_sel = ", ".join(sorted({p["masa"] for p in seleccion_parcelas}))
+    parcela_sel = ", ".join(f"{p['masa']}/{p['parcela']}" for p in seleccion_parcelas)
+
+# Por geometría: WKT, GeoJSON o KML pegados o subidos (trazados, conducciones, repoblaciones...)
+if modo == "Por geometría":
+    archivo_geometria = st.file_uploader("Fichero WKT, GeoJSON o KML", type=[e[1:] for e in EXTENSIONES])
+    texto_geometria = st.text_area("O pega aquí la geometría (WKT, GeoJSON o KML)", height=150,
+                                   help="Sin sistema de referencia indicado, las coordenadas en grados se toman "
+                                        "como WGS84 y las demás como ETRS89 / UTM zona 30")
+    contenido, formato = None, None
+    if archivo_geometria is not None:
+        contenido = archivo_geometria.getvalue()
+        formato = EXTENSIONES.get(os.path.splitext(archivo_geometria.name)[1].lower())
+    elif texto_geometria.strip():
+        contenido = texto_geometria
+    if contenido is not None:
+        huella = hashlib.sha256(contenido if isinstance(contenido, bytes) else contenido.encode()).hexdigest()
+        clave_entrada = ("geometria", huella, formato)
+
+        def leer_entrada():
+            try:
+                return leer_geometrias(contenido, formato), None
+            except ValueError as e:
+                return [], str(e)
+
+        elementos_entrada, error_entrada = nodo("entrada", clave_entrada, leer_entrada)
+        if error_entrada:
+            st.error(error_entrada)
+
+if modo in ("Varias parcelas", "Por geometría"):
+    if elementos_entrada:
+        def unir_entrada():
+            union = shapely.union_all([g for _, g in elementos_entrada])
+            punto_centro = union.point_on_surface()
+            return union, punto_centro.x, punto_centro.y
+
+        geometria_parcela, x, y = nodo("geometria", clave_entrada, unir_entrada)
+        st.success(f"{len(elementos_entrada)} geometrías seleccionadas: "
+                   f"{geometria_parcela.area / 10000:.2f} ha, {geometria_parcela.length:.0f} m de perímetro o longitud.")
+        st.write(", ".join(nombre for nombre, _ in elementos_entrada))
+    else:
+        st.info("Añade al menos una parcela o geometría.")
+
+# Modo por lote: un fichero con muchas coordenadas o parcelas, sin formulario individual
+if modo == "Por lote":
+    archivo_lote = st.file_uploader("Fichero CSV o Excel con columnas X e Y, o Municipio, Polígono y Parcela",
+                                    type=["csv", "xlsx"])
+    pdf_por_fila = st.checkbox("Generar un informe PDF por fila")
+
+    if archivo_lote is not None and st.button("Procesar lote"):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            entrada = os.path.join(tmpdir, archivo_lote.name)
+            with open(entrada, "wb") as f:
+                f.write(archivo_lote.getbuffer())
+            salida = os.path.join(tmpdir, "resultados.csv")
+            directorio_pdf = os.path.join(tmpdir, "pdf") if pdf_por_fila else None
+
+            estado = st.empty()
+            try:
+                total = procesar_lote(entrada, salida, directorio_pdf,
+                                      progreso=lambda n: estado.info(f"{n} filas procesadas..."))
+            except (ValueError, RuntimeError) as e:
+                st.error(str(e))
+            else:
+                estado.success(f"Lote procesado: {total} filas.")
+                with open(salida, "rb") as f:
+                    st.session_state['lote_csv'] = f.read()
+                st.session_state['lote_pdf'] = None
+                if directorio_pdf:
+                    comprimido = BytesIO()
+                    with zipfile.ZipFile(comprimido, "w", zipfile.ZIP_DEFLATED) as zf:
+                        for nombre_pdf in sorted(os.listdir(directorio_pdf)):
+                            zf.write(os.path.join(directorio_pdf, nombre_pdf), nombre_pdf)
+                    st.session_state['lote_pdf'] = comprimido.getvalue()
+
+    if st.session_state.get('lote_csv'):
+        st.download_button("📊 Descargar resultados CSV", st.session_state['lote_csv'],
+                           file_name="resultados_afecciones.csv")
+    if st.session_state.get('lote_pdf'):
+        st.download_button("📄 Descargar informes PDF (ZIP)", st.session_state['lote_pdf'],
+                           file_name="informes_afecciones.zip")
+    st.stop()
+
 # Si el modo es "Por coordenadas" NO se solicita la entrada previa
 # Se incluirán los inputs de coordenadas en el formulario
 
@@ -431,7 +490,7 @@ with st.form("formulario"):
         y = st.number_input("Coordenada Y (ETRS89)", format="%.2f")
     else:
         # Muestra las coordenadas calculadas y las pone como campo oculto para el formulario
-        st.info(f"Coordenadas obtenidas de la parcela: X = {x}, Y = {y}")
+        st.info(f"Coordenadas obtenidas de la parcela o geometría: X = {x:.2f}, Y = {y:.2f}")
         
     fecha_solicitud = st.date_input("Fecha de la solicitud")
     nombre = st.text_input("Nombre")
@@ -441,94 +500,147 @@ with st.form("formulario"):
     telefono = st.text_input("Teléfono")
     email = st.text_input("Correo electrónico")
     objeto = st.text_area("Objeto de la solicitud", max_chars=255)       
-    submitted = st.form_submit_button("Generar informe")
 
-if 'mapa_html' not in st.session_state:
-    st.session_state['mapa_html'] = None
-if 'pdf_file' not in st.session_state:
-    st.session_state['pdf_file'] = None
+    # Consulta de proximidad: además de la contención, distancia a los elementos de cada capa
+    proximidad = st.checkbox("Incluir proximidad a las capas (elementos a menos de N metros)")
+    with st.expander("Umbrales de proximidad (m)"):
+        distancias = {d.nombre: st.number_input(d.nombre, min_value=0.0, value=float(d.distancia), step=50.0,
+                                                key=f"distancia_{d.nombre}")
+                      for d in CAPAS_AFECCION if d.distancia > 0}
+    submitted = st.form_submit_button("Generar informe")
 
 if submitted:
     # Validación de entradas
     if not nombre or not apellidos or not dni or x == 0 or y == 0:
         st.warning("Por favor, completa todos los campos obligatorios y asegúrate de que las coordenadas son correctas.")
     else:
-        lon, lat = transformar_coordenadas(x, y)
-
-        # Mostrar los datos seleccionados (solo si estamos en modo parcela)
-        if modo == "Por parcela":
-            st.write(f"Municipio seleccionado: {municipio_sel}")
-            st.write(f"Polígono seleccionado: {masa_sel}")
-            st.write(f"Parcela seleccionada: {parcela_sel}")
-        else:
-            st.write("Modo por coordenadas seleccionado. Municipio no disponible.")
-
-        # URLs GeoJSON
-        enp_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/GeoJSON/ENP.json"
-        zepa_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/GeoJSON/ZEPA.json"
-        lic_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/GeoJSON/LIC.json"
-        vp_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/GeoJSON/VP.json"
-        tm_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/GeoJSON/TM.json"
-        mup_url = "https://raw.githubusercontent.com/UDIFCARM/Afecciones_UDIF/main/GeoJSON/MUP.json"
-
-        # Consultas de afecciones
-        afeccion_enp = consultar_geojson(x, y, enp_url, "ENP", campo_nombre="nombre")
-        afeccion_zepa = consultar_geojson(x, y, zepa_url, "ZEPA", campo_nombre="SITE_NAME")
-        afeccion_lic = consultar_geojson(x, y, lic_url, "LIC", campo_nombre="SITE_NAME")
-        afeccion_vp = consultar_geojson(x, y, vp_url, "VP", campo_nombre="VP_NB")
-        afeccion_tm = consultar_geojson(x, y, tm_url, "TM", campo_nombre="NAMEUNIT")
-        afeccion_mup = consultar_mup(x, y, mup_url)
-
-        # Compilando datos para mostrar
-        afecciones = [afeccion_enp, afeccion_zepa, afeccion_lic, afeccion_vp, afeccion_tm, afeccion_mup]
+        # Identificador de la solicitud: aparece en la línea de registro con los tiempos
+        # de cada etapa y en el nombre de los ficheros descargados
+        id_solicitud = uuid.uuid4().hex
+        st.session_state['id_solicitud'] = id_solicitud
+        with metricas.peticion("informe", id_solicitud, modo=modo):
+            lon, lat = transformar_coordenadas(x, y)
+
+            # Mostrar los datos seleccionados (solo si estamos en modo parcela)
+            if modo in ("Por parcela", "Varias parcelas"):
+                st.write(f"Municipio seleccionado: {municipio_sel}")
+                st.write(f"Polígono seleccionado: {masa_sel}")
+                st.write(f"Parcela seleccionada: {parcela_sel}")
+            else:
+                st.write("Modo por coordenadas seleccionado. Municipio no disponible.")
+
+            # Consultas de afecciones, todas las capas en paralelo. Con la misma entrada,
+            # umbrales y datos se reutiliza el resultado (y el mapa) de la sesión
+            clave_afecciones = (clave_entrada, x, y, proximidad, tuple(sorted(distancias.items())))
+            resultado_afecciones = nodo("afecciones", clave_afecciones, lambda: consultar_afecciones(
+                x, y, capas=con_distancias(distancias), geometria=geometria_parcela, proximidad=proximidad))
+            for resultado in resultado_afecciones:
+                if resultado.error:
+                    st.error(f"Error al consultar {resultado.capa}: {resultado.error}")
+
+            # Compilando datos para mostrar
+            afecciones = resultado_afecciones.textos
         
-        datos = {
-            "fecha_solicitud": fecha_solicitud.strftime('%d/%m/%Y'),
-            "fecha_informe": datetime.today().strftime('%d/%m/%Y'),
-            "nombre": nombre,
-            "apellidos": apellidos,
-            "dni": dni,
-            "dirección": direccion,
-            "teléfono": telefono,
-            "email": email,
-            "objeto de la solicitud": objeto,
-            "afección MUP": afeccion_mup,
-            "afección VP": afeccion_vp,
-            "afección ENP": afeccion_enp,
-            "afección ZEPA": afeccion_zepa,
-            "afección LIC": afeccion_lic,
-            "afección TM": afeccion_tm,
-            "coordenadas_x": x,
-            "coordenadas_y": y,
-            "municipio": municipio_sel if modo == "Por parcela" else "N/A",  # Solo en modo parcela
-            "polígono": masa_sel if modo == "Por parcela" else "N/A",  # Solo en modo parcela
-            "parcela": parcela_sel if modo == "Por parcela" else "N/A"  # Solo en modo parcela  
-        }
+            datos = componer_datos(
+                resultado_afecciones,
+                fecha_solicitud=fecha_solicitud.strftime('%d/%m/%Y'),
+                nombre=nombre,
+                apellidos=apellidos,
+                dni=dni,
+                direccion=direccion,
+                telefono=telefono,
+                email=email,
+                objeto=objeto,
+                # Solo en modo parcela
+                municipio=municipio_sel if modo in ("Por parcela", "Varias parcelas") else "N/A",
+                poligono=masa_sel if modo in ("Por parcela", "Varias parcelas") else "N/A",
+                parcela=parcela_sel if modo in ("Por parcela", "Varias parcelas") else "N/A",
+            )
         
-        # Crear mapa con afecciones
-        mapa_html, afecciones = crear_mapa(lon, lat, afecciones)
-
-        # Guardar estado 
-        st.session_state['mapa_html'] = mapa_html
-        st.session_state['afecciones'] = afecciones
+            # Crear mapa con afecciones
+            def crear_mapa_html():
+                with metricas.etapa("mapa_interactivo"):
+                    mapa_html, _ = crear_mapa(lon, lat, afecciones, x, y, geometria_parcela)
+                return mapa_html.getvalue()
+
+            mapa_html = nodo("mapa", clave_afecciones, crear_mapa_html)
+
+            # Guardar estado (el mapa y los informes se quedan solo en el grafo de la sesión)
+            st.session_state['afecciones'] = afecciones
+
+            # Mostrar el mapa y el PDF
+            st.subheader("Resultado de las afecciones")
+            for afeccion in afecciones:
+                st.write(f"• {afeccion}")
+
+            html(mapa_html.decode("utf-8"), height=500)
+
+            # Detalle por geometría de entrada: todas se cruzan a la vez con cada capa
+            st.session_state['tabla_elementos'] = None
+            if elementos_entrada:
+                def detallar_geometrias():
+                    with metricas.etapa("detalle_geometrias"):
+                        resultados_elementos = consultar_afecciones_lote([g for _, g in elementos_entrada])
+                    return [fila for (nombre_elemento, _), resultado_elemento
+                            in zip(elementos_entrada, resultados_elementos)
+                            for fila in filas_por_elemento(nombre_elemento, resultado_elemento)]
+
+                filas = nodo("detalle", (clave_entrada,), detallar_geometrias)
+                st.subheader("Afecciones por geometría")
+                if filas:
+                    tabla_elementos = pd.DataFrame(filas)
+                    st.dataframe(tabla_elementos, use_container_width=True)
+                    st.session_state['tabla_elementos'] = tabla_elementos.to_csv(index=False).encode("utf-8")
+                else:
+                    st.write("Ninguna de las geometrías está afectada.")
 
-        # Mostrar el mapa y el PDF
-        st.subheader("Resultado de las afecciones")
-        for afeccion in afecciones:
-            st.write(f"• {afeccion}")
+            # PDF generado en memoria desde los datos; solo se rehace si cambian los
+            # resultados o los datos del solicitante
+            clave_informe = (clave_afecciones, *sorted((k, str(v)) for k, v in datos.items()
+                                                       if k != "resultado_afecciones"))
+            nodo("pdf", clave_informe, lambda: generar_pdf(datos, x, y).getvalue())
 
-        with open(mapa_html, 'r') as f:
-            html(f.read(), height=500)
+            # Informe Word con la plantilla del repositorio
+            def generar_docx():
+                try:
+                    return generar_informe(datos, x, y, "docx").getvalue(), None
+                except Exception as e:
+                    return None, str(e)
 
-        # PDF generado desde los datos
-        pdf_filename = f"informe_{uuid.uuid4().hex[:8]}.pdf"
-        generar_pdf(datos, x, y, pdf_filename)
-        st.session_state['pdf_file'] = pdf_filename
+            _, error_docx = nodo("docx", clave_informe, generar_docx)
+            if error_docx:
+                st.warning(f"No se ha podido generar el informe Word: {error_docx}")
 
 # Botones de descarga
-if st.session_state['mapa_html'] and st.session_state['pdf_file']:
-    with open(st.session_state['pdf_file'], "rb") as f:
-        st.download_button("📄 Descargar informe PDF", f, file_name="informe_afecciones.pdf")
-
-    with open(st.session_state['mapa_html'], "r") as f:
-        st.download_button("🌍 Descargar mapa HTML", f, file_name="mapa_busqueda.html")
+if st.session_state.get('tabla_elementos'):
+    st.download_button("📊 Descargar afecciones por geometría (CSV)", st.session_state['tabla_elementos'],
+                       file_name="afecciones_por_geometria.csv", mime="text/csv")
+
+# Mapa e informes: se leen del grafo de la sesión, sin guardar otra copia
+mapa_html, pdf_file = valor_nodo("mapa"), valor_nodo("pdf")
+if mapa_html and pdf_file:
+    sufijo = st.session_state.get('id_solicitud', '')[:8]
+    docx_file, _ = valor_nodo("docx") or (None, None)
+    st.download_button("📄 Descargar informe PDF", pdf_file,
+                       file_name=f"informe_afecciones_{sufijo}.pdf", mime="application/pdf")
+    if docx_file:
+        st.download_button("📝 Descargar informe Word", docx_file,
+                           file_name=f"informe_afecciones_{sufijo}.docx",
+                           mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+
+    st.download_button("🌍 Descargar mapa HTML", mapa_html,
+                       file_name=f"mapa_busqueda_{sufijo}.html", mime="text/html")
+
+# Panel de administración: tiempos medios por etapa y contadores del proceso
+if config.PANEL_ADMIN:
+    with st.sidebar.expander("Métricas", expanded=False):
+        etapas, contadores = metricas.resumen()
+        if st.session_state.get('id_solicitud'):
+            st.caption(f"Última solicitud: {st.session_state['id_solicitud']}")
+        st.caption(f"Versión de los datos: {obtener_versionado().version}")
+        st.write("Tiempo medio por etapa")
+        st.dataframe([{"etapa": e, **v} for e, v in etapas.items()], use_container_width=True)
+        st.write("Contadores")
+        st.dataframe(contadores, use_container_width=True)
+        st.download_button("Descargar métricas (Prometheus)", metricas.texto_prometheus(),
+                           file_name="metricas.txt", mime="text/plain")